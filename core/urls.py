@@ -18,7 +18,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.views.generic import RedirectView
-from rental.views import dashboard, load_more_investments, city_analytics, download_debug_log
+from rental.views import dashboard, load_more_investments, city_analytics, download_debug_log, receivables_aging, revenue_forecast, deposit_liability, battery_utilization, assignment_integrity, fleet_as_of, fleet_as_of_api
 
 urlpatterns = [
     # Redirect root to admin
@@ -27,6 +27,13 @@ urlpatterns = [
     path('admin/dashboard/', dashboard, name='admin-dashboard'),
     path('admin/load-investments/', load_more_investments, name='load-investments'),
     path('admin/city-analytics/', city_analytics, name='city-analytics'),
+    path('admin/receivables-aging/', receivables_aging, name='receivables-aging'),
+    path('admin/revenue-forecast/', revenue_forecast, name='revenue-forecast'),
+    path('admin/deposit-liability/', deposit_liability, name='deposit-liability'),
+    path('admin/battery-utilization/', battery_utilization, name='battery-utilization'),
+    path('admin/assignment-integrity/', assignment_integrity, name='assignment-integrity'),
+    path('admin/fleet-as-of/', fleet_as_of, name='fleet-as-of'),
+    path('admin/fleet-as-of/api/', fleet_as_of_api, name='fleet-as-of-api'),
     path('admin/debug-log/', download_debug_log, name='download-debug-log'),
     path('admin/', admin.site.urls),
 ]
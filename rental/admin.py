@@ -1,23 +1,28 @@
 from django import forms
 from django.contrib.admin.views.decorators import staff_member_required
 from django.urls import reverse
-from django.http import HttpResponseRedirect, JsonResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, HttpResponseForbidden, StreamingHttpResponse
 
-from django.db import transaction
-from django.db.models import Sum, Q, F
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, OuterRef, Subquery, Sum, Q, F, DecimalField, Value
+from django.db.models.functions import Coalesce, NullIf
 
 from django.contrib import admin, messages
 from django.contrib.admin.helpers import ActionForm, ACTION_CHECKBOX_NAME
 from django.core.exceptions import ValidationError
 from django.urls import reverse, path
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.html import format_html
+from django.utils.http import quote_etag
 from django.utils import timezone
 from django.template.response import TemplateResponse
 from django.forms import inlineformset_factory, BaseInlineFormSet
+from django.core.paginator import Page, Paginator
 from decimal import Decimal
 from django.utils.safestring import mark_safe
 from datetime import datetime, time, timedelta, date as date_type
 from admin_auto_filters.filters import AutocompleteFilter
+import csv
 import json
 import traceback
 
@@ -25,13 +30,32 @@ import traceback
 import rental.templatetags.custom_filters
 
 from simple_history.admin import SimpleHistoryAdmin
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 from .models import (
     Client, Battery, Rental, RentalBatteryAssignment,
     Payment, ExpenseCategory, Expense, Repair, BatteryStatusLog, BatteryTransfer,
     FinancePartner, OwnerContribution, OwnerWithdrawal, MoneyTransfer, FinanceAdjustment,
-    City,
+    City, BatteryMonthlyAttribution, ScheduledTariffChange,
 )
-from .admin_utils import CityFilteredAdminMixin, get_user_city, get_user_cities, is_moderator, get_debug_log_path
+from . import attribution, billing, closing, snapshot, timeline
+from .assignment_effects import assignments_saved, batch_assignment_effects
+from .counters import status_counts
+from .tariffs import apply_tariff_change, carry_over_assignments
+from .admin_utils import (
+    CityFilteredAdminMixin, EstimatedCountPaginator, ScopedAutocompleteSelect, autocomplete_source, get_user_city,
+    get_user_cities, is_moderator, get_debug_log_path,
+)
+
+
+class HistoryAdmin(SimpleHistoryAdmin):
+    """
+    Базовая админка моделей с историей: списки большой таблицы без фильтров
+    считаются по оценке pg_class.reltuples (EstimatedCountPaginator).
+    Общее число строк без фильтров (root_queryset.count() в ChangeList) не
+    считается — иначе точный COUNT(*) выполнялся бы на каждом открытии списка.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class ModeratorRestrictedMixin:
@@ -177,7 +201,7 @@ class ModeratorReadOnlyRelatedMixin:
 
 
 @admin.register(City)
-class CityAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class CityAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "name", "code", "active")
     list_filter = ("active",)
     search_fields = ("name", "code")
@@ -191,7 +215,7 @@ class CityAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
 
 
 @admin.register(FinancePartner)
-class FinancePartnerAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class FinancePartnerAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "user", "role", "city", "cities_display", "share_percent", "commission_percent", "active")
     list_filter = ("role", "active", "city")
     search_fields = ("user__username", "user__first_name", "user__last_name")
@@ -429,7 +453,7 @@ class FinancePartnerAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
 
 
 # @admin.register(OwnerContribution)
-class OwnerContributionAdmin(SimpleHistoryAdmin):
+class OwnerContributionAdmin(HistoryAdmin):
     list_display = ("id", "partner", "amount", "date", "source")
     list_filter = ("source", "date")
     autocomplete_fields = ("partner", "expense")
@@ -450,7 +474,7 @@ class OwnerContributionAdmin(SimpleHistoryAdmin):
 
 
 @admin.register(OwnerWithdrawal)
-class OwnerWithdrawalAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class OwnerWithdrawalAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "partner", "amount", "date")
     list_filter = ("date",)
     autocomplete_fields = ("partner",)
@@ -501,7 +525,7 @@ class OwnerWithdrawalAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
 
 
 @admin.register(MoneyTransfer)
-class MoneyTransferAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class MoneyTransferAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "from_partner", "to_partner", "amount", "date", "purpose", "use_collected")
     list_filter = ("purpose", "use_collected", "date")
     autocomplete_fields = ("from_partner", "to_partner")
@@ -620,7 +644,7 @@ class MoneyTransferAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
 
 
 @admin.register(FinanceAdjustment)
-class FinanceAdjustmentAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class FinanceAdjustmentAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "target", "amount", "date")
     
     def has_module_permission(self, request):
@@ -2108,7 +2132,7 @@ class ActiveRentalFilter(admin.SimpleListFilter):
 
 
 @admin.register(Client)
-class ClientAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
+class ClientAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, HistoryAdmin):
     list_display = ("id", "name", "phone", "pesel", "city", "created_at", "has_active")
     list_filter = (ActiveRentalFilter, "city")
     search_fields = ("name", "phone", "pesel")
@@ -2126,21 +2150,28 @@ class ClientAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
 
         # Получаем все root-группы договоров клиента
         root_rentals = client.rentals.filter(parent__isnull=True).order_by("contract_code")
+        root_ids = list(root_rentals.values_list("pk", flat=True))
+
+        # Итоги по всем группам одним пакетным расчётом
+        now = timezone.now()
+        tz = timezone.get_current_timezone()
+        summaries, _groups = billing.group_summaries(root_ids, tz, now)
 
         # Собираем данные для шаблона
         rental_data = []
-        now = timezone.now()
         for root in root_rentals:
-            versions = root.group_versions()
-            start = versions.first().start_at if versions.exists() else None
-            end = versions.last().end_at if versions.exists() else None
+            summary = summaries.get(root.pk)
+            if not summary:
+                continue
+            # Границы группы и число версий — из сводки на root, без обхода версий
+            start = root.group_start_at or root.start_at
+            end = root.group_end_at
             days_total = (end or now) - (start or now)
             days_total = days_total.days if days_total else 0
-            billable_days = sum(v.billable_days() for v in versions)
-            charges = root.group_charges_until(now)
-            paid = root.group_paid_total()
+            charges = summary["charges"]
+            paid = summary["paid"]
             balance = (paid or Decimal(0)) - (charges or Decimal(0))
-            deposit = root.group_deposit_total()
+            deposit = summary["deposit"]
             # Определяем цветовую метку баланса (зелёный, если не должен)
             if (charges or 0) == 0 and (paid or 0) == 0:
                 color = 'gray'
@@ -2152,11 +2183,11 @@ class ClientAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                 color = 'red'
             rental_data.append({
                 "contract_code": root.contract_code,
-                "version_range": f"v1–v{versions.count()}",
+                "version_range": f"v1–v{root.versions_count}",
                 "start": start,
                 "end": end,
                 "days_total": days_total,
-                "billable_days": billable_days,
+                "billable_days": summary["billable_days"],
                 "charges": charges,
                 "paid": paid,
                 "balance": balance,
@@ -2172,9 +2203,128 @@ class ClientAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
             extra_context = {}
         extra_context["rental_data"] = rental_data
         extra_context["payments"] = payments
+        extra_context["statement_url"] = reverse("admin:rental_client_statement", args=[client.pk])
 
         return super().change_view(request, object_id, form_url, extra_context)
 
+    def get_urls(self):
+        urls = super().get_urls()
+        custom = [
+            path(
+                '<int:pk>/statement/',
+                self.admin_site.admin_view(self.statement_view),
+                name='rental_client_statement',
+            ),
+            path(
+                '<int:pk>/statement.csv',
+                self.admin_site.admin_view(self.statement_csv_view),
+                name='rental_client_statement_csv',
+            ),
+        ]
+        return custom + urls
+
+    def _get_statement_client(self, request, pk):
+        # get_object учитывает фильтрацию по городу модератора
+        client = self.get_object(request, str(pk))
+        if client is None or not self.has_view_permission(request, client):
+            return None
+        return client
+
+    def _statement_rows(self, client):
+        root_ids = client.rentals.filter(parent__isnull=True).values("pk")
+        return billing.iter_statement(root_ids, timezone.get_current_timezone(), timezone.now())
+
+    def _statement_page(self, client, page, per_page=100):
+        """
+        Итоги и одна страница выписки за один потоковый проход iter_statement:
+        в памяти только строки запрошенной и текущей последней страницы.
+        Номер страницы — как у Paginator.get_page; без номера (и вне диапазона) —
+        последняя: последние операции важнее.
+        """
+        try:
+            wanted = int(page) if page is not None else None
+        except (TypeError, ValueError):
+            wanted = 1
+        if wanted is not None and wanted < 1:
+            wanted = None
+        count = 0
+        charges = paid = Decimal(0)
+        last = None
+        page_rows, tail = [], []
+        for row in self._statement_rows(client):
+            if count % per_page == 0:
+                tail = []
+            tail.append(row)
+            if wanted is not None and (wanted - 1) * per_page <= count < wanted * per_page:
+                page_rows.append(row)
+            if row["kind"] == "charge":
+                charges += row["amount"]
+            elif row["kind"] == Payment.PaymentType.RENT:
+                paid += row["amount"]
+            last = row
+            count += 1
+        paginator = Paginator(range(count), per_page)
+        if wanted is None or wanted > paginator.num_pages:
+            wanted, page_rows = paginator.num_pages, tail
+        totals = {
+            "charges": charges,
+            "paid": paid,
+            "balance": last["balance"] if last else Decimal(0),
+            "deposit": last["deposit"] if last else Decimal(0),
+        }
+        return Page(page_rows, wanted, paginator), totals
+
+    def statement_view(self, request, pk):
+        """Выписка по счёту клиента: посуточные начисления, платежи, нарастающий баланс."""
+        client = self._get_statement_client(request, pk)
+        if client is None:
+            return HttpResponseForbidden("Нет доступа")
+        page_obj, totals = self._statement_page(client, request.GET.get("page"))
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": f"Выписка: {client.name}",
+            "client": client,
+            "page_obj": page_obj,
+            "totals": totals,
+            "csv_url": reverse("admin:rental_client_statement_csv", args=[client.pk]),
+            "change_url": reverse("admin:rental_client_change", args=[client.pk]),
+        }
+        return TemplateResponse(request, "admin/rental/client/statement.html", context)
+
+    def statement_csv_view(self, request, pk):
+        """Та же выписка потоковым CSV (строки формируются по мере отдачи)."""
+        client = self._get_statement_client(request, pk)
+        if client is None:
+            return HttpResponseForbidden("Нет доступа")
+
+        class Echo:
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo(), delimiter=';')
+
+        def stream():
+            yield writer.writerow([
+                "Дата", "Договор", "Операция", "Описание", "Батарей",
+                "Сумма", "Баланс", "Депозит",
+            ])
+            for r in self._statement_rows(client):
+                yield writer.writerow([
+                    r["date"].strftime("%d.%m.%Y"),
+                    r["contract_code"],
+                    r["label"],
+                    r["description"],
+                    r["battery_count"] if r["battery_count"] is not None else "",
+                    f"{r['amount']:.2f}",
+                    f"{r['balance']:.2f}",
+                    f"{r['deposit']:.2f}",
+                ])
+
+        response = StreamingHttpResponse(stream(), content_type="text/csv; charset=utf-8")
+        response["Content-Disposition"] = f'attachment; filename="statement_client_{client.pk}.csv"'
+        return response
+
     list_filter = (ActiveRentalFilter,)
 
     class Media:
@@ -2357,19 +2507,71 @@ class BatteryTransferActionForm(ActionForm):
         self.fields['to_city'].queryset = City.objects.filter(active=True).order_by('name')
 
 
+# Сколько последних полных месяцев берём для прогноза окупаемости батареи
+ATTRIBUTION_RECENT_MONTHS = 3
+
+
 @admin.register(Battery)
-class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
-    # Убираем тяжёлые колонки roi_progress из списка, возвращаем в detail
-    list_display = ("id", "short_code", "status_display", "usage_now", "serial_number", "city", "cost_price", "created_at")
+class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, HistoryAdmin):
+    # Окупаемость, выручка, ремонты и прогноз окупаемости берутся из помесячного
+    # леджера BatteryMonthlyAttribution (аннотации только в списке — get_changelist, сортируемые).
+    # Леджер дней и начислений идущих аренд обновляется ежесуточно:
+    # manage.py rebuild_battery_attribution --open (см. README)
+    list_display = (
+        "id", "short_code", "status_display", "usage_now", "serial_number", "city", "cost_price",
+        "roi_progress", "attr_payments_display", "attr_repairs_display", "payback_display", "created_at",
+    )
+    readonly_fields = ("roi_progress",)
     search_fields = ("short_code", "serial_number")
     list_filter = ("status", "city")
     autocomplete_fields = ["city"]
     change_list_template = 'admin/rental/battery/change_list.html'
+    change_form_template = 'admin/rental/battery/change_form.html'
     list_per_page = 50
     ordering = ['id']  # Сортировка по умолчанию от меньшего к большему
     actions = ["create_transfer_request"]
     action_form = BatteryTransferActionForm
 
+    class Media:
+        js = [
+            "https://unpkg.com/htmx.org@1.9.2",
+        ]
+
+    # Подписи видов записей хронологии (остальные — из BatteryStatusLog.Kind)
+    TIMELINE_LABELS = {
+        timeline.RENTAL: "Аренда",
+        timeline.REPAIR: "Ремонт",
+        timeline.TRANSFER: "Перенос",
+        timeline.IDLE: "Простой",
+    }
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom = [
+            path(
+                '<int:pk>/timeline/',
+                self.admin_site.admin_view(self.timeline_view),
+                name='rental_battery_timeline',
+            ),
+        ]
+        return custom + urls
+
+    def timeline_view(self, request, pk):
+        """HTMX-панель хронологии на странице батареи: батарея + один запрос UNION ALL."""
+        # Базовый queryset (с фильтром города модератора), без аннотаций леджера
+        battery = super().get_queryset(request).filter(pk=pk).values('id', 'created_at').first()
+        if battery is None or not self.has_view_permission(request):
+            return HttpResponseForbidden("Нет доступа")
+        entries = timeline.battery_timeline(battery['id'], since=battery['created_at'])
+        log_labels = dict(BatteryStatusLog.Kind.choices)
+        for e in entries:
+            e['label'] = self.TIMELINE_LABELS.get(e['kind']) or log_labels.get(e['kind'], e['kind'])
+            if e['kind'] == timeline.RENTAL:
+                e['url'] = reverse('admin:rental_rental_change', args=[e['root_id']])
+            elif e['kind'] == timeline.REPAIR:
+                e['url'] = reverse('admin:rental_repair_change', args=[e['id']])
+        return TemplateResponse(request, 'admin/partials/battery_timeline.html', {'entries': entries})
+
     def has_module_permission(self, request):
         """Скрываем модуль из списка для модераторов, но разрешаем autocomplete"""
         if is_moderator(request.user):
@@ -2386,15 +2588,62 @@ class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
         return super().has_view_permission(request, obj) if hasattr(super(), 'has_view_permission') else True
 
     def get_queryset(self, request):
-        """Оптимизация: предзагрузка assignments для избежания N+1"""
+        """Оптимизация: текущее назначение читается из указателя на батарее (без N+1)"""
         qs = super().get_queryset(request)
-        qs = qs.select_related('city')
-        qs = qs.prefetch_related(
-            'assignments__rental__client',
-            'assignments__rental__root'
+        qs = qs.select_related('city', 'current_assignment', 'current_rental_root', 'current_client')
+        # Число групп договоров, в которых батарея назначена сейчас (>1 — двойное назначение)
+        now = timezone.now()
+        active_roots = (
+            RentalBatteryAssignment.objects.filter(battery_id=OuterRef('pk'), start_at__lte=now)
+            .filter(Q(end_at__isnull=True) | Q(end_at__gt=now))
+            .order_by().values('battery_id')
+            .annotate(n=Count(Coalesce('rental__root_id', 'rental_id'), distinct=True)).values('n')
         )
-        return qs
-    
+        return qs.annotate(active_roots_now=Coalesce(Subquery(active_roots), 0))
+
+    def get_changelist(self, request, **kwargs):
+        from django.contrib.admin.views.main import ChangeList
+
+        annotate = self._annotate_attribution
+
+        class AttributionChangeList(ChangeList):
+            def get_queryset(self, request, exclude_parameters=None):
+                # Суммы леджера (GROUP BY) — только в списке батарей, не в autocomplete и форме.
+                # Аннотируем исходный queryset до сортировки: столбцы сортируются по attr_*
+                if not getattr(self, '_attribution_annotated', False):
+                    self.root_queryset = annotate(self.root_queryset)
+                    self._attribution_annotated = True
+                return super().get_queryset(request, exclude_parameters)
+
+        return AttributionChangeList
+
+    @staticmethod
+    def _annotate_attribution(qs):
+        """Суммы из леджера атрибуции + окупаемость и прогноз в месяцах (для сортировки)."""
+        zero = Value(Decimal(0), output_field=DecimalField(max_digits=12, decimal_places=2))
+        this_month = attribution.month_start(timezone.localdate())
+        recent_from = this_month
+        for _ in range(ATTRIBUTION_RECENT_MONTHS):
+            recent_from = attribution.month_start(recent_from - timedelta(days=1))
+        qs = qs.annotate(
+            attr_payments=Coalesce(Sum('monthly_attribution__payments'), zero),
+            attr_repairs=Coalesce(Sum('monthly_attribution__repair_costs'), zero),
+            attr_days=Coalesce(Sum('monthly_attribution__battery_days'), Value(0)),
+            attr_recent=Coalesce(
+                Sum(
+                    'monthly_attribution__payments',
+                    filter=Q(monthly_attribution__month__gte=recent_from, monthly_attribution__month__lt=this_month),
+                ),
+                zero,
+            ),
+        )
+        return qs.annotate(
+            attr_recovery=(F('attr_payments') - F('attr_repairs')) * 100 / NullIf(F('cost_price'), zero),
+            attr_remaining=Coalesce(F('cost_price'), zero) + F('attr_repairs') - F('attr_payments'),
+        ).annotate(
+            attr_payback_months=F('attr_remaining') * ATTRIBUTION_RECENT_MONTHS / NullIf(F('attr_recent'), zero),
+        )
+
     def get_form(self, request, obj=None, **kwargs):
         """Делаем поле city readonly для модераторов"""
         form = super().get_form(request, obj, **kwargs)
@@ -2450,6 +2699,12 @@ class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
             # #endregion
             if city:
                 queryset = queryset.filter(city=city)
+
+        # Батареи в назначениях договора — только из города договора
+        if autocomplete_source(request) == ('rentalbatteryassignment', 'battery'):
+            city_id = request.GET.get('city')
+            if city_id and city_id.isdigit():
+                queryset = queryset.filter(city_id=int(city_id))
         
         # #region agent log
         try:
@@ -2477,41 +2732,36 @@ class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
         super().save_model(request, obj, form, change)
 
     def usage_now(self, obj):
-        # Активные договоры сейчас, где батарея назначена
-        tz = timezone.get_current_timezone()
-        now = timezone.localtime(timezone.now(), tz)
-        assignments = obj.assignments.select_related('rental__client').all()
-        active_roots = []
-        for a in assignments:
-            start = timezone.localtime(a.start_at, tz)
-            end = timezone.localtime(a.end_at, tz) if a.end_at else None
-            if start <= now and (end is None or end > now):
-                root = a.rental.root if hasattr(a.rental, 'root') and a.rental.root_id else a.rental
-                active_roots.append(root)
-        # Уникальные root договоры
-        uniq = []
-        seen = set()
-        for r in active_roots:
-            if r.pk not in seen:
-                uniq.append(r)
-                seen.add(r.pk)
-        parts = []
-        for r in uniq:
-            client_link = format_html('<a href="{}" style="color:#000; text-decoration:none;">{}</a>', reverse('admin:rental_client_change', args=[r.client_id]), r.client.name)
-            rental_link = format_html('<a href="{}" style="color:#000; text-decoration:none;">{}</a>', reverse('admin:rental_rental_change', args=[r.pk]), r.contract_code)
-            parts.append(format_html('[{}, {}]', client_link, rental_link))
-        count = len(uniq)
+        # Текущий договор батареи — денормализованный указатель (Battery.sync_current_assignment)
+        now = timezone.now()
+        if getattr(obj, 'active_roots_now', 0) > 1:
+            # Батарея сейчас в нескольких группах — перечисляем все (редкий случай, отдельный запрос)
+            root_ids = {
+                root_id or rental_id
+                for rental_id, root_id in obj.assignments.filter(start_at__lte=now)
+                .filter(Q(end_at__isnull=True) | Q(end_at__gt=now)).values_list('rental_id', 'rental__root_id')
+            }
+            roots = Rental.objects.filter(pk__in=root_ids).select_related('client').order_by('pk')
+            parts = [
+                format_html(
+                    '[{}, {}]',
+                    format_html('<a href="{}" style="color:#000; text-decoration:none;">{}</a>', reverse('admin:rental_client_change', args=[r.client_id]), r.client.name),
+                    format_html('<a href="{}" style="color:#000; text-decoration:none;">{}</a>', reverse('admin:rental_rental_change', args=[r.pk]), r.contract_code),
+                )
+                for r in roots
+            ]
+            content = format_html(', '.join(['{}'] * len(parts)), *parts) if parts else '-'
+            return format_html('<span class="badge bg-{}" style="background-color:{}; color:#000;">{}</span>', 'warning', '#ffc107', content)
+        a = obj.current_assignment
+        r = obj.current_rental_root
+        active = a is not None and r is not None and a.start_at <= now and (a.end_at is None or a.end_at > now)
         # Цвет + инлайн-стиль как fallback, если Bootstrap не подгрузился
-        bg = 'secondary'
-        bg_color = '#6c757d'
-        if count == 1:
-            bg = 'success'
-            bg_color = '#198754'
-        elif count > 1:
-            bg = 'warning'
-            bg_color = '#ffc107'
-        content = format_html(', '.join(['{}'] * len(parts)), *parts) if parts else '-'
-        return format_html('<span class="badge bg-{}" style="background-color:{}; color:#000;">{}</span>', bg, bg_color, content)
+        if not active:
+            return format_html('<span class="badge bg-{}" style="background-color:{}; color:#000;">{}</span>', 'secondary', '#6c757d', '-')
+        client_link = format_html('<a href="{}" style="color:#000; text-decoration:none;">{}</a>', reverse('admin:rental_client_change', args=[obj.current_client_id]), obj.current_client.name if obj.current_client else '-')
+        rental_link = format_html('<a href="{}" style="color:#000; text-decoration:none;">{}</a>', reverse('admin:rental_rental_change', args=[r.pk]), r.contract_code)
+        content = format_html('[{}, {}]', client_link, rental_link)
+        return format_html('<span class="badge bg-{}" style="background-color:{}; color:#000;">{}</span>', 'success', '#198754', content)
     usage_now.short_description = "В аренде"
 
     @admin.display(ordering='status', description='Статус')
@@ -2545,74 +2795,24 @@ class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
             label
         )
 
+    def _attribution(self, obj):
+        """Значения леджера: из аннотаций списка или одним запросом для формы батареи."""
+        if not hasattr(obj, 'attr_payments'):
+            annotated = self._annotate_attribution(Battery.objects.filter(pk=obj.pk)).values(
+                'attr_payments', 'attr_repairs', 'attr_days', 'attr_recovery', 'attr_remaining', 'attr_payback_months'
+            ).first() or {}
+            for name, value in annotated.items():
+                setattr(obj, name, value)
+        return obj
+
     def roi_progress(self, obj):
-        # Окупаемость по фактическим оплатам: распределяем оплаты по доле "нагрузки" батареи
-        from decimal import Decimal, InvalidOperation
-        tz = timezone.get_current_timezone()
-        now = timezone.localtime(timezone.now(), tz)
-        # Группируем по root-договорам, где батарея была назначена
-        by_root_share = {}
-        days_total = 0
-        # Сначала соберём версии по root для быстрого доступа
-        roots = {}
-        for a in obj.assignments.select_related('rental').all():
-            root = a.rental.root if getattr(a.rental, 'root_id', None) else a.rental
-            roots.setdefault(root.pk, root)
-        # Для каждого root считаем долю батареи (battery_share) и дни аренды
-        for root in roots.values():
-            versions = list(root.group_versions())
-            # Precompute version windows with daily_rate
-            v_windows = []
-            for v in versions:
-                v_start = timezone.localtime(v.start_at, tz)
-                v_end = timezone.localtime(v.end_at, tz) if v.end_at else now
-                v_windows.append((v_start, v_end, (v.weekly_rate or Decimal(0)) / Decimal(7)))
-            battery_share = Decimal(0)
-            # Соберём интервалы назначений этой батареи внутри данного root
-            for a in obj.assignments.filter(rental__root=root).all():
-                a_start = timezone.localtime(a.start_at, tz)
-                a_end = timezone.localtime(a.end_at, tz) if a.end_at else now
-                # Идём по календарным дням, считаем только те дни, когда есть активная версия
-                d = a_start.date()
-                end_date = a_end.date()
-                while d <= end_date:
-                    day_start = timezone.make_aware(datetime.combine(d, time(0, 0)), tz)
-                    day_end = timezone.make_aware(datetime.combine(d + timedelta(days=1), time(0, 0)), tz)
-                    rate = None
-                    for v_start, v_end, v_rate in v_windows:
-                        if v_start < day_end and v_end > day_start:
-                            rate = v_rate
-                            break
-                    if rate is not None:
-                        battery_share += rate
-                    d += timedelta(days=1)
-            # Считаем дни аренды без привязки к активной версии
-            days_total = 0
-            for a in obj.assignments.all():
-                a_start = timezone.localtime(a.start_at, tz)
-                a_end = timezone.localtime(a.end_at, tz) if a.end_at else now
-                d = a_start.date()
-                end_date = a_end.date()
-                while d <= end_date:
-                    days_total += 1
-                    d += timedelta(days=1)
-            # Общая сумма начислений по группе
-            group_charges = root.group_charges_until(until=now) or Decimal(0)
-            group_paid = root.group_paid_total() or Decimal(0)
-            if group_charges > 0 and battery_share > 0:
-                by_root_share[root.pk] = (battery_share, group_charges, group_paid)
-        # Распределяем оплаты пропорционально
-        allocated = Decimal(0)
-        for battery_share, group_charges, group_paid in by_root_share.values():
-            try:
-                allocated += (battery_share / group_charges) * group_paid
-            except (InvalidOperation, ZeroDivisionError):
-                continue
-        cost = obj.cost_price or Decimal(0)
-        try:
-            pct = int(round((allocated / cost) * 100)) if cost else 0
-        except Exception:
-            pct = 0
+        # Окупаемость по леджеру: (оплаты, отнесённые на батарею − ремонты) / себестоимость
+        if obj is None or obj.pk is None:
+            return "-"
+        obj = self._attribution(obj)
+        recovery = obj.attr_recovery
+        days_total = obj.attr_days or 0
+        pct = int(round(recovery)) if recovery is not None else 0
         # Цвета прогресса
         bar_class = 'bg-danger'
         bar_style = ''
@@ -2634,7 +2834,36 @@ class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
             '</div>',
             bar_class, width, bar_style, pct, pct, days_total
         )
-    roi_progress.short_description = "Окупаемость"
+    roi_progress.short_description = "Окупаемость ((оплаты − ремонты) / себестоимость)"
+    roi_progress.admin_order_field = "attr_recovery"
+
+    @admin.display(description="Выручка (леджер)", ordering="attr_payments")
+    def attr_payments_display(self, obj):
+        if obj is None or obj.pk is None:
+            return "-"
+        return f"{self._attribution(obj).attr_payments or 0:.2f}"
+
+    @admin.display(description="Ремонты", ordering="attr_repairs")
+    def attr_repairs_display(self, obj):
+        if obj is None or obj.pk is None:
+            return "-"
+        return f"{self._attribution(obj).attr_repairs or 0:.2f}"
+
+    @admin.display(description="Окупится", ordering="attr_payback_months")
+    def payback_display(self, obj):
+        # Прогноз: остаток / средняя оплата за последние полные месяцы
+        if obj is None or obj.pk is None:
+            return "-"
+        obj = self._attribution(obj)
+        if not obj.cost_price:
+            return "-"
+        if obj.attr_remaining is not None and obj.attr_remaining <= 0:
+            return format_html('<span style="color: #00d27a;">{}</span>', "Окупилась")
+        months = obj.attr_payback_months
+        if months is None:
+            return "—"
+        payback_date = timezone.localdate() + timedelta(days=int(months * Decimal('30.44')))
+        return f"≈ {payback_date:%m.%Y}"
     
     @admin.action(description="Создать запрос на перенос батарей")
     def create_transfer_request(self, request, queryset):
@@ -2723,64 +2952,82 @@ class BatteryAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
                 self.message_user(request, error, level=messages.ERROR)
 
     def changelist_view(self, request, extra_context=None):
-        """Добавляем статистику в контекст списка батарей с кэшированием"""
-        from django.core.cache import cache
-        
+        """Добавляем статистику в контекст списка батарей (таблица счётчиков BatteryStatusCounter)"""
         extra_context = extra_context or {}
         
-        # Кэш на 24 часа (86400 секунд)
-        cache_key = 'battery_admin_stats'
-        cached_stats = cache.get(cache_key)
-        
-        if cached_stats is None:
-            # Статистика по статусам
-            from django.db.models import Count, Sum
-            status_stats = Battery.objects.values('status').annotate(
-                count=Count('id'),
-                total_cost=Sum('cost_price')
-            ).order_by('status')
-            
-            # Общая статистика
-            total_batteries = Battery.objects.count()
-            total_cost = Battery.objects.aggregate(total=Sum('cost_price'))['total'] or 0
-            
-            # Форматируем статистику по статусам
-            formatted_stats = []
-            status_labels = {
-                'rented': 'В аренде',
-                'service': 'Сервис',
-                'available': 'Доступны',
-                'sold': 'Продано'
-            }
-            status_colors = {
-                'rented': 'success',
-                'service': 'warning',
-                'available': 'primary',
-                'sold': 'info'
-            }
-            
-            for stat in status_stats:
-                if stat['status']:
-                    formatted_stats.append({
-                        'label': status_labels.get(stat['status'], stat['status']),
-                        'count': stat['count'],
-                        'total_cost': stat['total_cost'] or 0,
-                        'color': status_colors.get(stat['status'], 'secondary')
-                    })
-            
-            cached_stats = {
-                'total_batteries': total_batteries,
-                'total_cost': total_cost,
-                'status_breakdown': formatted_stats
-            }
-            
-            # Кэшируем на 24 часа
-            cache.set(cache_key, cached_stats, 86400)
+        counts = status_counts()
         
-        extra_context['battery_stats'] = cached_stats
+        # Форматируем статистику по статусам
+        formatted_stats = []
+        status_labels = {
+            'rented': 'В аренде',
+            'service': 'Сервис',
+            'available': 'Доступны',
+            'sold': 'Продано'
+        }
+        status_colors = {
+            'rented': 'success',
+            'service': 'warning',
+            'available': 'primary',
+            'sold': 'info'
+        }
+        
+        for status in sorted(counts):
+            if status and counts[status]['count']:
+                formatted_stats.append({
+                    'label': status_labels.get(status, status),
+                    'count': counts[status]['count'],
+                    'total_cost': counts[status]['total_cost'],
+                    'color': status_colors.get(status, 'secondary')
+                })
+        
+        battery_stats = {
+            'total_batteries': sum(c['count'] for c in counts.values()),
+            'total_cost': sum((c['total_cost'] for c in counts.values()), Decimal(0)),
+            'status_breakdown': formatted_stats
+        }
+        
+        extra_context['battery_stats'] = battery_stats
+        extra_context['fleet_profitability'] = self._fleet_profitability()
         
         return super().changelist_view(request, extra_context)
 
+    @staticmethod
+    def _fleet_profitability():
+        """Доходность парка по городам: себестоимость, оплаты и ремонты из леджера."""
+        from django.db.models import Count
+        cost_by_city = {
+            row['city_id']: row
+            for row in Battery.objects.values('city_id', 'city__name').annotate(
+                batteries=Count('id'), cost=Sum('cost_price')
+            ).order_by()
+        }
+        ledger_by_city = {
+            row['battery__city_id']: row
+            for row in BatteryMonthlyAttribution.objects.values('battery__city_id').annotate(
+                payments=Sum('payments'), repairs=Sum('repair_costs'), days=Sum('battery_days')
+            ).order_by()
+        }
+        rows = []
+        for city_id, c in cost_by_city.items():
+            ledger = ledger_by_city.get(city_id, {})
+            cost = c['cost'] or Decimal(0)
+            payments = ledger.get('payments') or Decimal(0)
+            repairs = ledger.get('repairs') or Decimal(0)
+            net = payments - repairs
+            rows.append({
+                'city': c['city__name'] or '—',
+                'batteries': c['batteries'],
+                'cost': cost,
+                'payments': payments,
+                'repairs': repairs,
+                'net': net,
+                'battery_days': ledger.get('days') or 0,
+                'recovery': (net / cost * 100) if cost else None,
+            })
+        rows.sort(key=lambda r: r['net'], reverse=True)
+        return rows
+
 
 
 class RentalBatteryAssignmentForm(forms.ModelForm):
@@ -2829,6 +3076,15 @@ class RentalBatteryAssignmentInline(admin.TabularInline):
     def get_formset(self, request, obj=None, **kwargs):
         """Дополнительно запрещаем добавление/редактирование батарей для модераторов через get_formset"""
         formset = super().get_formset(request, obj, **kwargs)
+
+        # Поиск батарей — только в городе договора (BatteryAdmin.get_search_results)
+        battery_field = formset.form.base_fields.get('battery')
+        if battery_field is not None and obj is not None and obj.city_id and hasattr(battery_field.widget, 'widget'):
+            scoped = ScopedAutocompleteSelect(
+                RentalBatteryAssignment._meta.get_field('battery'), self.admin_site, params={'city': obj.city_id}
+            )
+            scoped.choices = battery_field.widget.widget.choices
+            battery_field.widget.widget = scoped
         
         if is_moderator(request.user):
             # Для модераторов запрещаем все действия со связанными объектами
@@ -2885,7 +3141,7 @@ class NewVersionActionForm(ActionForm):
 
 
 @admin.register(Rental)
-class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
+class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, HistoryAdmin):
     autocomplete_fields = ('client', 'city')
 
     def changelist_view(self, request, extra_context=None):
@@ -2908,9 +3164,6 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         # #endregion
         if extra_context is None:
             extra_context = {}
-        from .models import Client
-        # Используем только необходимые поля, чтобы не тянуть всё
-        extra_context['clients'] = Client.objects.only('id', 'name').order_by('name')
         # Добавляем список городов для фильтра (только для администраторов)
         if request.user.is_superuser:
             extra_context['cities'] = City.objects.filter(active=True).order_by('name')
@@ -2936,12 +3189,17 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         from django.contrib.admin.views.main import ChangeList
 
         class CustomChangeList(ChangeList):
+            def get_queryset(self, request, exclude_parameters=None):
+                # Текущие батареи — подзапросами StringAgg/Count только для строк страницы
+                return super().get_queryset(request, exclude_parameters).annotate(
+                    **RentalBatteryAssignment.current_batteries()
+                )
+
             def get_results(self, request):
                 super().get_results(request)
-                # Приглушить строки с статусом modified или closed
+                # Приглушить строки modified/closed: класс строки читает change_list_results.html
                 for result in self.result_list:
-                    if hasattr(result, 'status') and result.status in [result.Status.MODIFIED, result.Status.CLOSED]:
-                        result.row_class = 'opacity-80'
+                    result.row_class = 'opacity-80' if result.status in (Rental.Status.MODIFIED, Rental.Status.CLOSED) else ''
 
         return CustomChangeList
 
@@ -2964,19 +3222,11 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         except: pass
         # #endregion
         qs = super().get_queryset(request)
-        # Предзагрузить связанные объекты, чтобы избежать N+1
-        from django.db.models import Count
-        qs = qs.select_related('client', 'city').prefetch_related('assignments', 'assignments__battery')
-        qs = qs.annotate(assignments_count=Count('assignments'))
-        # Добавить row_class для приглушения строк
-        for obj in qs:
-            if obj.status in [obj.Status.MODIFIED, obj.Status.CLOSED]:
-                obj.row_class = 'opacity-80'
-            else:
-                obj.row_class = ''
+        # Queryset остаётся ленивым: строки вычисляет только страница списка
+        # (батареи — в CustomChangeList.get_queryset, приглушение строк — в get_results)
+        qs = qs.select_related('client', 'city')
         # #region agent log
         try:
-            count = qs.count()
             elapsed = (time_module.time() - start_time) * 1000
             with open(str(get_debug_log_path()), 'a', encoding='utf-8') as f:
                 f.write(json.dumps({
@@ -2985,7 +3235,7 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                     "hypothesisId": "F",
                     "location": "admin.py:RentalAdmin.get_queryset:exit",
                     "message": "RentalAdmin.get_queryset completed",
-                    "data": {"count": count, "elapsed_ms": elapsed},
+                    "data": {"elapsed_ms": elapsed},
                     "timestamp": time_module.time() * 1000
                 }, ensure_ascii=False) + '\n')
         except: pass
@@ -3073,6 +3323,10 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                         }, ensure_ascii=False) + '\n')
                 except: pass
                 # #endregion
+
+        # Поле «Договор» в форме платежа: по умолчанию только активные последние версии
+        if autocomplete_source(request) == ('payment', 'rental') and request.GET.get('show_all_rentals') != '1':
+            queryset = queryset.filter(status=Rental.Status.ACTIVE, children__isnull=True)
         
         return queryset, use_distinct
 
@@ -3103,6 +3357,10 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         return inlines
     
     def batteries_count_now(self, obj):
+        if hasattr(obj, 'current_batteries_count'):
+            codes = obj.current_battery_codes
+            obj._batteries_list = codes.split(', ') if codes else []
+            return obj.current_batteries_count
         tz = timezone.get_current_timezone()
         now = timezone.now()
         count = 0
@@ -3134,36 +3392,11 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                 }, ensure_ascii=False) + '\n')
         except: pass
         # #endregion
-        tz = timezone.get_current_timezone()
-        now = timezone.now()
-        codes = []
-        # #region agent log
-        try:
-            assignments_before = getattr(obj, '_prefetched_objects_cache', {}).get('assignments', None)
-            has_prefetch = assignments_before is not None
-            with open(str(get_debug_log_path()), 'a', encoding='utf-8') as f:
-                f.write(json.dumps({
-                    "sessionId": "debug-session",
-                    "runId": "run1",
-                    "hypothesisId": "B",
-                    "location": "admin.py:RentalAdmin.assigned_batteries_short:before_query",
-                    "message": "Before assignments query",
-                    "data": {"has_prefetch": has_prefetch, "prefetch_count": len(assignments_before) if assignments_before else None},
-                    "timestamp": time_module.time() * 1000
-                }, ensure_ascii=False) + '\n')
-        except: pass
-        # #endregion
-        # Используем prefetch_related если доступен (Django автоматически использует его)
-        # Просто обращаемся к assignments.all() - Django использует prefetch если он был установлен
-        assignments = obj.assignments.all()
-        
-        for a in assignments:
-            a_start = timezone.localtime(a.start_at, tz)
-            a_end = timezone.localtime(a.end_at, tz) if a.end_at else None
-            if a_start <= now and (a_end is None or a_end > now):
-                # Батарея должна быть загружена через prefetch_related('assignments__battery')
-                if hasattr(a, 'battery') and a.battery:
-                    codes.append(a.battery.short_code)
+        # Коды аннотированы для страницы в CustomChangeList.get_queryset
+        has_prefetch = hasattr(obj, 'current_battery_codes')
+        if not has_prefetch:
+            obj = Rental.objects.annotate(**RentalBatteryAssignment.current_batteries()).get(pk=obj.pk)
+        codes = obj.current_battery_codes.split(', ') if obj.current_battery_codes else []
         # #region agent log
         try:
             elapsed = (time_module.time() - start_time) * 1000
@@ -3450,121 +3683,78 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
             except Exception:
                 new_rate = None
         for rental in queryset:
-            root = rental.root or rental
-            now = new_start or timezone.now()
-            # Закрываем старую версию
-            if not rental.end_at or rental.end_at > now:
-                rental.end_at = now
-            rental.status = Rental.Status.MODIFIED
-            rental.save()
-            if free_days > 0:
-                # Создаем версию с бесплатными днями
-                free_start = now
-                free_end = free_start + timezone.timedelta(days=free_days)
-                try:
-                    new_version_num = root.group_versions().count() + 1
-                except Exception:
-                    new_version_num = rental.version + 1
-                free_version = Rental(
-                    client=rental.client,
-                    start_at=free_start,
-                    end_at=free_end,
-                    weekly_rate=Decimal(0),
-                    deposit_amount=rental.deposit_amount,
-                    status=Rental.Status.ACTIVE,
-                    battery_type=rental.battery_type,
-                    parent=rental,
-                    root=root,
-                    version=new_version_num,
-                    contract_code=root.contract_code or rental.contract_code,
-                )
-                free_version.created_by = request.user
-                free_version.updated_by = request.user
-                free_version.save()
-                # Создаем следующую версию после бесплатных дней
-                try:
-                    new_version_num = root.group_versions().count() + 1
-                except Exception:
-                    new_version_num = free_version.version + 1
-                next_start = free_end
-                new_rental = Rental(
-                    client=rental.client,
-                    start_at=next_start,
-                    weekly_rate=new_rate if new_rate is not None else rental.weekly_rate,
-                    deposit_amount=rental.deposit_amount,
-                    status=Rental.Status.ACTIVE,
-                    battery_type=rental.battery_type,
-                    parent=free_version,
-                    root=root,
-                    version=new_version_num,
-                    contract_code=root.contract_code or rental.contract_code,
-                )
-                new_rental.created_by = request.user
-                new_rental.updated_by = request.user
-                new_rental.save()
-                # Переносим активные назначения батарей на новую версию, закрыв их в старой
-                tz = timezone.get_current_timezone()
-                for a in rental.assignments.all():
-                    a_start = timezone.localtime(a.start_at, tz)
-                    a_end = timezone.localtime(a.end_at, tz) if a.end_at else None
-                    if a_end is None or a_end > now:
-                        # закрываем в старой версии
-                        if a_end is None or a_end > now:
-                            a.end_at = now
-                            a.updated_by = request.user
-                            a.save(update_fields=["end_at", "updated_by"])
-                        # создаем продолжение в новой версии, начиная сейчас
-                        RentalBatteryAssignment.objects.create(
-                            rental=new_rental,
-                            battery=a.battery,
-                            start_at=now,
-                            end_at=None,
-                            created_by=request.user,
-                            updated_by=request.user,
-                        )
-                count += 2
-            else:
-                # Создаем новую версию без бесплатных дней
-                try:
-                    new_version_num = root.group_versions().count() + 1
-                except Exception:
-                    new_version_num = rental.version + 1
-                new_rental = Rental(
-                    client=rental.client,
-                    start_at=now,
-                    weekly_rate=new_rate if new_rate is not None else rental.weekly_rate,
-                    deposit_amount=rental.deposit_amount,
-                    status=Rental.Status.ACTIVE,
-                    battery_type=rental.battery_type,
-                    parent=rental,
-                    root=root,
-                    version=new_version_num,
-                    contract_code=root.contract_code or rental.contract_code,
-                )
-                new_rental.created_by = request.user
-                new_rental.updated_by = request.user
-                new_rental.save()
-                # Переносим активные назначения батарей на новую версию, закрыв их в старой
-                tz = timezone.get_current_timezone()
-                for a in rental.assignments.all():
-                    a_start = timezone.localtime(a.start_at, tz)
-                    a_end = timezone.localtime(a.end_at, tz) if a.end_at else None
-                    if a_end is None or a_end > now:
-                        # закрываем в старой версии
-                        if a_end is None or a_end > now:
-                            a.end_at = now
-                            a.updated_by = request.user
-                            a.save(update_fields=["end_at", "updated_by"])
-                        # создаем продолжение в новой версии, начиная сейчас
-                        RentalBatteryAssignment.objects.create(
-                            rental=new_rental,
-                            battery=a.battery,
-                            start_at=now,
-                            end_at=None,
-                            created_by=request.user,
-                            updated_by=request.user,
-                        )
-                count += 1
+            # Версии и перенос батарей — атомарно; эффекты назначений пакетом в той же транзакции
+            with transaction.atomic(), batch_assignment_effects(request.user):
+                root = rental.root or rental
+                now = new_start or timezone.now()
+                # Закрываем старую версию
+                if not rental.end_at or rental.end_at > now:
+                    rental.end_at = now
+                rental.status = Rental.Status.MODIFIED
+                rental.save()
+                if free_days > 0:
+                    # Создаем версию с бесплатными днями
+                    free_start = now
+                    free_end = free_start + timezone.timedelta(days=free_days)
+                    new_version_num = Rental.next_version_number(root.pk)
+                    free_version = Rental(
+                        client=rental.client,
+                        start_at=free_start,
+                        end_at=free_end,
+                        weekly_rate=Decimal(0),
+                        deposit_amount=rental.deposit_amount,
+                        status=Rental.Status.ACTIVE,
+                        battery_type=rental.battery_type,
+                        parent=rental,
+                        root=root,
+                        version=new_version_num,
+                        contract_code=root.contract_code or rental.contract_code,
+                    )
+                    free_version.created_by = request.user
+                    free_version.updated_by = request.user
+                    free_version.save()
+                    # Создаем следующую версию после бесплатных дней
+                    new_version_num = Rental.next_version_number(root.pk)
+                    next_start = free_end
+                    new_rental = Rental(
+                        client=rental.client,
+                        start_at=next_start,
+                        weekly_rate=new_rate if new_rate is not None else rental.weekly_rate,
+                        deposit_amount=rental.deposit_amount,
+                        status=Rental.Status.ACTIVE,
+                        battery_type=rental.battery_type,
+                        parent=free_version,
+                        root=root,
+                        version=new_version_num,
+                        contract_code=root.contract_code or rental.contract_code,
+                    )
+                    new_rental.created_by = request.user
+                    new_rental.updated_by = request.user
+                    new_rental.save()
+                    # Переносим активные назначения батарей на новую версию, закрыв их в старой
+                    self._carry_over_batteries(rental, new_rental, request.user, now)
+                    count += 2
+                else:
+                    # Создаем новую версию без бесплатных дней
+                    new_version_num = Rental.next_version_number(root.pk)
+                    new_rental = Rental(
+                        client=rental.client,
+                        start_at=now,
+                        weekly_rate=new_rate if new_rate is not None else rental.weekly_rate,
+                        deposit_amount=rental.deposit_amount,
+                        status=Rental.Status.ACTIVE,
+                        battery_type=rental.battery_type,
+                        parent=rental,
+                        root=root,
+                        version=new_version_num,
+                        contract_code=root.contract_code or rental.contract_code,
+                    )
+                    new_rental.created_by = request.user
+                    new_rental.updated_by = request.user
+                    new_rental.save()
+                    # Переносим активные назначения батарей на новую версию, закрыв их в старой
+                    self._carry_over_batteries(rental, new_rental, request.user, now)
+                    count += 1
         self.message_user(request, f"Создано новых версий: {count}; активные батареи перенесены")
     make_new_version.short_description = "Создать новую версию (начало с даты и времени, с переносом батарей)"
 
@@ -3576,8 +3766,6 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         Uses select_for_update on root to prevent race conditions on version number.
         """
         root = rental.root or rental
-        # Lock root row to serialize version creation
-        Rental.objects.select_for_update().filter(pk=root.pk).first()
 
         # Close current version
         if not rental.end_at or rental.end_at > cut_date:
@@ -3586,8 +3774,8 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         rental.updated_by = user
         rental.save(update_fields=["end_at", "status", "updated_by"])
 
-        # New version
-        new_version_num = root.group_versions().count() + 1
+        # New version: number from root's latest_version under a row lock on root
+        new_version_num = Rental.next_version_number(root.pk)
         new_rental = Rental(
             client=rental.client,
             city=rental.city,
@@ -3608,20 +3796,12 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         return new_rental
 
     def _carry_over_batteries(self, rental, new_rental, user, cut_date):
-        """Close active assignments in old version and create continuations in new version."""
-        for a in rental.assignments.select_related("battery").all():
-            if a.end_at is None or a.end_at > cut_date:
-                a.end_at = cut_date
-                a.updated_by = user
-                a.save(update_fields=["end_at", "updated_by"])
-                RentalBatteryAssignment.objects.create(
-                    rental=new_rental,
-                    battery=a.battery,
-                    start_at=cut_date,
-                    end_at=None,
-                    created_by=user,
-                    updated_by=user,
-                )
+        """Close active assignments in old version and create continuations in new version.
+
+        Bulk writes via tariffs.carry_over_assignments: one UPDATE for closed assignments,
+        one INSERT for continuations; side effects are applied once via assignment_effects.
+        """
+        carry_over_assignments([(rental.pk, new_rental)], user, cut_date)
 
     # Пользовательский admin-view для изменения состава батарей
     def get_urls(self):
@@ -3662,11 +3842,16 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                 self.admin_site.admin_view(self.financial_data_view),
                 name='rental_rental_financial_data',
             ),
+            path(
+                '<int:pk>/snapshot/',
+                self.admin_site.admin_view(self.snapshot_view),
+                name='rental_rental_snapshot',
+            ),
         ]
         return custom + urls
 
     def available_batteries_view(self, request, pk):
-        """GET: список батарей города договора со статусом AVAILABLE, не занятых в других активных договорах."""
+        """GET: список батарей города договора со статусом AVAILABLE, не занятых и не забронированных в других активных договорах."""
         if request.method != 'GET':
             return JsonResponse({'success': False, 'error': 'Method not allowed'}, status=405)
         try:
@@ -3676,24 +3861,15 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
             city_id = rental.city_id
             if not city_id:
                 return JsonResponse({'batteries': []})
-            now = timezone.now()
-            # Батареи в активных назначениях других активных договоров — исключаем
-            busy_battery_ids = set(
-                RentalBatteryAssignment.objects.filter(
-                    end_at__isnull=True,
-                    rental__status=Rental.Status.ACTIVE,
-                ).exclude(rental_id=pk).values_list('battery_id', flat=True)
-            )
-            busy_battery_ids |= set(
-                RentalBatteryAssignment.objects.filter(
-                    end_at__gt=now,
-                    rental__status=Rental.Status.ACTIVE,
-                ).exclude(rental_id=pk).values_list('battery_id', flat=True)
-            )
+            # Батареи, занятые другими активными договорами сейчас или забронированные на будущее:
+            # указатель current_assignment будущие назначения не видит, поэтому — EXISTS
+            busy = RentalBatteryAssignment.objects.filter(
+                battery_id=OuterRef('pk'), rental__status=Rental.Status.ACTIVE,
+            ).exclude(rental_id=pk).filter(Q(end_at__isnull=True) | Q(end_at__gt=timezone.now()))
             qs = Battery.objects.filter(
                 city_id=city_id,
                 status=Battery.Status.AVAILABLE,
-            ).exclude(id__in=busy_battery_ids).order_by('short_code')
+            ).exclude(Exists(busy)).order_by('short_code')
             batteries = [{'id': b.id, 'short_code': b.short_code} for b in qs.only('id', 'short_code')]
             return JsonResponse({'batteries': batteries})
         except Rental.DoesNotExist:
@@ -3702,7 +3878,7 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
     def change_batteries_view(self, request, pk):
         """GET: JSON с назначениями батарей договора. POST: JSON с actions (end, add, replace)."""
         try:
-            rental = Rental.objects.select_related('city').get(pk=pk)
+            rental = Rental.objects.select_related('city', 'root__active_version').get(pk=pk)
         except Rental.DoesNotExist:
             return JsonResponse({'success': False, 'error': 'Договор не найден'}, status=404)
         if not self.has_change_permission(request, rental):
@@ -3713,12 +3889,11 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
 
         if request.method == 'GET':
             # #11: If this version is not active, find the latest active version in group
+            # (active_version хранится на корне группы)
             target_rental = rental
-            if rental.status != Rental.Status.ACTIVE:
-                root = rental.root or rental
-                latest_active = Rental.objects.filter(root=root, status=Rental.Status.ACTIVE).order_by('-version').first()
-                if latest_active:
-                    target_rental = latest_active
+            root = rental.root or rental
+            if rental.status != Rental.Status.ACTIVE and root.active_version_id:
+                target_rental = root.active_version
 
             assignments = target_rental.assignments.select_related('battery').order_by('start_at', 'id')
             tz = timezone.get_current_timezone()
@@ -3735,9 +3910,8 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                     'end_reason': (a.end_reason or '')[:255],
                     'is_active': is_active,
                 })
-            # Find earliest start_at across all versions in the group (for date validation on frontend)
-            root_rental = target_rental.root or target_rental
-            group_start_at = root_rental.start_at.isoformat()
+            # Earliest start_at across all versions in the group (for date validation on frontend)
+            group_start_at = (root.group_start_at or root.start_at).isoformat()
 
             return JsonResponse({
                 'rental': {
@@ -3782,7 +3956,8 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
             return dt.replace(hour=0, minute=0, second=0, microsecond=0)
 
         try:
-            with transaction.atomic():
+            # Эффекты назначений (логи, статусы батарей) — один пакет в этой же транзакции
+            with transaction.atomic(), batch_assignment_effects(request.user):
                 end_actions = {}   # assignment_id -> (end_at_exclusive, reason)
                 replace_actions = {}  # assignment_id -> (new_battery_id, replace_date_dt, reason)
                 add_actions = []  # (battery_id, start_date_dt)
@@ -3795,9 +3970,35 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                 tomorrow_start = today_start + timedelta(days=1)
                 rental_start_date = timezone.localtime(rental.start_at, tz_val).date()  # current version start
 
-                # Preload assignments for validation
-                assignments_by_id = {
-                    a.id: a for a in rental.assignments.select_related("battery").all()
+                # Снимок для проверки всего списка действий, под блокировками в порядке
+                # корень -> версия -> назначения -> батареи (как tariffs._apply_chunk):
+                # повторная отправка формы или параллельная смена тарифа ждут этой транзакции
+                root_id = rental.root_id or rental.pk
+                locked = dict(
+                    Rental.objects.select_for_update(of=('self',))
+                    .filter(pk__in={root_id, rental.pk}).order_by('pk').values_list('pk', 'status')
+                )
+                if locked.get(rental.pk) != Rental.Status.ACTIVE:
+                    raise ValidationError("Изменение батарей доступно только для активных договоров")
+                version_assignments = list(
+                    RentalBatteryAssignment.objects.select_for_update(of=('self',))
+                    .select_related("battery").filter(rental=rental).order_by('start_at', 'id')
+                )
+                assignments_by_id = {a.id: a for a in version_assignments}
+
+                def parse_battery_id(value):
+                    try:
+                        return int(value)
+                    except (TypeError, ValueError):
+                        return None
+
+                # Все батареи замен и добавлений — одним запросом с блокировкой
+                candidate_ids = {
+                    parse_battery_id(act.get("new_battery_id") if act.get("type") == "replace" else act.get("battery_id"))
+                    for act in actions if act.get("type") in ("replace", "add")
+                } - {None}
+                batteries_by_id = {
+                    b.pk: b for b in Battery.objects.select_for_update().filter(pk__in=candidate_ids).order_by('pk')
                 }
 
                 for act in actions:
@@ -3849,21 +4050,14 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                                     f"{assignment.battery.short_code} ({a_start_date.strftime('%d.%m.%Y')})"
                                 )
                         reason = (act.get("reason") or "Замена батареи")[:255]
-                        new_battery = Battery.objects.filter(pk=new_battery_id).first()
+                        new_battery_id = parse_battery_id(new_battery_id)
+                        new_battery = batteries_by_id.get(new_battery_id)
                         if not new_battery:
                             raise ValidationError("Новая батарея не найдена")
                         if new_battery.city_id != rental.city_id:
                             raise ValidationError(f"Батарея {new_battery.short_code} из другого города")
                         if new_battery.status != Battery.Status.AVAILABLE:
                             raise ValidationError(f"Батарея {new_battery.short_code} недоступна (статус не AVAILABLE)")
-                        overlap = RentalBatteryAssignment.objects.filter(
-                            battery_id=new_battery_id,
-                            rental__status=Rental.Status.ACTIVE,
-                        ).filter(
-                            Q(end_at__isnull=True) | Q(end_at__gt=replace_date),
-                        ).filter(start_at__lte=replace_date).exclude(rental=rental).exists()
-                        if overlap:
-                            raise ValidationError(f"Батарея {new_battery.short_code} уже занята в другом договоре")
                         replace_actions[aid] = (new_battery_id, replace_date, reason)
                         all_user_dates.append(replace_date)
                     elif act.get("type") == "add":
@@ -3878,21 +4072,14 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                             raise ValidationError(f"Дата добавления не может быть раньше начала договора ({rental_start_date.strftime('%d.%m.%Y')})")
                         if start_at > tomorrow_start:
                             raise ValidationError("Дата добавления не может быть позже завтрашнего дня")
-                        bat = Battery.objects.filter(pk=battery_id).first()
+                        battery_id = parse_battery_id(battery_id)
+                        bat = batteries_by_id.get(battery_id)
                         if not bat:
                             raise ValidationError("Батарея не найдена")
                         if bat.city_id != rental.city_id:
                             raise ValidationError(f"Батарея {bat.short_code} из другого города")
                         if bat.status != Battery.Status.AVAILABLE:
                             raise ValidationError(f"Батарея {bat.short_code} недоступна (статус не AVAILABLE)")
-                        overlap = RentalBatteryAssignment.objects.filter(
-                            battery_id=battery_id,
-                            rental__status=Rental.Status.ACTIVE,
-                        ).filter(
-                            Q(end_at__isnull=True) | Q(end_at__gt=start_at),
-                        ).filter(start_at__lte=start_at).exclude(rental=rental).exists()
-                        if overlap:
-                            raise ValidationError(f"Батарея {bat.short_code} уже занята в другом договоре")
                         add_actions.append((battery_id, start_at))
                         all_user_dates.append(start_at)
 
@@ -3906,93 +4093,120 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
 
                 cut_date_dt = min(all_user_dates)
 
-                # Активные на cut_date назначения до закрытия (для переноса в новую версию)
-                active_at_cut = list(
-                    rental.assignments.select_related("battery").filter(
-                        start_at__lte=cut_date_dt,
-                    ).filter(Q(end_at__isnull=True) | Q(end_at__gt=cut_date_dt))
-                )
+                # Открытые после cut_date назначения версии — из снимка. Начавшиеся раньше
+                # cut_date закрываются на cut_date и продолжаются в новой версии; начинающиеся
+                # не раньше cut_date (например, добавленные на завтра) переносятся в новую
+                # версию целиком — закрытие на cut_date дало бы start_at > end_at (DataError)
+                open_after_cut = [a for a in version_assignments if a.end_at is None or a.end_at > cut_date_dt]
+                active_at_cut = [a for a in open_after_cut if a.start_at < cut_date_dt]
+                moved = [a for a in open_after_cut if a.start_at >= cut_date_dt]
 
                 # Создаём новую версию через хелпер (с select_for_update на root)
                 new_rental = self._create_next_version(rental, request.user, cut_date_dt)
 
-                # В старой версии закрываем все назначения на cut_date_dt (00:00)
-                for a in rental.assignments.filter(Q(end_at__isnull=True) | Q(end_at__gt=cut_date_dt)):
+                # В старой версии закрываем назначения на cut_date_dt (00:00), будущие переносим —
+                # один bulk UPDATE. Статусы батарей (освобождение заменённых/завершённых, занятие
+                # новых) выводит assignment_effects по итоговым назначениям.
+                now = timezone.now()
+                closed = active_at_cut
+                for a in closed:
                     a.end_at = cut_date_dt
                     a.updated_by = request.user
+                    a.updated_at = now
                     if a.id in end_actions:
                         a.end_reason = end_actions[a.id][1]
                     elif a.id in replace_actions:
                         a.end_reason = replace_actions[a.id][2]
                     else:
                         a.end_reason = ""
-                    a.save(update_fields=["end_at", "end_reason", "updated_by"])
-                    # Статус AVAILABLE: для replace — всегда (старая батарея освобождается);
-                    # для end — только если не создаём remainder (иначе батарея ещё в новой версии до end_at_db)
-                    if a.id in replace_actions:
-                        a.battery.status = Battery.Status.AVAILABLE
-                        a.battery.save(update_fields=["status"])
-                    elif a.id in end_actions:
-                        end_at_db, _ = end_actions[a.id]
-                        if end_at_db <= cut_date_dt:
-                            a.battery.status = Battery.Status.AVAILABLE
-                            a.battery.save(update_fields=["status"])
 
-                now = timezone.now()
                 # Переносим в новую версию: продолжения (не end, не replace) с cut_date_dt; replace — новая батарея с replace_date (00:00)
+                created = []
                 for a in active_at_cut:
                     if a.id in end_actions:
                         end_at_db, reason = end_actions[a.id]
                         if end_at_db > cut_date_dt:
                             # End date extends beyond version boundary (mixed case) — carry remainder to new version
-                            RentalBatteryAssignment.objects.create(
+                            created.append(RentalBatteryAssignment(
                                 rental=new_rental,
-                                battery=a.battery,
+                                battery_id=a.battery_id,
                                 start_at=cut_date_dt,
                                 end_at=end_at_db,
                                 end_reason=reason,
                                 created_by=request.user,
                                 updated_by=request.user,
-                            )
-                            # Если remainder уже в прошлом — батарея свободна
-                            if end_at_db <= now:
-                                Battery.objects.filter(pk=a.battery_id).update(status=Battery.Status.AVAILABLE)
+                            ))
                         continue
                     if a.id in replace_actions:
                         new_bid, rep_dt, _ = replace_actions[a.id]
-                        RentalBatteryAssignment.objects.create(
+                        created.append(RentalBatteryAssignment(
                             rental=new_rental,
                             battery_id=new_bid,
                             start_at=rep_dt,
                             end_at=None,
                             created_by=request.user,
                             updated_by=request.user,
-                        )
-                        Battery.objects.filter(pk=new_bid).update(status=Battery.Status.RENTED)
+                        ))
                         continue
-                    RentalBatteryAssignment.objects.create(
+                    created.append(RentalBatteryAssignment(
                         rental=new_rental,
-                        battery=a.battery,
+                        battery_id=a.battery_id,
                         start_at=cut_date_dt,
                         end_at=None,
                         created_by=request.user,
                         updated_by=request.user,
+                    ))
+
+                # Будущие назначения — в новую версию со своим началом; end/replace применяются к ним самим
+                for a in moved:
+                    a.rental = new_rental
+                    a.updated_by = request.user
+                    a.updated_at = now
+                    if a.id in end_actions:
+                        a.end_at, a.end_reason = end_actions[a.id]
+                    elif a.id in replace_actions:
+                        new_bid, rep_dt, reason = replace_actions[a.id]
+                        # Замена в день подключения — пустой интервал [start_at, start_at)
+                        a.end_at = max(rep_dt, a.start_at)
+                        a.end_reason = reason
+                        created.append(RentalBatteryAssignment(
+                            rental=new_rental,
+                            battery_id=new_bid,
+                            start_at=rep_dt,
+                            end_at=None,
+                            created_by=request.user,
+                            updated_by=request.user,
+                        ))
+
+                if closed or moved:
+                    bulk_update_with_history(
+                        closed + moved, RentalBatteryAssignment,
+                        ["rental", "end_at", "end_reason", "updated_by", "updated_at"],
+                        default_user=request.user,
                     )
 
                 for battery_id, start_dt in add_actions:
-                    RentalBatteryAssignment.objects.create(
+                    created.append(RentalBatteryAssignment(
                         rental=new_rental,
                         battery_id=battery_id,
                         start_at=start_dt,
                         end_at=None,
                         created_by=request.user,
                         updated_by=request.user,
-                    )
-                    Battery.objects.filter(pk=battery_id).update(status=Battery.Status.RENTED)
-
-                active_count = new_rental.assignments.filter(
-                    start_at__lte=now,
-                ).filter(Q(end_at__isnull=True) | Q(end_at__gt=now)).count()
+                    ))
+                if created:
+                    # Пересечения с другими назначениями батареи отсекает excl_assign_battery_overlap
+                    try:
+                        with transaction.atomic():
+                            bulk_create_with_history(created, RentalBatteryAssignment, default_user=request.user)
+                    except IntegrityError as e:
+                        raise RentalBatteryAssignment.overlap_error(e) or e
+                assignments_saved(closed + moved + created)
+
+                # Назначения новой версии — перенесённые и созданные
+                active_count = sum(
+                    1 for a in moved + created if a.start_at <= now and (a.end_at is None or a.end_at > now)
+                )
                 if active_count < 1:
                     raise ValidationError("Должна остаться минимум одна активная батарея на текущий момент")
 
@@ -4021,7 +4235,10 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
             close_date_str = request.POST.get('close_date')
             tz = timezone.get_current_timezone()
             if close_date_str:
-                d = date_type.fromisoformat(close_date_str[:10])
+                try:
+                    d = date_type.fromisoformat(close_date_str[:10])
+                except ValueError:
+                    return JsonResponse({'success': False, 'error': 'Неверная дата закрытия'}, status=400)
                 close_date = timezone.make_aware(
                     datetime.combine(d + timedelta(days=1), time(0, 0)), tz
                 )
@@ -4031,28 +4248,13 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                     datetime.combine(now_local.date() + timedelta(days=1), time(0, 0)), tz
                 )
             
-            # Закрываем договор
-            root = rental.root or rental
-            for v in Rental.objects.filter(root=root, status=Rental.Status.ACTIVE):
-                if not v.end_at or v.end_at > close_date:
-                    v.end_at = close_date
-                v.status = Rental.Status.CLOSED
-                v.updated_by = request.user
-                v.save()
-                
-                # Закрываем все активные назначения батарей и освобождаем батареи
-                for assignment in v.assignments.select_related("battery").filter(end_at__isnull=True):
-                    assignment.end_at = close_date
-                    assignment.updated_by = request.user
-                    assignment.save()
-                    assignment.battery.status = Battery.Status.AVAILABLE
-                    assignment.battery.save(update_fields=["status"])
-                for assignment in v.assignments.select_related("battery").filter(end_at__gt=close_date):
-                    assignment.end_at = close_date
-                    assignment.updated_by = request.user
-                    assignment.save()
-                    assignment.battery.status = Battery.Status.AVAILABLE
-                    assignment.battery.save(update_fields=["status"])
+            # Закрываем группу: версии и назначения — set-based (closing.close_groups)
+            report = closing.close_groups([rental.root_id or rental.pk], close_date, request.user)
+            if report['errors']:
+                error = report['errors'][0]
+                return JsonResponse({'success': False, 'error': error['error']}, status=400 if error['validation'] else 500)
+            if not report['groups']:
+                return JsonResponse({'success': False, 'error': 'Нет активных версий договора для закрытия'}, status=400)
             
             return JsonResponse({'success': True, 'message': 'Договор закрыт'})
             
@@ -4229,6 +4431,31 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         except Exception as e:
             return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
+    def snapshot_view(self, request, pk):
+        """
+        GET: снимок договора одним ответом (rental/snapshot.py) для карточки договора
+        и формы платежа. ETag — snapshot.snapshot_etag (без расчёта снимка);
+        If-None-Match с тем же ETag даёт 304 без обращения к начислениям и платежам.
+        """
+        if request.method != 'GET':
+            return JsonResponse({'success': False, 'error': 'Method not allowed'}, status=405)
+        now = timezone.now()
+        rental = snapshot.load_rental(pk, now)
+        if rental is None:
+            return JsonResponse({'success': False, 'error': 'Договор не найден'}, status=404)
+        if not self.has_view_permission(request, rental):
+            return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
+
+        # ETag — из счётчиков и updated_at группы (один запрос); снимок строится только при промахе
+        etag = quote_etag(snapshot.snapshot_etag(rental, now))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            data = snapshot.rental_snapshot(rental, now)
+            response = HttpResponse(json.dumps({'success': True, **data}, ensure_ascii=False), content_type='application/json')
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
     def change_view(self, request, object_id, form_url='', extra_context=None):
         """Добавляем дополнительный контекст для шаблона change_form"""
         extra_context = extra_context or {}
@@ -4325,16 +4552,12 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
                 ).select_related('rental').order_by('-date')
                 extra_context['all_payments'] = all_payments
                 
-                # Получаем номера батарей для текущей версии (активные сейчас)
+                # Номера батарей текущей версии (активные сейчас) — одним агрегатом в SQL
                 now = timezone.now()
-                current_batteries = []
-                for a in rental.assignments.select_related('battery').all():
-                    a_start = a.start_at
-                    a_end = a.end_at
-                    # Батарея активна если начало <= сейчас и (нет окончания или окончание > сейчас)
-                    if a_start <= now and (a_end is None or a_end > now):
-                        current_batteries.append(a.battery.short_code)
-                extra_context['current_battery_codes'] = ', '.join(current_batteries) if current_batteries else '—'
+                current_codes = Rental.objects.filter(pk=rental.pk).annotate(
+                    **RentalBatteryAssignment.current_batteries(now=now)
+                ).values_list('current_battery_codes', flat=True).first()
+                extra_context['current_battery_codes'] = current_codes or '—'
                 
                 # Вычисляем длительность текущей версии в днях
                 start = rental.start_at
@@ -4347,70 +4570,25 @@ class RentalAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleH
         return super().change_view(request, object_id, form_url, extra_context)
 
     def close_with_deposit(self, request, queryset):
-        closed = 0
         # Опционально: принять оплату (аренда) сразу из формы действия
         amt = request.POST.get("payment_amount")
-        mth = request.POST.get("payment_method")
-        note = request.POST.get("payment_note")
-        for rental in queryset:
-            root = rental.root or rental
-            now = timezone.now()
-            for v in Rental.objects.filter(root=root, status=Rental.Status.ACTIVE):
-                if not v.end_at or v.end_at > now:
-                    v.end_at = now
-                v.status = Rental.Status.CLOSED
-                v.save()
-            balance = root.group_balance(until=now)
-            deposit_left = root.group_deposit_total()
-            applied = Decimal(0)
-            if balance > 0 and deposit_left > 0:
-                applied = min(balance, deposit_left)
-                Payment.objects.create(
-                    rental=root,
-                    amount=-applied,
-                    date=timezone.localdate(),
-                    type=Payment.PaymentType.ADJUSTMENT,
-                    method=Payment.Method.OTHER,
-                    note="Зачёт депозита при закрытии",
-                    created_by=request.user,
-                    updated_by=request.user,
-                )
-                balance -= applied
-                deposit_left -= applied
-            if deposit_left > 0:
-                Payment.objects.create(
-                    rental=root,
-                    amount=deposit_left,
-                    date=timezone.localdate(),
-                    type=Payment.PaymentType.RETURN_DEPOSIT,
-                    method=Payment.Method.OTHER,
-                    note="Возврат остатка депозита",
-                    created_by=request.user,
-                    updated_by=request.user,
-                )
-            if amt:
-                try:
-                    amt_dec = Decimal(amt)
-                    if amt_dec != 0:
-                        Payment.objects.create(
-                            rental=root,
-                            amount=amt_dec,
-                            date=timezone.localdate(),
-                            type=Payment.PaymentType.RENT,
-                            method=mth or Payment.Method.OTHER,
-                            note=note or "",
-                            created_by=request.user,
-                            updated_by=request.user,
-                        )
-                except Exception:
-                    pass
-            closed += 1
-        self.message_user(request, f"Закрыто договоров: {closed}")
+        rent_payment = None
+        if amt:
+            try:
+                rent_payment = (Decimal(amt), request.POST.get("payment_method"), request.POST.get("payment_note"))
+            except Exception:
+                pass
+        root_ids = {root_id or pk for pk, root_id in queryset.values_list('pk', 'root_id')}
+        # Все группы — пачками, с зачётом и возвратом депозита (closing.close_groups)
+        report = closing.close_groups(root_ids, timezone.now(), request.user, settle=True, rent_payment=rent_payment)
+        self.message_user(request, f"Закрыто договоров: {report['groups']}")
+        for error in report['errors']:
+            self.message_user(request, f"Договор #{error['root']} не закрыт: {error['error']}", level=messages.ERROR)
     close_with_deposit.short_description = "Закрыть договор (с зачётом депозита)"
 
 
 @admin.register(Payment)
-class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
+class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, HistoryAdmin):
     class RentalFilter(AutocompleteFilter):
         title = 'Договор'
         field_name = 'rental'
@@ -4419,7 +4597,7 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
     list_filter = (RentalFilter, "type", "method", "city")
     search_fields = ("rental__id", "note", "rental__client__name", "created_by__username")
     readonly_fields = ("updated_by",)
-    autocomplete_fields = ["city"]
+    autocomplete_fields = ["city", "rental"]
     date_hierarchy = 'date'
     list_per_page = 50
     change_form_template = 'admin/rental/payment/change_form.html'
@@ -5046,12 +5224,12 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
         try:
             qs = response.context_data['cl'].queryset
             
-            # Агрегированная статистика
-            stats = qs.aggregate(
-                total_amount=Sum('amount'),
-                avg_amount=Avg('amount'),
-                count=Count('id')
-            )
+            # Итоги и разбивка по типам — одним запросом (условная агрегация)
+            aggregates = {'total_amount': Sum('amount'), 'avg_amount': Avg('amount'), 'count': Count('id')}
+            for value in Payment.PaymentType.values:
+                aggregates[f'total_{value}'] = Sum('amount', filter=Q(type=value))
+                aggregates[f'count_{value}'] = Count('id', filter=Q(type=value))
+            stats = qs.order_by().aggregate(**aggregates)
             extra_context['stats'] = {
                 'total_amount': stats['total_amount'] or Decimal('0'),
                 'avg_amount': stats['avg_amount'] or Decimal('0'),
@@ -5059,11 +5237,17 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
             }
             
             # Статистика по типам
-            type_stats = qs.values('type').annotate(
-                total=Sum('amount'),
-                count=Count('id')
-            ).order_by('-total')
-            extra_context['type_stats'] = type_stats
+            type_stats = [
+                {
+                    'type': value,
+                    'type_display': label,
+                    'total': stats[f'total_{value}'] or Decimal('0'),
+                    'count': stats[f'count_{value}'],
+                }
+                for value, label in Payment.PaymentType.choices
+                if stats[f'count_{value}']
+            ]
+            extra_context['type_stats'] = sorted(type_stats, key=lambda row: row['total'], reverse=True)
             
         except (AttributeError, KeyError):
             pass
@@ -5097,6 +5281,9 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
             except Rental.DoesNotExist:
                 extra_context['selected_rental'] = None
         
+        # Контекст ответа уже собран super() — дополняем его до рендера
+        if hasattr(response, 'context_data'):
+            response.context_data.update(extra_context)
         return response
 
     def get_search_results(self, request, queryset, search_term):
@@ -5202,8 +5389,6 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
                         kwargs["queryset"] = all_rentals_qs
                         # #region agent log
                         try:
-                            count = all_rentals_qs.count()
-                            statuses = list(all_rentals_qs.values_list('status', flat=True).distinct())
                             with open(str(get_debug_log_path()), 'a', encoding='utf-8') as f:
                                 f.write(json.dumps({
                                     "sessionId": "debug-session",
@@ -5211,10 +5396,7 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
                                     "hypothesisId": "B",
                                     "location": "admin.py:PaymentAdmin.formfield_for_foreignkey:all_rentals",
                                     "message": "All rentals queryset for moderator",
-                                    "data": {
-                                        "queryset_count": count,
-                                        "statuses": statuses
-                                    },
+                                    "data": {"show_all": True},
                                     "timestamp": __import__('time').time() * 1000
                                 }, ensure_ascii=False) + '\n')
                         except: pass
@@ -5230,7 +5412,6 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
                         kwargs["queryset"] = active_rentals_qs
                         # #region agent log
                         try:
-                            count = active_rentals_qs.count()
                             with open(str(get_debug_log_path()), 'a', encoding='utf-8') as f:
                                 f.write(json.dumps({
                                     "sessionId": "debug-session",
@@ -5239,7 +5420,6 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
                                     "location": "admin.py:PaymentAdmin.formfield_for_foreignkey:active_rentals",
                                     "message": "Active rentals queryset for moderator",
                                     "data": {
-                                        "queryset_count": count,
                                         "city_id": city.id,
                                         "city_name": city.name,
                                         "filter_applied": "status=ACTIVE AND children_count=0"
@@ -5286,6 +5466,11 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
                         Q(status=Rental.Status.ACTIVE) & Q(children_count=0)
                     ).order_by('-id')
                     kwargs["queryset"] = queryset
+
+            # Варианты договоров — autocomplete с поиском на сервере (RentalAdmin.get_search_results,
+            # с фильтром по городу модератора); галочка «показать все» уходит в URL поиска
+            if request.GET.get('show_all_rentals') == '1' or request.POST.get('show_all_rentals') == '1':
+                kwargs["widget"] = ScopedAutocompleteSelect(db_field, self.admin_site, params={'show_all_rentals': '1'})
         
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
     
@@ -5396,7 +5581,7 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
             from .models import Rental
             from .views import calculate_balances_for_rentals
             
-            rental = Rental.objects.select_related('client').get(pk=rental_id)
+            rental = Rental.objects.select_related('client', 'root').get(pk=rental_id)
             
             # Расчет баланса
             tz = timezone.get_current_timezone()
@@ -5423,22 +5608,15 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
             # Получаем номера батарей через assignments (активные на данный момент)
             battery_numbers = []
             if rental.status == Rental.Status.ACTIVE:
-                # Получаем активные батареи (где end_at is NULL или в будущем)
-                active_assignments = rental.assignments.filter(
-                    Q(end_at__isnull=True) | Q(end_at__gt=now_dt)
-                ).select_related('battery')
-                battery_numbers = [a.battery.short_code for a in active_assignments]
-                battery_numbers.sort()
+                # Активные сейчас батареи — одним агрегатом в SQL
+                codes = Rental.objects.filter(pk=rental.pk).annotate(
+                    **RentalBatteryAssignment.current_batteries(now=now_dt)
+                ).values_list('current_battery_codes', flat=True).first()
+                battery_numbers = sorted(codes.split(', ')) if codes else []
             
-            # Получаем дату старта от первой версии (root)
-            if rental.root_id:
-                try:
-                    root_rental = Rental.objects.get(pk=rental.root_id)
-                    start_at = root_rental.start_at
-                except Rental.DoesNotExist:
-                    start_at = rental.start_at
-            else:
-                start_at = rental.start_at
+            # Дата старта группы хранится на корне (group_start_at)
+            root_rental = rental.root or rental
+            start_at = root_rental.group_start_at or root_rental.start_at
             
             return JsonResponse({
                 'success': True,
@@ -5478,7 +5656,7 @@ class PaymentAdmin(ModeratorReadOnlyRelatedMixin, CityFilteredAdminMixin, Simple
 
 
 @admin.register(ExpenseCategory)
-class ExpenseCategoryAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class ExpenseCategoryAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "name")
     
     def has_module_permission(self, request):
@@ -5487,7 +5665,7 @@ class ExpenseCategoryAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
 
 
 @admin.register(Expense)
-class ExpenseAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
+class ExpenseAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, HistoryAdmin):
     city_filter_field = 'paid_by_partner__city'  # Фильтруем через связанное поле
     
     list_display = ("id", "date", "amount", "category", "payment_type", "paid_by_partner")
@@ -5602,7 +5780,7 @@ class ExpenseAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHisto
 
 
 @admin.register(Repair)
-class RepairAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
+class RepairAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, HistoryAdmin):
     city_filter_field = 'battery__city'  # Фильтруем через связанное поле
     
     list_display = ("id", "battery", "start_at", "end_at", "cost")
@@ -5621,7 +5799,7 @@ class RepairAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHistor
 
 
 @admin.register(BatteryStatusLog)
-class BatteryStatusLogAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
+class BatteryStatusLogAdmin(ModeratorRestrictedMixin, HistoryAdmin):
     list_display = ("id", "battery", "kind", "start_at", "end_at")
     
     def get_queryset(self, request):
@@ -5636,7 +5814,7 @@ class BatteryStatusLogAdmin(ModeratorRestrictedMixin, SimpleHistoryAdmin):
 
 
 @admin.register(BatteryTransfer)
-class BatteryTransferAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, SimpleHistoryAdmin):
+class BatteryTransferAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, HistoryAdmin):
     city_filter_field = 'from_city'  # Модераторы видят только запросы из своего города
     
     list_display = ("id", "battery", "from_city", "to_city", "status_display", "requested_by", "approved_by", "created_at")
@@ -5667,96 +5845,53 @@ class BatteryTransferAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, Sim
     
     @admin.action(description="Подтвердить выбранные переносы")
     def approve_transfers(self, request, queryset):
+        """Пакетное подтверждение: одна транзакция и фиксированное число запросов на всю пачку"""
         from .logging_utils import log_error, log_action
-        import logging
-        import traceback
-        import os
-        
-        logger = logging.getLogger('rental')
-        
+
+        transfers = {
+            t['id']: t
+            for t in queryset.filter(status=BatteryTransfer.Status.PENDING).values(
+                'id', 'battery__short_code', 'from_city__name', 'to_city__name'
+            )
+        }
         try:
-            pending = queryset.filter(status=BatteryTransfer.Status.PENDING)
-            count = 0
-            errors = []
-            
-            logger.info(f"Начало подтверждения переносов. Выбрано: {pending.count()}")
-            
-            for transfer in pending:
-                try:
-                    logger.debug(f"Попытка подтверждения переноса ID={transfer.id}, батарея={transfer.battery.short_code if transfer.battery else 'None'}, from_city={transfer.from_city.name if transfer.from_city else 'None'}, to_city={transfer.to_city.name if transfer.to_city else 'None'}")
-                    
-                    # Проверяем, что все необходимые объекты существуют
-                    if not transfer.battery:
-                        raise ValueError(f"У переноса {transfer.id} отсутствует батарея")
-                    if not transfer.from_city:
-                        raise ValueError(f"У переноса {transfer.id} отсутствует город отправления")
-                    if not transfer.to_city:
-                        raise ValueError(f"У переноса {transfer.id} отсутствует город назначения")
-                    
-                    transfer.approve(request.user)
-                    count += 1
-                    
-                    logger.info(f"Перенос {transfer.id} успешно подтверждён")
-                    
-                    log_action(
-                        "Подтверждён перенос батареи",
-                        user=request.user,
-                        details={
-                            'transfer_id': transfer.id,
-                            'battery': transfer.battery.short_code,
-                            'from_city': str(transfer.from_city),
-                            'to_city': str(transfer.to_city),
-                        },
-                        request=request
-                    )
-                except ValidationError as e:
-                    error_msg = str(e)
-                    logger.error(f"ValidationError при подтверждении переноса {transfer.id}: {error_msg}\n{traceback.format_exc()}")
-                    errors.append(f"{transfer}: {error_msg}")
-                    log_error(
-                        "Ошибка при подтверждении переноса батареи",
-                        exception=e,
-                        user=request.user,
-                        context={
-                            'transfer_id': transfer.id,
-                            'battery': transfer.battery.short_code if transfer.battery else None,
-                            'from_city': str(transfer.from_city) if transfer.from_city else None,
-                            'to_city': str(transfer.to_city) if transfer.to_city else None,
-                        },
-                        request=request
-                    )
-                except Exception as e:
-                    error_msg = str(e)
-                    logger.error(f"Неожиданная ошибка при подтверждении переноса {transfer.id}: {error_msg}\n{traceback.format_exc()}")
-                    errors.append(f"{transfer}: {error_msg}")
-                    log_error(
-                        "Неожиданная ошибка при подтверждении переноса батареи",
-                        exception=e,
-                        user=request.user,
-                        context={
-                            'transfer_id': transfer.id,
-                            'battery': transfer.battery.short_code if transfer.battery else None,
-                        },
-                        request=request
-                    )
-            
-            if count:
-                self.message_user(request, f"Подтверждено переносов: {count}", level=messages.SUCCESS)
-            if errors:
-                for error in errors:
-                    self.message_user(request, error, level=messages.ERROR)
-                    
+            approved, errors = BatteryTransfer.approve_many(list(transfers), request.user)
         except Exception as e:
-            error_msg = f"Критическая ошибка в approve_transfers: {str(e)}\n{traceback.format_exc()}"
-            logger.error(error_msg)
             log_error(
-                "Критическая ошибка в approve_transfers",
+                "Ошибка при пакетном подтверждении переносов батарей",
                 exception=e,
                 user=request.user,
-                context={},
+                context={'transfer_ids': list(transfers)},
                 request=request
             )
             self.message_user(request, f"Произошла ошибка при подтверждении переносов: {str(e)}", level=messages.ERROR)
+            return
+
+        if approved:
+            log_action(
+                "Подтверждены переносы батарей",
+                user=request.user,
+                details={
+                    'transfers': [
+                        {
+                            'transfer_id': t.pk,
+                            'battery': transfers[t.pk]['battery__short_code'],
+                            'from_city': transfers[t.pk]['from_city__name'],
+                            'to_city': transfers[t.pk]['to_city__name'],
+                        }
+                        for t in approved
+                    ],
+                },
+                request=request
+            )
+            self.message_user(request, f"Подтверждено переносов: {len(approved)}", level=messages.SUCCESS)
+        for transfer_id, error in errors.items():
+            t = transfers.get(transfer_id, {})
+            self.message_user(
+                request,
+                f"{t.get('battery__short_code')} из {t.get('from_city__name')} в {t.get('to_city__name')}: {error}",
+                level=messages.ERROR,
+            )
     
     @admin.action(description="Отклонить выбранные переносы")
     def reject_transfers(self, request, queryset):
@@ -5765,3 +5900,73 @@ class BatteryTransferAdmin(ModeratorRestrictedMixin, CityFilteredAdminMixin, Sim
         for transfer in pending:
             transfer.reject(request.user)
         self.message_user(request, f"Отклонено переносов: {pending.count()}", level=messages.SUCCESS)
+
+
+@admin.register(ScheduledTariffChange)
+class ScheduledTariffChangeAdmin(ModeratorRestrictedMixin, HistoryAdmin):
+    """Запланированные смены тарифа: применяются командой apply_tariff_changes (cron) или действием"""
+    list_display = (
+        "id", "new_weekly_rate", "effective_at", "city", "current_weekly_rate", "status", "applied_count",
+        "applied_at", "created_by",
+    )
+    list_filter = ("status", "city")
+    autocomplete_fields = ["city", "rentals"]
+    readonly_fields = ("status", "applied_at", "applied_count", "matching_versions", "report", "created_at", "updated_at")
+    fields = (
+        "city", "current_weekly_rate", "rentals", "new_weekly_rate", "effective_at", "note",
+        "matching_versions", "status", "applied_at", "applied_count", "report", "created_at", "updated_at",
+    )
+    actions = ["apply_now", "cancel_changes"]
+
+    def has_module_permission(self, request):
+        return request.user.is_superuser
+
+    def has_change_permission(self, request, obj=None):
+        # Применённую или отменённую смену не редактируем
+        if obj is not None and obj.status != ScheduledTariffChange.Status.PENDING:
+            return False
+        return super().has_change_permission(request, obj)
+
+    @admin.display(description="Подходящих версий")
+    def matching_versions(self, obj):
+        if obj is None or obj.pk is None:
+            return "-"
+        if obj.status != ScheduledTariffChange.Status.PENDING:
+            return "-"
+        return obj.target_versions().count()
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.created_by = request.user
+        obj.updated_by = request.user
+        super().save_model(request, obj, form, change)
+
+    @admin.action(description="Применить сейчас (не дожидаясь cron)")
+    def apply_now(self, request, queryset):
+        now = timezone.now()
+        for change in queryset.filter(status=ScheduledTariffChange.Status.PENDING).select_related("created_by"):
+            if change.effective_at > now:
+                self.message_user(request, f"{change}: дата ещё не наступила", level=messages.WARNING)
+                continue
+            report = apply_tariff_change(change)
+            if report["errors"]:
+                self.message_user(
+                    request,
+                    f"{change}: создано версий {report['created']}, ставка изменена в {report['rerated']} "
+                    f"из {report['versions']}; "
+                    f"ошибки: {'; '.join(e['error'] for e in report['errors'])}",
+                    level=messages.ERROR,
+                )
+            else:
+                self.message_user(
+                    request,
+                    f"{change}: создано версий {report['created']}, ставка изменена в {report['rerated']}",
+                    level=messages.SUCCESS,
+                )
+
+    @admin.action(description="Отменить выбранные смены тарифа")
+    def cancel_changes(self, request, queryset):
+        updated = queryset.filter(status=ScheduledTariffChange.Status.PENDING).update(
+            status=ScheduledTariffChange.Status.CANCELLED, updated_by=request.user, updated_at=timezone.now()
+        )
+        self.message_user(request, f"Отменено смен тарифа: {updated}", level=messages.SUCCESS)
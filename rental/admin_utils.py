@@ -1,8 +1,14 @@
 """
 Утилиты для работы с разграничением доступа по городам в админ-панели.
 """
+from urllib.parse import urlencode
+
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
 from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from pathlib import Path
 from .models import FinancePartner, City
 
@@ -347,3 +353,66 @@ class CityFilteredAdminMixin:
         """
         return self.has_view_permission(request, obj)
 
+
+
+class ScopedAutocompleteSelect(AutocompleteSelect):
+    """
+    AutocompleteSelect с дополнительными GET-параметрами в URL поиска.
+    Параметры читает get_search_results целевой админки (например, город
+    договора для батарей или show_all_rentals для договоров в форме платежа).
+    """
+
+    def __init__(self, field, admin_site, params=None, **kwargs):
+        super().__init__(field, admin_site, **kwargs)
+        self.params = params or {}
+
+    def get_url(self):
+        url = super().get_url()
+        return f"{url}?{urlencode(self.params)}" if self.params else url
+
+
+def autocomplete_source(request):
+    """(model_name, field_name) формы, из которой пришёл autocomplete-запрос."""
+    return request.GET.get('model_name'), request.GET.get('field_name')
+
+
+def estimated_count(queryset):
+    """
+    Оценка числа строк таблицы из pg_class.reltuples (обновляется ANALYZE/autovacuum).
+    Только для queryset без фильтров, DISTINCT, группировки и срезов — иначе None
+    (как и для других СУБД и ещё не проанализированных таблиц).
+    """
+    query = getattr(queryset, 'query', None)
+    if query is None or query.where or query.distinct or query.group_by or query.combinator:
+        return None
+    if query.low_mark or query.high_mark is not None:
+        return None
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+            [connection.ops.quote_name(queryset.model._meta.db_table)],
+        )
+        row = cursor.fetchone()
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator списков админки: для нефильтрованного списка большой таблицы
+    число строк берётся из estimated_count вместо COUNT(*).
+    С фильтрами, поиском, ограничением по городу и для небольших таблиц — точный COUNT.
+    Оценка приблизительна: последняя страница может оказаться неполной или пустой.
+    """
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate >= self.estimate_threshold:
+            return estimate
+        return Paginator.count.func(self)
@@ -0,0 +1,185 @@
+"""
+Побочные эффекты изменения назначений батарей (RentalBatteryAssignment).
+
+На каждое сохранение/удаление назначения нужно: upsert лога RENTED в
+BatteryStatusLog, статус батареи, указатель текущего назначения, счётчики
+по городам и атрибуция выручки. Вне пакета эффекты применяются сразу
+(одно назначение: без перечитывания строки, лог — обычным save()). Внутри
+batch_assignment_effects() изменения копятся и
+применяются один раз при выходе из внешнего блока — в той же транзакции, что и
+сами назначения: логи — bulk_create/bulk_update, статусы — два UPDATE по
+множеству батарей. После коммита выполняются только пересчёты производных
+таблиц (счётчики, атрибуция — schedule_recount/schedule_refresh).
+Пользователь пакета (batch_assignment_effects(user=...)) пишется в историю
+логов как default_user bulk-операций.
+
+Статус батареи выводится из итогового состояния назначений (как в
+fix_battery_status): есть активное назначение активного договора — RENTED,
+иначе RENTED сменяется на AVAILABLE (SERVICE/SOLD не трогаем).
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+from .attribution import schedule_refresh
+from .counters import schedule_recount
+from .models import Battery, BatteryStatusLog, Rental, RentalBatteryAssignment
+
+_state = threading.local()
+
+
+def _new_pending(user=None):
+    return {'saved_ids': set(), 'deleted': set(), 'user': user}
+
+
+def _deleted_key(instance):
+    return (instance.battery_id, instance.rental_id, instance.start_at)
+
+
+@contextmanager
+def batch_assignment_effects(user=None):
+    """
+    Копит эффекты назначений до выхода из внешнего блока и применяет их там же,
+    внутри транзакции вызывающего (блок открывают внутри transaction.atomic()):
+    статусы, логи и указатели батарей коммитятся вместе с назначениями.
+    user — автор записей истории логов. Вложенные блоки объединяются (пользователь —
+    первый указанный); при исключении накопленное сбрасывается.
+    """
+    depth = getattr(_state, 'depth', 0)
+    if depth == 0:
+        _state.pending = _new_pending(user)
+    elif _state.pending['user'] is None:
+        _state.pending['user'] = user
+    _state.depth = depth + 1
+    try:
+        yield
+    except BaseException:
+        if depth == 0:
+            _state.pending = None
+        raise
+    finally:
+        _state.depth = depth
+    if depth == 0:
+        pending, _state.pending = _state.pending, None
+        if pending['saved_ids'] or pending['deleted']:
+            apply_effects(pending['saved_ids'], pending['deleted'], user=pending['user'])
+
+
+def _batching():
+    return getattr(_state, 'depth', 0) > 0
+
+
+def assignments_saved(assignments):
+    """Назначения сохранены (в т.ч. bulk_create/bulk_update, где сигналы не отправляются)."""
+    ids = {a.pk for a in assignments if a.pk}
+    if _batching():
+        _state.pending['saved_ids'] |= ids
+    elif len(ids) == 1 and len(assignments) == 1:
+        # Одиночное сохранение (post_save) — строка уже в памяти, без повторной выборки
+        a = assignments[0]
+        apply_effects(ids, (), rows=[{
+            'battery_id': a.battery_id, 'rental_id': a.rental_id, 'start_at': a.start_at, 'end_at': a.end_at,
+            'created_by_id': a.created_by_id, 'updated_by_id': a.updated_by_id,
+        }])
+    else:
+        apply_effects(ids, ())
+
+
+def assignments_deleted(assignments):
+    keys = {_deleted_key(a) for a in assignments}
+    if _batching():
+        _state.pending['deleted'] |= keys
+    else:
+        apply_effects((), keys)
+
+
+def apply_effects(saved_ids, deleted, now=None, user=None, rows=None):
+    """
+    Применяет эффекты для сохранённых назначений (id) и удалённых (battery, rental, start_at).
+    user — default_user истории bulk-операций; rows — уже известные значения сохранённых
+    назначений (тогда они не перечитываются).
+    """
+    now = now or timezone.now()
+    saved = rows if rows is not None else list(
+        RentalBatteryAssignment.objects.filter(pk__in=saved_ids).values(
+            'battery_id', 'rental_id', 'start_at', 'end_at', 'created_by_id', 'updated_by_id'
+        )
+    )
+    battery_ids = {a['battery_id'] for a in saved} | {key[0] for key in deleted}
+    rental_ids = {a['rental_id'] for a in saved} | {key[1] for key in deleted}
+    battery_ids.discard(None)
+    if not battery_ids:
+        return
+
+    with transaction.atomic():
+        # Логи RENTED: одна выборка, затем bulk_create / bulk_update / delete
+        logs = {}
+        for log in BatteryStatusLog.objects.filter(
+            kind=BatteryStatusLog.Kind.RENTED, battery_id__in=battery_ids, rental_id__in=rental_ids
+        ):
+            logs.setdefault((log.battery_id, log.rental_id, log.start_at), []).append(log)
+        to_create, to_update = [], []
+        saved_keys = set()
+        for a in saved:
+            key = (a['battery_id'], a['rental_id'], a['start_at'])
+            saved_keys.add(key)
+            if key not in logs:
+                log = BatteryStatusLog(
+                    battery_id=a['battery_id'],
+                    kind=BatteryStatusLog.Kind.RENTED,
+                    rental_id=a['rental_id'],
+                    start_at=a['start_at'],
+                    end_at=a['end_at'],
+                    created_by_id=a['created_by_id'],
+                    updated_by_id=a['updated_by_id'],
+                )
+                logs[key] = [log]
+                to_create.append(log)
+                continue
+            log = logs[key][0]
+            if log.end_at != a['end_at'] and log not in to_update:
+                log.end_at = a['end_at']
+                log.updated_at = now
+                to_update.append(log)
+        if len(to_create) + len(to_update) == 1:
+            # Одна запись — обычный save(): история с пользователем запроса (HistoryRequestMiddleware)
+            (to_create or to_update)[0].save()
+        else:
+            if to_create:
+                bulk_create_with_history(to_create, BatteryStatusLog, default_user=user)
+            if to_update:
+                bulk_update_with_history(to_update, BatteryStatusLog, ['end_at', 'updated_at'], default_user=user)
+        stale_ids = [
+            log.pk
+            for key in deleted if key not in saved_keys
+            for log in logs.get(key, [])
+        ]
+        if stale_ids:
+            BatteryStatusLog.objects.filter(pk__in=stale_ids).delete()
+
+        # Статусы батарей по итоговому состоянию назначений — два UPDATE
+        active_ids = set(
+            RentalBatteryAssignment.objects.filter(
+                battery_id__in=battery_ids,
+                rental__status=Rental.Status.ACTIVE,
+                start_at__lte=now,
+            ).filter(Q(end_at__isnull=True) | Q(end_at__gt=now)).values_list('battery_id', flat=True)
+        )
+        Battery.objects.filter(pk__in=active_ids).exclude(status=Battery.Status.RENTED).update(
+            status=Battery.Status.RENTED
+        )
+        Battery.objects.filter(pk__in=battery_ids - active_ids, status=Battery.Status.RENTED).update(
+            status=Battery.Status.AVAILABLE
+        )
+
+        Battery.sync_current_assignment(battery_ids, now)
+
+    root_ids = {root_id or rental_id for rental_id, root_id in Rental.objects.filter(
+        pk__in=rental_ids
+    ).values_list('id', 'root_id')}
+    schedule_recount(battery_ids=battery_ids)
+    schedule_refresh(battery_ids=battery_ids, root_ids=root_ids)
@@ -0,0 +1,174 @@
+"""
+Помесячная атрибуция выручки по батареям (таблица BatteryMonthlyAttribution).
+
+Для набора батарей строки считаются одним пакетным проходом
+(billing.battery_charge_shares — общая загрузка назначений и групп):
+- дни в аренде — объединение дневных интервалов назначений, разбитое по месяцам;
+- начислено — интервалы начислений батареи (назначение × ставка версии) по месяцам;
+- оплачено — каждая оплата аренды группы делится между батареями пропорционально
+  их доле в начислениях группы и относится к месяцу платежа;
+- ремонты — Repair.cost по месяцу начала ремонта.
+
+Изменения назначений, версий, платежей и ремонтов копятся за транзакцию и
+пересчитываются один раз в transaction.on_commit (см. schedule_refresh).
+"""
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import billing
+from .models import BatteryMonthlyAttribution, Payment, RentalBatteryAssignment, Repair
+
+CENT = Decimal('0.01')
+
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def next_month(d):
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+
+def split_by_month(first, last):
+    """Разбивает дни [first, last] по месяцам: [(первое число месяца, дней), ...]."""
+    parts = []
+    d = first
+    while d <= last:
+        nm = next_month(d)
+        end = min(last, nm - timedelta(days=1))
+        parts.append((month_start(d), (end - d).days + 1))
+        d = nm
+    return parts
+
+
+def compute_attribution(battery_ids, tz, now_dt):
+    """Строки атрибуции: {(battery_id, month): {'battery_days', 'charges', 'payments', 'repair_costs'}}."""
+    wanted = set(battery_ids)
+    rows = {}
+
+    def row(battery_id, month):
+        key = (battery_id, month)
+        if key not in rows:
+            rows[key] = {
+                'battery_days': 0,
+                'charges': Decimal(0),
+                'payments': Decimal(0),
+                'repair_costs': Decimal(0),
+            }
+        return rows[key]
+
+    # Назначения, группы и начисления — общей пакетной загрузкой billing
+    loaded = billing.battery_charge_shares(wanted, tz, now_dt)
+    root_ids = loaded['root_ids']
+    group_charges = loaded['group_charges']
+
+    # Дни в аренде: объединение дневных интервалов, разбитое по месяцам
+    for battery_id, s, e in loaded['rented_spans']:
+        for month, days in split_by_month(s, e):
+            row(battery_id, month)['battery_days'] += days
+
+    # Начисления батареи по месяцам и доля батареи в начислениях группы
+    shares = {}
+    for root_id, battery_id, s, e, daily_rate in loaded['segments']:
+        amount = daily_rate * Decimal((e - s).days + 1)
+        shares.setdefault(root_id, {})
+        shares[root_id][battery_id] = shares[root_id].get(battery_id, Decimal(0)) + amount
+        for month, days in split_by_month(s, e):
+            row(battery_id, month)['charges'] += daily_rate * Decimal(days)
+
+    # Оплаты аренды группы по месяцам, распределённые по долям батарей
+    paid_by_root_month = (
+        Payment.objects
+        .filter(rental__root_id__in=root_ids, type=Payment.PaymentType.RENT)
+        .values_list('rental__root_id', 'date__year', 'date__month')
+        .annotate(total=Sum('amount'))
+        .order_by()
+    )
+    for root_id, year, month_no, total in paid_by_root_month:
+        total_charges = group_charges.get(root_id, Decimal(0))
+        if not total or total_charges <= 0:
+            continue
+        month = date(year, month_no, 1)
+        for battery_id, share in shares.get(root_id, {}).items():
+            row(battery_id, month)['payments'] += total * share / total_charges
+
+    repairs = (
+        Repair.objects
+        .filter(battery_id__in=wanted)
+        .values_list('battery_id', 'start_at', 'cost')
+    )
+    for battery_id, start_at, cost in repairs:
+        if cost:
+            row(battery_id, month_start(billing.first_day(start_at, tz)))['repair_costs'] += cost
+
+    return rows
+
+
+def refresh_batteries(battery_ids, now_dt=None):
+    """Пересчитывает строки атрибуции батарей: удаление старых и bulk_create новых в одной транзакции."""
+    battery_ids = list(set(battery_ids))
+    if not battery_ids:
+        return 0
+    tz = timezone.get_current_timezone()
+    rows = compute_attribution(battery_ids, tz, now_dt or timezone.now())
+    objs = [
+        BatteryMonthlyAttribution(
+            battery_id=battery_id,
+            month=month,
+            battery_days=data['battery_days'],
+            charges=data['charges'].quantize(CENT),
+            payments=data['payments'].quantize(CENT),
+            repair_costs=data['repair_costs'].quantize(CENT),
+        )
+        for (battery_id, month), data in rows.items()
+    ]
+    with transaction.atomic():
+        BatteryMonthlyAttribution.objects.filter(battery_id__in=battery_ids).delete()
+        BatteryMonthlyAttribution.objects.bulk_create(objs, batch_size=1000)
+    return len(objs)
+
+
+# --- Инкрементальный пересчёт: копим изменения за транзакцию ---
+_pending = threading.local()
+
+
+def _flush():
+    battery_ids = getattr(_pending, 'battery_ids', set())
+    root_ids = getattr(_pending, 'root_ids', set())
+    _pending.battery_ids = set()
+    _pending.root_ids = set()
+    if root_ids:
+        # Доля оплат зависит от всех батарей группы — пересчитываем их все
+        battery_ids |= set(
+            RentalBatteryAssignment.objects
+            .filter(rental__root_id__in=root_ids)
+            .values_list('battery_id', flat=True)
+        )
+    try:
+        refresh_batteries(battery_ids)
+    except Exception as e:
+        from .logging_utils import log_error
+        log_error(
+            "Ошибка пересчёта атрибуции батарей",
+            exception=e,
+            context={'battery_ids': sorted(battery_ids)[:50], 'root_ids': sorted(root_ids)[:50]},
+        )
+
+
+def schedule_refresh(battery_ids=(), root_ids=()):
+    """Отмечает батареи/группы для пересчёта после коммита текущей транзакции."""
+    if not hasattr(_pending, 'battery_ids'):
+        _pending.battery_ids = set()
+        _pending.root_ids = set()
+    _pending.battery_ids.update(b for b in battery_ids if b)
+    _pending.root_ids.update(r for r in root_ids if r)
+    # Один пересчёт на транзакцию; при откате Django сам очищает run_on_commit
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(entry[1] is _flush for entry in connection.run_on_commit):
+        return
+    transaction.on_commit(_flush)
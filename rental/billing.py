@@ -0,0 +1,501 @@
+"""
+Пакетный расчёт начислений по группам договоров (root).
+
+Все версии и назначения батарей загружаются двумя запросами, после чего
+начисления считаются по интервалам (пересечение версии и назначения в
+календарных днях), без посуточных циклов и без вызовов charges_until().
+
+Семантика совпадает с Rental.group_charges_until(until):
+- версия начисляется до min(end_at, until), открытая версия — до until (или до now);
+- календарный день начисляется, если интервал пересекает [00:00, 24:00);
+- окончание ровно в полночь — исключающая граница (день окончания не считается);
+- день на стыке двух версий начисляется в обеих версиях.
+"""
+import heapq
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import DecimalField, Exists, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Rental, RentalBatteryAssignment, Payment
+
+
+def first_day(dt, tz):
+    """Первый календарный день, который затрагивает момент dt."""
+    return timezone.localtime(dt, tz).date()
+
+
+def last_day(dt, tz):
+    """Последний начисляемый календарный день для исключающей границы dt."""
+    local = timezone.localtime(dt, tz)
+    d = local.date()
+    if local.hour == 0 and local.minute == 0 and local.second == 0 and local.microsecond == 0:
+        d -= timedelta(days=1)
+    return d
+
+
+def load_groups(root_ids):
+    """
+    Загружает версии и назначения групп двумя запросами.
+    root_ids — список id или QuerySet с id (будет подзапросом).
+    Возвращает (versions_by_root, assignments_by_version).
+    """
+    versions_by_root = {}
+    for v in (
+        Rental.objects
+        .filter(root_id__in=root_ids)
+        .values(
+            'id', 'root_id', 'client_id', 'city_id', 'version', 'status',
+            'start_at', 'end_at', 'weekly_rate', 'contract_code', 'created_by_id',
+        )
+        .order_by('start_at', 'id')
+    ):
+        versions_by_root.setdefault(v['root_id'], []).append(v)
+
+    assignments_by_version = {}
+    for a in (
+        RentalBatteryAssignment.objects
+        .filter(rental__root_id__in=root_ids)
+        .values('id', 'rental_id', 'battery_id', 'start_at', 'end_at')
+        .order_by('start_at', 'id')
+    ):
+        assignments_by_version.setdefault(a['rental_id'], []).append(a)
+    return versions_by_root, assignments_by_version
+
+
+def version_window(v, tz, now_dt, until=None):
+    """
+    Окно начислений версии в днях [first, last] или None, если окно пустое.
+    Без until версия считается до end_at (открытая — до now_dt), как в charges_until().
+    """
+    if until is None:
+        end = v['end_at'] or now_dt
+    else:
+        end = v['end_at'] if v['end_at'] and v['end_at'] < until else until
+    if end <= v['start_at']:
+        return None
+    first = first_day(v['start_at'], tz)
+    last = last_day(end, tz)
+    if last < first:
+        return None
+    return first, last
+
+
+def charge_segments(versions_by_root, assignments_by_version, tz, now_dt, until=None):
+    """
+    Интервалы начислений: пересечения окна версии с назначениями батарей.
+    Выдаёт кортежи (root_id, version, battery_id, first_day, last_day, daily_rate),
+    где version — словарь из load_groups().
+    """
+    for root_id, versions in versions_by_root.items():
+        for v in versions:
+            window = version_window(v, tz, now_dt, until)
+            if window is None:
+                continue
+            v_first, v_last = window
+            daily_rate = (v['weekly_rate'] or Decimal(0)) / Decimal(7)
+            for a in assignments_by_version.get(v['id'], []):
+                s = max(v_first, first_day(a['start_at'], tz))
+                e = min(v_last, last_day(a['end_at'], tz)) if a['end_at'] else v_last
+                if e < s:
+                    continue
+                yield root_id, v, a['battery_id'], s, e, daily_rate
+
+
+def battery_charge_shares(battery_ids, tz, now_dt):
+    """
+    Пакетная загрузка начислений по батареям (общая для окупаемости и леджера
+    атрибуции): назначения батарей, версии и назначения их групп — три запроса
+    независимо от числа батарей.
+    Возвращает словарь:
+      root_ids — группы, где батареи были назначены;
+      rented_spans — [(battery_id, first_day, last_day)]: объединение дневных интервалов
+        назначений батареи (отсортировано по батарее и дате);
+      group_charges — {root_id: Decimal}: все начисления группы (до now_dt);
+      segments — [(root_id, battery_id, first_day, last_day, daily_rate)]: интервалы
+        начислений запрошенных батарей.
+    """
+    wanted = set(battery_ids)
+    rows = list(
+        RentalBatteryAssignment.objects
+        .filter(battery_id__in=wanted)
+        .values_list('battery_id', 'rental__root_id', 'start_at', 'end_at')
+    )
+
+    spans = sorted(
+        (battery_id, first_day(start_at, tz), last_day(end_at or now_dt, tz))
+        for battery_id, _root_id, start_at, end_at in rows
+    )
+    merged = []
+    for battery_id, s, e in spans:
+        if e < s:
+            continue
+        if merged and merged[-1][0] == battery_id and s <= merged[-1][2] + timedelta(days=1):
+            merged[-1][2] = max(merged[-1][2], e)
+        else:
+            merged.append([battery_id, s, e])
+
+    root_ids = list({root_id for _b, root_id, _s, _e in rows if root_id})
+    versions_by_root, assignments_by_version = load_groups(root_ids)
+    group_charges = {}
+    segments = []
+    for root_id, _v, battery_id, s, e, daily_rate in charge_segments(
+        versions_by_root, assignments_by_version, tz, now_dt, until=now_dt
+    ):
+        group_charges[root_id] = group_charges.get(root_id, Decimal(0)) + daily_rate * Decimal((e - s).days + 1)
+        if battery_id in wanted:
+            segments.append((root_id, battery_id, s, e, daily_rate))
+    return {
+        'root_ids': root_ids,
+        'rented_spans': [tuple(span) for span in merged],
+        'group_charges': group_charges,
+        'segments': segments,
+    }
+
+
+def daily_accruals(versions_by_root, assignments_by_version, tz, now_dt, until=None):
+    """
+    Посуточные начисления по версиям через разностные массивы количества батарей.
+    Возвращает {root_id: [{'date', 'version_id', 'version', 'battery_count',
+    'daily_rate', 'amount'}, ...]} в хронологическом порядке (только дни с начислением).
+    """
+    # (root_id, version_id) -> [first_day, diff-массив]
+    diffs = {}
+    rates = {}
+    for root_id, v, _battery_id, s, e, daily_rate in charge_segments(
+        versions_by_root, assignments_by_version, tz, now_dt, until
+    ):
+        key = (root_id, v['id'])
+        if key not in diffs:
+            v_first, v_last = version_window(v, tz, now_dt, until)
+            diffs[key] = (v_first, [0] * ((v_last - v_first).days + 2))
+            rates[key] = (v['version'], daily_rate)
+        base, diff = diffs[key]
+        diff[(s - base).days] += 1
+        diff[(e - base).days + 1] -= 1
+
+    result = {}
+    for (root_id, version_id), (base, diff) in diffs.items():
+        version_no, daily_rate = rates[(root_id, version_id)]
+        rows = result.setdefault(root_id, [])
+        count = 0
+        for i in range(len(diff) - 1):
+            count += diff[i]
+            if count:
+                rows.append({
+                    'date': base + timedelta(days=i),
+                    'version_id': version_id,
+                    'version': version_no,
+                    'battery_count': count,
+                    'daily_rate': daily_rate,
+                    'amount': daily_rate * count,
+                })
+    for rows in result.values():
+        rows.sort(key=lambda r: (r['date'], r['version']))
+    return result
+
+
+def group_charges(versions_by_root, assignments_by_version, tz, now_dt, until=None):
+    """Сумма начислений по каждой группе: {root_id: Decimal}."""
+    charges = {root_id: Decimal(0) for root_id in versions_by_root}
+    for root_id, _v, _battery_id, s, e, daily_rate in charge_segments(
+        versions_by_root, assignments_by_version, tz, now_dt, until
+    ):
+        charges[root_id] += daily_rate * Decimal((e - s).days + 1)
+    return charges
+
+
+def group_payment_totals(root_ids):
+    """
+    Суммы платежей по группам и типам одним запросом.
+    Возвращает {root_id: {payment_type: Decimal}}.
+    """
+    totals = {}
+    rows = (
+        Payment.objects
+        .filter(rental__root_id__in=root_ids)
+        .values('rental__root_id', 'type')
+        .annotate(total=Sum('amount'))
+        .order_by()
+    )
+    for row in rows:
+        totals.setdefault(row['rental__root_id'], {})[row['type']] = row['total'] or Decimal(0)
+    return totals
+
+
+def group_summaries(root_ids, tz, now_dt):
+    """
+    Итоги по группам для карточки клиента (то же, что считал change_view через
+    group_charges_until/group_paid_total/group_deposit_total, но пакетно).
+    Возвращает {root_id: {...}} и исходные данные групп для повторного использования.
+    Начало/конец группы и число версий здесь не считаются — они лежат на root
+    (group_start_at, group_end_at, versions_count).
+    """
+    versions_by_root, assignments_by_version = load_groups(root_ids)
+    charges = group_charges(versions_by_root, assignments_by_version, tz, now_dt, until=now_dt)
+    payments = group_payment_totals(root_ids)
+    summaries = {}
+    for root_id, versions in versions_by_root.items():
+        billable_days = 0
+        for v in versions:
+            window = version_window(v, tz, now_dt)
+            if window:
+                billable_days += (window[1] - window[0]).days + 1
+        by_type = payments.get(root_id, {})
+        summaries[root_id] = {
+            'billable_days': billable_days,
+            'charges': charges.get(root_id, Decimal(0)),
+            'paid': by_type.get(Payment.PaymentType.RENT, Decimal(0)),
+            'deposit': (
+                by_type.get(Payment.PaymentType.DEPOSIT, Decimal(0))
+                - by_type.get(Payment.PaymentType.RETURN_DEPOSIT, Decimal(0))
+            ),
+        }
+    return summaries, (versions_by_root, assignments_by_version)
+
+
+def iter_statement(root_ids, tz, now_dt, groups=None):
+    """
+    Выписка по группам договоров в хронологическом порядке.
+    Посуточные начисления (по количеству батарей и ставке) и платежи сливаются
+    в одну ленту с нарастающим балансом (оплачено аренды − начислено) и
+    нарастающим остатком депозита. Внутри одного дня начисления идут раньше платежей.
+    groups — уже загруженные (versions_by_root, assignments_by_version), если есть.
+    """
+    if groups is None:
+        groups = load_groups(root_ids)
+    versions_by_root, assignments_by_version = groups
+    codes = {
+        root_id: (versions[0]['contract_code'] if versions else '')
+        for root_id, versions in versions_by_root.items()
+    }
+    accruals = daily_accruals(versions_by_root, assignments_by_version, tz, now_dt, until=now_dt)
+
+    def charge_rows():
+        streams = [
+            ((r['date'], 0, root_id, r['version']), root_id, r)
+            for root_id, rows in accruals.items() for r in rows
+        ]
+        streams.sort(key=lambda x: x[0])
+        for _key, root_id, r in streams:
+            yield (r['date'], 0), {
+                'date': r['date'],
+                'contract_code': codes.get(root_id, ''),
+                'kind': 'charge',
+                'label': 'Начисление',
+                'description': f"v{r['version']}: {r['battery_count']} бат. × {r['daily_rate']:.2f}",
+                'battery_count': r['battery_count'],
+                'amount': r['amount'],
+            }
+
+    def payment_rows():
+        labels = dict(Payment.PaymentType.choices)
+        methods = dict(Payment.Method.choices)
+        qs = (
+            Payment.objects
+            .filter(rental__root_id__in=root_ids)
+            .values('id', 'date', 'amount', 'type', 'method', 'note', 'rental__root_id')
+            .order_by('date', 'id')
+        )
+        for p in qs.iterator():
+            yield (p['date'], 1), {
+                'date': p['date'],
+                'contract_code': codes.get(p['rental__root_id'], ''),
+                'kind': p['type'],
+                'label': labels.get(p['type'], p['type']),
+                'description': ' '.join(filter(None, [methods.get(p['method'], ''), p['note']])),
+                'battery_count': None,
+                'amount': p['amount'] or Decimal(0),
+            }
+
+    balance = Decimal(0)
+    deposit = Decimal(0)
+    for _key, row in heapq.merge(charge_rows(), payment_rows(), key=lambda x: x[0]):
+        amount = row['amount']
+        if row['kind'] == 'charge':
+            balance -= amount
+        elif row['kind'] == Payment.PaymentType.RENT:
+            balance += amount
+        elif row['kind'] == Payment.PaymentType.DEPOSIT:
+            deposit += amount
+        elif row['kind'] == Payment.PaymentType.RETURN_DEPOSIT:
+            deposit -= amount
+        row['balance'] = balance
+        row['deposit'] = deposit
+        yield row
+
+
+# Корзины просрочки: (ключ, подпись, от дней, до дней включительно; None — без верхней границы)
+AGING_BUCKETS = (
+    ('current', 'Текущий', 0, 0),
+    ('d1_7', '1–7 дней', 1, 7),
+    ('d8_30', '8–30 дней', 8, 30),
+    ('d31_60', '31–60 дней', 31, 60),
+    ('d60_plus', '60+ дней', 61, None),
+)
+
+
+def aging_bucket_index(days):
+    for i, (_key, _label, lo, hi) in enumerate(AGING_BUCKETS):
+        if days >= lo and (hi is None or days <= hi):
+            return i
+    return 0
+
+
+def aging_by_root(versions_by_root, assignments_by_version, paid_by_root, tz, now_dt):
+    """
+    Просрочка по группам: оплаты аренды гасят посуточные начисления по FIFO
+    (самые старые дни первыми), неоплаченный остаток каждого дня попадает
+    в корзину по возрасту (сегодня − дата начисления).
+    Возвращает {root_id: {'buckets': [Decimal, ...], 'total': Decimal, 'credit': Decimal}}.
+    """
+    today = timezone.localtime(now_dt, tz).date()
+    accruals = daily_accruals(versions_by_root, assignments_by_version, tz, now_dt, until=now_dt)
+    result = {}
+    for root_id in versions_by_root:
+        remaining_paid = paid_by_root.get(root_id, Decimal(0))
+        buckets = [Decimal(0)] * len(AGING_BUCKETS)
+        for r in accruals.get(root_id, []):
+            amount = r['amount']
+            if remaining_paid >= amount:
+                remaining_paid -= amount
+                continue
+            buckets[aging_bucket_index((today - r['date']).days)] += amount - remaining_paid
+            remaining_paid = Decimal(0)
+        result[root_id] = {
+            'buckets': buckets,
+            'total': sum(buckets, Decimal(0)),
+            'credit': remaining_paid,
+        }
+    return result
+
+
+def charges_by_city_in_period(versions_by_root, assignments_by_version, tz, now_dt, first, last):
+    """Начисления по городам за дни [first, last] (по городу версии): {city_id: Decimal}."""
+    totals = {}
+    for _root_id, v, _battery_id, s, e, daily_rate in charge_segments(
+        versions_by_root, assignments_by_version, tz, now_dt, until=now_dt
+    ):
+        s = max(s, first)
+        e = min(e, last)
+        if e < s:
+            continue
+        totals[v['city_id']] = totals.get(v['city_id'], Decimal(0)) + daily_rate * Decimal((e - s).days + 1)
+    return totals
+
+
+def forecast_by_city(city_ids, tz, now_dt, days):
+    """
+    Прогноз начислений на days дней вперёд, начиная с сегодняшнего.
+    Берутся открытые назначения активных версий: ставка версии, плановый
+    end_at версии и назначения ограничивают интервал. Суммы по дням получаются
+    префиксной суммой разностного массива на каждый город.
+    city_ids=None — все договоры, включая без города.
+    Возвращает (первый день, {city_id: [Decimal по дням]}).
+    """
+    today = timezone.localtime(now_dt, tz).date()
+    horizon = today + timedelta(days=days - 1)
+    rows = RentalBatteryAssignment.objects.filter(rental__status=Rental.Status.ACTIVE)
+    if city_ids is not None:
+        rows = rows.filter(rental__city_id__in=city_ids)
+    rows = (
+        rows
+        .filter(Q(end_at__isnull=True) | Q(end_at__gt=now_dt))
+        .filter(Q(rental__end_at__isnull=True) | Q(rental__end_at__gt=now_dt))
+        .values_list(
+            'start_at', 'end_at', 'rental__start_at', 'rental__end_at',
+            'rental__weekly_rate', 'rental__city_id',
+        )
+    )
+    diffs = {}
+    for a_start, a_end, v_start, v_end, weekly_rate, city_id in rows:
+        s = max(today, first_day(a_start, tz), first_day(v_start, tz))
+        e = horizon
+        if a_end:
+            e = min(e, last_day(a_end, tz))
+        if v_end:
+            e = min(e, last_day(v_end, tz))
+        if e < s:
+            continue
+        daily_rate = (weekly_rate or Decimal(0)) / Decimal(7)
+        diff = diffs.setdefault(city_id, [Decimal(0)] * (days + 1))
+        diff[(s - today).days] += daily_rate
+        diff[(e - today).days + 1] -= daily_rate
+
+    result = {}
+    for city_id, diff in diffs.items():
+        running = Decimal(0)
+        values = []
+        for i in range(days):
+            running += diff[i]
+            values.append(running)
+        result[city_id] = values
+    return today, result
+
+
+DEPOSIT_TYPES = (Payment.PaymentType.DEPOSIT, Payment.PaymentType.RETURN_DEPOSIT)
+
+
+def _held_deposit_sum():
+    """Депозит минус возвраты одним агрегатом (вместо двух запросов group_deposit_total)."""
+    zero = Value(Decimal(0), output_field=DecimalField(max_digits=12, decimal_places=2))
+    return (
+        Coalesce(Sum('amount', filter=Q(type=Payment.PaymentType.DEPOSIT)), zero)
+        - Coalesce(Sum('amount', filter=Q(type=Payment.PaymentType.RETURN_DEPOSIT)), zero)
+    )
+
+
+def held_deposits_by_group(city_ids):
+    """
+    Удерживаемые депозиты по группам одним сгруппированным запросом.
+    Для каждой группы: город и клиент root, сумма на руках, есть ли активная
+    версия и дата окончания последней версии (для старения закрытых договоров).
+    city_ids=None — все группы, включая без города.
+    """
+    active_versions = Rental.objects.filter(root_id=OuterRef('rental__root_id'), status=Rental.Status.ACTIVE)
+    group_end = (
+        Rental.objects
+        .filter(root_id=OuterRef('rental__root_id'))
+        .order_by()
+        .values('root_id')
+        .annotate(last_end=Max('end_at'))
+        .values('last_end')
+    )
+    qs = Payment.objects.filter(type__in=DEPOSIT_TYPES)
+    if city_ids is not None:
+        qs = qs.filter(rental__root__city_id__in=city_ids)
+    return (
+        qs
+        .values(
+            'rental__root_id', 'rental__root__contract_code', 'rental__root__city_id',
+            'rental__root__client_id', 'rental__root__client__name',
+        )
+        .annotate(
+            held=_held_deposit_sum(),
+            has_active=Exists(active_versions),
+            group_end=Subquery(group_end),
+        )
+        .exclude(held=0)
+        .order_by()
+    )
+
+
+def deposit_snapshot_by_city(city_ids=None):
+    """
+    Депозиты на руках по городам {city_id: Decimal} одним сгруппированным запросом
+    по платежам. None в city_ids — группы без города. Источник для таблицы
+    DepositSnapshot (rental.counters); dashboard читает таблицу, а не платежи.
+    """
+    qs = Payment.objects.filter(type__in=DEPOSIT_TYPES)
+    if city_ids is not None:
+        city_ids = set(city_ids)
+        city_q = Q(rental__root__city_id__in=[c for c in city_ids if c is not None])
+        if None in city_ids:
+            city_q |= Q(rental__root__city_id__isnull=True)
+        qs = qs.filter(city_q)
+    return {
+        row['rental__root__city_id']: row['held']
+        for row in qs.values('rental__root__city_id').annotate(held=_held_deposit_sum()).order_by()
+    }
@@ -0,0 +1,194 @@
+"""
+Массовое закрытие групп договоров (root) на дату с расчётом по депозиту.
+
+Закрытие идёт пачками по chunk групп, одна транзакция на пачку (при ошибке
+пачка повторяется по одной группе, чтобы сбойная не блокировала остальные):
+- корни и активные версии блокируются select_for_update (как tariffs._apply_chunk);
+- версии закрываются bulk_update, открытые назначения (end_at пуст или позже
+  даты закрытия) — одним bulk UPDATE; начинающиеся позже даты закрытия получают
+  пустой интервал [start_at, start_at), а не start_at > end_at; освобождение
+  батарей — один раз на пачку через batch_assignment_effects;
+- при settle начисления и платежи закрытых в пачке групп считаются пакетно
+  (billing.group_summaries), зачёт и возврат депозита (и оплата из формы)
+  создаются одним bulk INSERT. Уже закрытые группы не рассчитываются повторно.
+
+bulk-операции не отправляют сигналы, поэтому их эффекты (сводка групп на root,
+указатели батарей, атрибуция) вызываются явно.
+"""
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, DataError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+from . import billing
+from .assignment_effects import assignments_saved, batch_assignment_effects
+from .attribution import schedule_refresh
+from .counters import schedule_deposit_recount
+from .models import Battery, Payment, Rental, RentalBatteryAssignment
+
+DEFAULT_CHUNK = 100
+
+
+def _user_name(user):
+    if user is None:
+        return ''
+    return user.get_full_name() or user.username or user.email
+
+
+def settlement_payments(root, charges, paid, deposit, user, today, rent_payment=None):
+    """
+    Платежи расчёта при закрытии группы (как close_with_deposit): зачёт депозита
+    в долг (ADJUSTMENT с минусом), возврат остатка депозита, оплата аренды из формы.
+    rent_payment — (сумма, метод, примечание) или None.
+    """
+    payments = []
+
+    def payment(amount, type_, method, note):
+        payments.append(Payment(
+            rental=root,
+            city_id=root.city_id,
+            amount=amount,
+            date=today,
+            type=type_,
+            method=method,
+            note=note,
+            created_by=user,
+            updated_by=user,
+        ))
+
+    balance = charges - paid
+    deposit_left = deposit
+    if balance > 0 and deposit_left > 0:
+        applied = min(balance, deposit_left)
+        payment(-applied, Payment.PaymentType.ADJUSTMENT, Payment.Method.OTHER, "Зачёт депозита при закрытии")
+        deposit_left -= applied
+    if deposit_left > 0:
+        payment(deposit_left, Payment.PaymentType.RETURN_DEPOSIT, Payment.Method.OTHER, "Возврат остатка депозита")
+    if rent_payment and rent_payment[0]:
+        amount, method, note = rent_payment
+        payment(amount, Payment.PaymentType.RENT, method or Payment.Method.OTHER, note or "")
+    return payments
+
+
+def _close_chunk(root_ids, close_at, user, settle, rent_payment):
+    """Одна пачка групп в одной транзакции. Возвращает счётчики пачки."""
+    now = timezone.now()
+    user_name = _user_name(user)
+    with transaction.atomic(), batch_assignment_effects(user):
+        roots = {
+            r.pk: r for r in Rental.objects.select_for_update(of=('self',)).filter(pk__in=root_ids).order_by('pk')
+        }
+        versions = list(
+            Rental.objects.select_for_update(of=('self',))
+            .filter(Q(root_id__in=roots) | Q(pk__in=roots), status=Rental.Status.ACTIVE)
+            .order_by('pk')
+        )
+        closed_roots = {v.root_id or v.pk for v in versions}
+        for v in versions:
+            if not v.end_at or v.end_at > close_at:
+                # Версия, начинающаяся после даты закрытия, — пустой интервал
+                v.end_at = max(close_at, v.start_at)
+            v.status = Rental.Status.CLOSED
+            v.updated_by = user
+            v.updated_by_name = user_name
+            v.updated_at = now
+            # Корень в той же пачке — держим в roots актуальный объект
+            if v.pk in roots:
+                roots[v.pk] = v
+        if versions:
+            bulk_update_with_history(
+                versions, Rental, ['end_at', 'status', 'updated_by', 'updated_by_name', 'updated_at'], default_user=user
+            )
+
+        version_ids = [v.pk for v in versions]
+        closed = list(
+            RentalBatteryAssignment.objects.select_for_update(of=('self',))
+            .filter(rental_id__in=version_ids)
+            .filter(Q(end_at__isnull=True) | Q(end_at__gt=close_at))
+        )
+        for a in closed:
+            a.end_at = max(close_at, a.start_at)
+            a.updated_by = user
+            a.updated_at = now
+        if closed:
+            bulk_update_with_history(
+                closed, RentalBatteryAssignment, ['end_at', 'updated_by', 'updated_at'], default_user=user
+            )
+        assignments_saved(closed)
+        # Как сигнал rental_sync_current_pointer: закрытие версии освобождает и батареи,
+        # назначения которых уже заканчиваются до даты закрытия
+        Battery.sync_current_assignment(
+            RentalBatteryAssignment.objects.filter(rental_id__in=version_ids).values_list('battery_id', flat=True)
+        )
+        Rental.refresh_group_meta(roots)
+
+        payments = []
+        if settle:
+            tz = timezone.get_current_timezone()
+            summaries, _groups = billing.group_summaries(sorted(closed_roots), tz, max(now, close_at))
+            today = timezone.localdate()
+            for root_id in sorted(closed_roots):
+                root = roots.get(root_id)
+                summary = summaries.get(root_id)
+                if root is None or summary is None:
+                    continue
+                payments += settlement_payments(
+                    root, summary['charges'], summary['paid'], summary['deposit'], user, today, rent_payment
+                )
+            if payments:
+                bulk_create_with_history(payments, Payment, default_user=user)
+                # bulk_create не отправляет post_save — снимок депозитов отмечаем сами
+                schedule_deposit_recount(rental_ids={p.rental_id for p in payments})
+        schedule_refresh(root_ids=list(roots))
+    return {'groups': len(closed_roots), 'versions': len(versions), 'assignments': len(closed), 'payments': len(payments)}
+
+
+def _error(root_id, exc):
+    """Запись об ошибке группы; validation — ошибка данных (для ответа 400), а не сбой БД."""
+    if isinstance(exc, ValidationError):
+        text = '; '.join(exc.messages)
+    else:
+        text = str(exc)
+    return {'root': root_id, 'error': text, 'validation': isinstance(exc, (ValidationError, DataError))}
+
+
+def close_groups(root_ids, close_at, user, settle=False, rent_payment=None, chunk_size=DEFAULT_CHUNK):
+    """
+    Закрывает группы договоров на close_at пачками. Ошибка пачки откатывает только её,
+    после чего пачка повторяется по одной группе: остальные группы закрываются,
+    в отчёт попадает сбойная. Прочие исключения (ошибки кода) не перехватываются.
+    settle — создать платежи расчёта по депозиту (settlement_payments).
+    Возвращает отчёт {'groups' (закрытых групп), 'versions', 'assignments', 'payments',
+    'errors': [{'root', 'error', 'validation'}]}.
+    """
+    root_ids = sorted({r for r in root_ids if r})
+    report = {'groups': 0, 'versions': 0, 'assignments': 0, 'payments': 0, 'errors': []}
+
+    def add(counts):
+        for key, value in counts.items():
+            report[key] += value
+
+    for i in range(0, len(root_ids), chunk_size):
+        chunk = root_ids[i:i + chunk_size]
+        try:
+            add(_close_chunk(chunk, close_at, user, settle, rent_payment))
+            continue
+        except (ValidationError, DatabaseError) as e:
+            if len(chunk) == 1:
+                report['errors'].append(_error(chunk[0], e))
+                continue
+        for root_id in chunk:
+            try:
+                add(_close_chunk([root_id], close_at, user, settle, rent_payment))
+            except (ValidationError, DatabaseError) as e:
+                report['errors'].append(_error(root_id, e))
+    return report
+
+
+def active_roots(city_ids=None):
+    """id корней групп с активной версией (для массового закрытия по городам)."""
+    qs = Rental.objects.filter(status=Rental.Status.ACTIVE)
+    if city_ids:
+        qs = qs.filter(city_id__in=city_ids)
+    return sorted({root_id or pk for pk, root_id in qs.values_list('pk', 'root_id')})
@@ -0,0 +1,174 @@
+"""
+Счётчики батарей по (город, статус) — таблица BatteryStatusCounter,
+и депозиты на руках по городам — таблица DepositSnapshot.
+
+Все пути, меняющие Battery.status или Battery.city (сигналы назначений,
+сохранение/удаление батареи, подтверждение переноса, fix_battery_status),
+отмечают затронутые города через schedule_recount. После коммита транзакции
+строки этих городов пересчитываются одним сгруппированным запросом, так что
+счётчики совпадают с таблицей батарей и одинаковы во всех процессах.
+
+Так же пути, меняющие депозитные платежи или город корня группы (сигналы
+Payment и Rental, bulk-закрытие с возвратом депозита), отмечают города через
+schedule_deposit_recount.
+"""
+import threading
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q, Sum
+
+from .billing import deposit_snapshot_by_city
+from .models import Battery, BatteryStatusCounter, DepositSnapshot, Rental
+
+# Статусы «основного» парка (без проданных), как в статистике dashboard
+MAIN_STATUSES = (Battery.Status.AVAILABLE, Battery.Status.RENTED, Battery.Status.SERVICE)
+
+
+def _city_filter(field, city_ids):
+    q = Q(**{f'{field}__in': [c for c in city_ids if c is not None]})
+    if None in city_ids:
+        q |= Q(**{f'{field}__isnull': True})
+    return q
+
+
+def recount_cities(city_ids):
+    """Пересчитывает строки счётчиков указанных городов (None — батареи без города)."""
+    city_ids = set(city_ids)
+    if not city_ids:
+        return
+    rows = (
+        Battery.objects.filter(_city_filter('city_id', city_ids))
+        .values('city_id', 'status')
+        .annotate(count=Count('id'), total_cost=Sum('cost_price'))
+        .order_by()
+    )
+    merged = {}
+    for row in rows:
+        key = (row['city_id'], row['status'] or '')
+        count, cost = merged.get(key, (0, Decimal(0)))
+        merged[key] = (count + row['count'], cost + (row['total_cost'] or Decimal(0)))
+    with transaction.atomic():
+        BatteryStatusCounter.objects.filter(_city_filter('city_id', city_ids)).delete()
+        BatteryStatusCounter.objects.bulk_create([
+            BatteryStatusCounter(city_id=city_id, status=status, count=count, total_cost=cost)
+            for (city_id, status), (count, cost) in merged.items()
+        ])
+
+
+def recount_all():
+    """Полный пересчёт: все города, где есть батареи или строки счётчиков."""
+    city_ids = set(Battery.objects.values_list('city_id', flat=True).distinct())
+    city_ids |= set(BatteryStatusCounter.objects.values_list('city_id', flat=True).distinct())
+    recount_cities(city_ids)
+
+
+def recount_deposits(city_ids):
+    """Пересчитывает строки DepositSnapshot указанных городов (None — группы без города)."""
+    city_ids = set(city_ids)
+    if not city_ids:
+        return
+    held = deposit_snapshot_by_city(city_ids)
+    with transaction.atomic():
+        DepositSnapshot.objects.filter(_city_filter('city_id', city_ids)).delete()
+        DepositSnapshot.objects.bulk_create([
+            DepositSnapshot(city_id=city_id, held=amount) for city_id, amount in held.items() if amount
+        ])
+
+
+def recount_all_deposits():
+    """Полный пересчёт DepositSnapshot."""
+    with transaction.atomic():
+        DepositSnapshot.objects.all().delete()
+        DepositSnapshot.objects.bulk_create([
+            DepositSnapshot(city_id=city_id, held=amount)
+            for city_id, amount in deposit_snapshot_by_city().items() if amount
+        ])
+
+
+# --- Пересчёт после коммита: копим города за транзакцию ---
+_pending = threading.local()
+_PENDING_SETS = ('city_ids', 'battery_ids', 'deposit_city_ids', 'deposit_rental_ids')
+
+
+def _take_pending():
+    taken = {name: getattr(_pending, name, set()) for name in _PENDING_SETS}
+    for name in _PENDING_SETS:
+        setattr(_pending, name, set())
+    return taken
+
+
+def _recount(func, city_ids):
+    try:
+        func(city_ids)
+    except IntegrityError:
+        # Параллельный пересчёт того же города — повторяем один раз по свежим данным
+        func(city_ids)
+
+
+def _flush():
+    pending = _take_pending()
+    city_ids = pending['city_ids']
+    if pending['battery_ids']:
+        city_ids |= set(Battery.objects.filter(pk__in=pending['battery_ids']).values_list('city_id', flat=True))
+    _recount(recount_cities, city_ids)
+    deposit_city_ids = pending['deposit_city_ids']
+    if pending['deposit_rental_ids']:
+        # Депозиты считаются по городу корня группы
+        deposit_city_ids |= set(
+            Rental.objects.filter(pk__in=pending['deposit_rental_ids']).values_list('root__city_id', flat=True)
+        )
+    _recount(recount_deposits, deposit_city_ids)
+
+
+def _schedule(**items):
+    for name in _PENDING_SETS:
+        if not hasattr(_pending, name):
+            setattr(_pending, name, set())
+    for name, values in items.items():
+        getattr(_pending, name).update(values)
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(entry[1] is _flush for entry in connection.run_on_commit):
+        return
+    transaction.on_commit(_flush)
+
+
+def schedule_recount(city_ids=(), battery_ids=()):
+    """Отмечает города (или города батарей) для пересчёта после коммита текущей транзакции."""
+    _schedule(city_ids=city_ids, battery_ids=[b for b in battery_ids if b])
+
+
+def schedule_deposit_recount(city_ids=(), rental_ids=()):
+    """Отмечает города (или города групп договоров) для пересчёта DepositSnapshot после коммита."""
+    _schedule(deposit_city_ids=city_ids, deposit_rental_ids=[r for r in rental_ids if r])
+
+
+# --- Чтение ---
+def status_counts(city_ids=None):
+    """{status: {'count', 'total_cost'}} по всем городам или по списку city_ids."""
+    qs = BatteryStatusCounter.objects.all()
+    if city_ids is not None:
+        qs = qs.filter(city_id__in=city_ids)
+    result = {}
+    for status, count, total_cost in qs.values_list('status', 'count', 'total_cost'):
+        item = result.setdefault(status, {'count': 0, 'total_cost': Decimal(0)})
+        item['count'] += count
+        item['total_cost'] += total_cost
+    return result
+
+
+def status_counts_by_city(city_ids):
+    """{city_id: {status: count}} для указанных городов одним запросом."""
+    result = {city_id: {} for city_id in city_ids}
+    rows = BatteryStatusCounter.objects.filter(city_id__in=city_ids).values_list('city_id', 'status', 'count')
+    for city_id, status, count in rows:
+        result.setdefault(city_id, {})[status] = count
+    return result
+
+
+def deposits_held_by_city(city_ids=None):
+    """{city_id: Decimal} депозитов на руках из DepositSnapshot (без прохода по платежам)."""
+    qs = DepositSnapshot.objects.all()
+    if city_ids is not None:
+        qs = qs.filter(city_id__in=city_ids)
+    return dict(qs.values_list('city_id', 'held'))
@@ -0,0 +1,197 @@
+"""
+Состояние парка на произвольный момент T: где была каждая батарея (город,
+клиент, договор, статус).
+
+Назначения, подтверждённые переносы и интервалы статусов (SERVICE/SOLD из
+BatteryStatusLog) загружаются один раз четырьмя запросами и раскладываются по
+батареям в отсортированные массивы. Ответ на момент T — бинарный поиск в
+массивах каждой батареи (O(B log n)), поэтому пошаговый проход по многим
+моментам (ряды для графиков утилизации) не требует новых запросов.
+
+- город: to_city последнего переноса (по моменту подтверждения approved_at)
+  не позже T; до первого переноса — его from_city; без переносов — текущий
+  город батареи. Для отчёта по городам загружаются только батареи, которые
+  сейчас в этих городах или переносились в них/из них (fleet_battery_ids);
+- аренда: назначения батареи не пересекаются (excl_assign_battery_overlap),
+  так что T покрывает только последнее назначение с началом <= T;
+- сервис/продажа: интервалы могут пересекаться, поэтому рядом с началами
+  хранится префиксный максимум концов — T покрыт, если он больше T.
+"""
+from bisect import bisect_right
+from datetime import datetime, timezone as dt_timezone
+
+from django.db.models import Q
+
+from .models import Battery, BatteryStatusLog, BatteryTransfer, RentalBatteryAssignment
+
+# Конец открытого интервала
+_OPEN = datetime.max.replace(tzinfo=dt_timezone.utc)
+
+
+class _Intervals:
+    """Интервалы одной батареи: начала по возрастанию, данные и префиксный максимум концов."""
+
+    __slots__ = ('starts', 'ends', 'items', 'max_ends')
+
+    def __init__(self):
+        self.starts, self.ends, self.items, self.max_ends = [], [], [], []
+
+    def add(self, start, end, item=None):
+        # Вызывается в порядке возрастания start
+        end = end or _OPEN
+        self.starts.append(start)
+        self.ends.append(end)
+        self.items.append(item)
+        self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+
+    def last_covering(self, at):
+        """Данные последнего начавшегося интервала, если он покрывает at."""
+        i = bisect_right(self.starts, at) - 1
+        if i >= 0 and self.ends[i] > at:
+            return self.items[i]
+        return None
+
+    def any_covering(self, at):
+        i = bisect_right(self.starts, at) - 1
+        return i >= 0 and self.max_ends[i] > at
+
+
+def fleet_battery_ids(city_ids):
+    """Батареи, которые хотя бы когда-то могли быть в городах city_ids (текущий город или переносы)."""
+    ids = set(Battery.objects.filter(city_id__in=city_ids).values_list('pk', flat=True))
+    ids |= set(
+        BatteryTransfer.objects.filter(status=BatteryTransfer.Status.APPROVED)
+        .filter(Q(from_city_id__in=city_ids) | Q(to_city_id__in=city_ids))
+        .values_list('battery_id', flat=True)
+    )
+    return ids
+
+
+def transfer_timelines(battery_ids=None):
+    """
+    Подтверждённые переносы по батареям: {battery_id: (моменты подтверждения, города)},
+    где cities[i] — город до i-го переноса, cities[-1] — после последнего.
+    """
+    transfers = BatteryTransfer.objects.filter(status=BatteryTransfer.Status.APPROVED)
+    if battery_ids is not None:
+        transfers = transfers.filter(battery_id__in=battery_ids)
+    timelines = {}
+    for t in transfers.values('battery_id', 'approved_at', 'updated_at', 'from_city_id', 'to_city_id').order_by(
+        'battery_id', 'approved_at', 'pk'
+    ):
+        times, cities = timelines.setdefault(t['battery_id'], ([], []))
+        if not cities:
+            cities.append(t['from_city_id'])
+        # approved_at заполнен для всех подтверждённых (миграция 0035); updated_at — на всякий случай
+        times.append(t['approved_at'] or t['updated_at'])
+        cities.append(t['to_city_id'])
+    return timelines
+
+
+class FleetHistory:
+    """История парка в памяти; battery_ids=None — все батареи."""
+
+    def __init__(self, battery_ids=None):
+        batteries = Battery.objects.all()
+        assignments = RentalBatteryAssignment.objects.all()
+        logs = BatteryStatusLog.objects.filter(
+            kind__in=[BatteryStatusLog.Kind.SERVICE, BatteryStatusLog.Kind.SOLD]
+        )
+        if battery_ids is not None:
+            batteries = batteries.filter(pk__in=battery_ids)
+            assignments = assignments.filter(battery_id__in=battery_ids)
+            logs = logs.filter(battery_id__in=battery_ids)
+
+        self.batteries = {
+            b['id']: b for b in batteries.values('id', 'short_code', 'city_id', 'created_at')
+        }
+        self.rentals = {}
+        for a in assignments.values(
+            'battery_id', 'start_at', 'end_at', 'rental_id', 'rental__root_id', 'rental__contract_code',
+            'rental__client_id', 'rental__client__name',
+        ).order_by('battery_id', 'start_at'):
+            self.rentals.setdefault(a['battery_id'], _Intervals()).add(a['start_at'], a['end_at'], {
+                'rental_id': a['rental_id'],
+                'root_id': a['rental__root_id'] or a['rental_id'],
+                'contract_code': a['rental__contract_code'],
+                'client_id': a['rental__client_id'],
+                'client_name': a['rental__client__name'],
+            })
+        self.service = {}
+        self.sold = {}
+        for log in logs.values('battery_id', 'kind', 'start_at', 'end_at').order_by('battery_id', 'start_at'):
+            target = self.sold if log['kind'] == BatteryStatusLog.Kind.SOLD else self.service
+            target.setdefault(log['battery_id'], _Intervals()).add(log['start_at'], log['end_at'])
+        # Переносы: моменты подтверждения и города по батарее
+        self.transfers = transfer_timelines(battery_ids)
+        # Появление батареи: created_at или первое событие, если оно раньше
+        self.first_seen = {}
+        for bid, b in self.batteries.items():
+            candidates = [b['created_at']] if b['created_at'] else []
+            for source in (self.rentals, self.service, self.sold):
+                track = source.get(bid)
+                if track:
+                    candidates.append(track.starts[0])
+            if bid in self.transfers:
+                candidates.append(self.transfers[bid][0][0])
+            self.first_seen[bid] = min(candidates) if candidates else None
+
+    def city_at(self, battery_id, at):
+        entry = self.transfers.get(battery_id)
+        if not entry:
+            return self.batteries[battery_id]['city_id']
+        times, cities = entry
+        return cities[bisect_right(times, at)]
+
+    def battery_at(self, battery_id, at):
+        """Состояние батареи на момент at или None, если её ещё не было."""
+        first_seen = self.first_seen.get(battery_id)
+        if first_seen is None or first_seen > at:
+            return None
+        rental = None
+        track = self.rentals.get(battery_id)
+        if track:
+            rental = track.last_covering(at)
+        if rental is not None:
+            status = Battery.Status.RENTED
+        elif battery_id in self.sold and self.sold[battery_id].any_covering(at):
+            status = Battery.Status.SOLD
+        elif battery_id in self.service and self.service[battery_id].any_covering(at):
+            status = Battery.Status.SERVICE
+        else:
+            status = Battery.Status.AVAILABLE
+        battery = self.batteries[battery_id]
+        return {
+            'id': battery_id,
+            'short_code': battery['short_code'],
+            'city_id': self.city_at(battery_id, at),
+            'status': status,
+            'rental': rental,
+        }
+
+    def state_at(self, at, city_ids=None):
+        """Состояния всех батарей на момент at (фильтр — по городу на момент at)."""
+        result = []
+        for battery_id in self.batteries:
+            state = self.battery_at(battery_id, at)
+            if state is None or (city_ids is not None and state['city_id'] not in city_ids):
+                continue
+            result.append(state)
+        return result
+
+    @staticmethod
+    def count(states):
+        """{city_id: {status: count}} по списку состояний."""
+        counts = {}
+        for state in states:
+            by_status = counts.setdefault(state['city_id'], {})
+            by_status[state['status']] = by_status.get(state['status'], 0) + 1
+        return counts
+
+    def counts_at(self, at, city_ids=None):
+        """{city_id: {status: count}} на момент at."""
+        return self.count(self.state_at(at, city_ids))
+
+    def series(self, moments, city_ids=None):
+        """[(момент, {city_id: {status: count}})] для последовательности моментов."""
+        return [(at, self.counts_at(at, city_ids)) for at in moments]
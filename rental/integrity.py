@@ -0,0 +1,151 @@
+"""
+Проверка согласованности назначений батарей и версий договоров.
+
+Все назначения и версии загружаются двумя запросами, дальше — сортировка
+и линейные проходы (O(n log n) в сумме, без попарных запросов):
+- двойные назначения: по (battery_id, start_at) с кучей ещё не закончившихся
+  назначений батареи; выводится каждая пересекающаяся пара;
+- дни без батарей: окно начислений версии минус объединение дневных
+  интервалов её назначений (по start_at внутри версии);
+- назначения вне окна версии: начало раньше start_at версии или конец
+  позже end_at версии (в т.ч. открытое назначение у закрытой версии).
+"""
+import heapq
+from datetime import timedelta
+
+from django.utils import timezone
+
+from . import billing
+from .models import Rental, RentalBatteryAssignment
+
+
+def _load(city_ids=None):
+    versions = Rental.objects.all()
+    assignments = RentalBatteryAssignment.objects.all()
+    if city_ids is not None:
+        versions = versions.filter(city_id__in=city_ids)
+        assignments = assignments.filter(rental__city_id__in=city_ids)
+    versions = {
+        v['id']: v
+        for v in versions.values(
+            'id', 'root_id', 'version', 'status', 'start_at', 'end_at', 'weekly_rate', 'contract_code', 'city_id',
+            'client_id', 'client__name',
+        )
+    }
+    assignments = list(
+        assignments.values('id', 'rental_id', 'battery_id', 'battery__short_code', 'start_at', 'end_at')
+    )
+    return versions, assignments
+
+
+def find_double_bookings(assignments, versions):
+    """
+    Все пары пересекающихся назначений одной батареи ([start_at, end_at), открытое — бесконечно).
+    Проход по (battery_id, start_at) с кучей ещё не закончившихся назначений батареи:
+    каждое назначение сравнивается только с пересекающимися с ним — O(n log n + пар).
+    """
+    far_future = timezone.now() + timedelta(days=365 * 100)
+    ordered = sorted(assignments, key=lambda a: (a['battery_id'], a['start_at'], a['id']))
+    issues = []
+    battery_id = None
+    running = []  # куча (конец, id, назначение) ещё открытых назначений текущей батареи
+    for a in ordered:
+        if a['battery_id'] != battery_id:
+            battery_id = a['battery_id']
+            running = []
+        while running and running[0][0] <= a['start_at']:
+            heapq.heappop(running)
+        end = a['end_at'] or far_future
+        for current_end, _id, current in sorted(running, key=lambda r: (r[2]['start_at'], r[1])):
+            first_v, second_v = versions.get(current['rental_id']), versions.get(a['rental_id'])
+            issues.append({
+                'battery_id': a['battery_id'],
+                'battery_code': a['battery__short_code'],
+                'first': current,
+                'second': a,
+                'first_rental': first_v,
+                'second_rental': second_v,
+                'same_group': bool(
+                    first_v and second_v
+                    and (first_v['root_id'] or first_v['id']) == (second_v['root_id'] or second_v['id'])
+                ),
+                'overlap_start': a['start_at'],
+                'overlap_end': min(end, current_end) if (a['end_at'] or current['end_at']) else None,
+            })
+        heapq.heappush(running, (end, a['id'], a))
+    return issues
+
+
+def find_gaps(assignments, versions, tz, now_dt):
+    """Платные версии с днями без батарей: [{'rental', 'window', 'gaps', 'gap_days', 'no_assignments'}]."""
+    by_version = {}
+    for a in sorted(assignments, key=lambda a: (a['rental_id'], a['start_at'], a['id'])):
+        by_version.setdefault(a['rental_id'], []).append(a)
+
+    issues = []
+    for v in versions.values():
+        # Бесплатные версии (пауза, бесплатные дни) без батарей — норма
+        if not v['weekly_rate']:
+            continue
+        window = billing.version_window(v, tz, now_dt)
+        if window is None:
+            continue
+        v_first, v_last = window
+        gaps = []
+        cursor = v_first  # первый ещё не покрытый день окна
+        for a in by_version.get(v['id'], []):
+            s = max(v_first, billing.first_day(a['start_at'], tz))
+            e = min(v_last, billing.last_day(a['end_at'], tz)) if a['end_at'] else v_last
+            if e < s or e < cursor:
+                continue
+            if s > cursor:
+                gaps.append((cursor, s - timedelta(days=1)))
+            cursor = e + timedelta(days=1)
+            if cursor > v_last:
+                break
+        if cursor <= v_last:
+            gaps.append((cursor, v_last))
+        if gaps:
+            issues.append({
+                'rental': v,
+                'window': window,
+                'gaps': gaps,
+                'gap_days': sum((e - s).days + 1 for s, e in gaps),
+                'no_assignments': v['id'] not in by_version,
+            })
+    return issues
+
+
+def find_outside_window(assignments, versions):
+    """Назначения, выходящие за границы своей версии."""
+    issues = []
+    for a in assignments:
+        v = versions.get(a['rental_id'])
+        if v is None:
+            continue
+        starts_early = a['start_at'] < v['start_at']
+        ends_late = bool(v['end_at']) and (a['end_at'] is None or a['end_at'] > v['end_at'])
+        if starts_early or ends_late:
+            issues.append({
+                'assignment': a,
+                'battery_code': a['battery__short_code'],
+                'rental': v,
+                'starts_early': starts_early,
+                'ends_late': ends_late,
+            })
+    issues.sort(key=lambda i: (i['rental']['root_id'] or i['rental']['id'], i['rental']['version'], i['assignment']['start_at']))
+    return issues
+
+
+def find_assignment_issues(city_ids=None, tz=None, now_dt=None):
+    """Все три вида проблем: {'double_bookings', 'gaps', 'outside_window', 'assignments', 'versions'}."""
+    tz = tz or timezone.get_current_timezone()
+    now_dt = now_dt or timezone.now()
+    versions, assignments = _load(city_ids)
+    return {
+        'double_bookings': find_double_bookings(assignments, versions),
+        'gaps': find_gaps(assignments, versions, tz, now_dt),
+        'outside_window': find_outside_window(assignments, versions),
+        'assignments': len(assignments),
+        'versions': len(versions),
+    }
@@ -0,0 +1,72 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from rental.tariffs import DEFAULT_CHUNK, apply_tariff_change, due_changes
+
+
+class Command(BaseCommand):
+    help = (
+        'Применяет запланированные смены тарифов (ScheduledTariffChange), у которых наступил effective_at: '
+        'закрывает текущие версии договоров и создаёт новые с новой ставкой, перенося батареи. '
+        'Пачками по --chunk версий, одна транзакция на пачку. Для cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=DEFAULT_CHUNK,
+            help=f'Версий договоров в одной транзакции (по умолчанию {DEFAULT_CHUNK})',
+        )
+        parser.add_argument(
+            '--change',
+            type=int,
+            action='append',
+            dest='change_ids',
+            help='ID смены тарифа (можно несколько раз). По умолчанию — все наступившие',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, сколько версий будет изменено',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести отчёт в JSON',
+        )
+
+    def handle(self, *args, **options):
+        changes = due_changes()
+        if options['change_ids']:
+            changes = changes.filter(pk__in=options['change_ids'])
+        chunk = max(options['chunk'], 1)
+
+        reports = []
+        for change in changes.select_related('created_by'):
+            if options['dry_run']:
+                report = {'versions': change.target_versions().count(), 'created': 0, 'rerated': 0, 'errors': []}
+            else:
+                report = apply_tariff_change(change, chunk)
+            reports.append({'change': change.pk, **report})
+            if options['json']:
+                continue
+            if report['errors']:
+                self.stdout.write(self.style.ERROR(
+                    f"{change}: создано версий {report['created']}, ставка изменена в {report['rerated']} "
+                    f"из {report['versions']}, ошибок в пачках: {len(report['errors'])}"
+                ))
+                for error in report['errors']:
+                    self.stdout.write(self.style.ERROR(f"  версии {error['versions'][:10]}…: {error['error']}"))
+            elif options['dry_run']:
+                self.stdout.write(f"{change}: будет изменено версий {report['versions']}")
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    f"{change}: создано версий {report['created']}, ставка изменена в {report['rerated']}"
+                ))
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, ensure_ascii=False))
+        elif not reports:
+            self.stdout.write('Наступивших смен тарифа нет.')
@@ -0,0 +1,96 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from rental.integrity import find_assignment_issues
+
+
+class Command(BaseCommand):
+    help = (
+        'Проверяет назначения батарей по всему парку: двойные назначения одной батареи, '
+        'платные версии договоров с днями без батарей и назначения вне окна своей версии. '
+        'Один проход по отсортированным интервалам, без попарных запросов.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--city',
+            type=int,
+            action='append',
+            dest='city_ids',
+            help='ID города (можно указать несколько раз). По умолчанию — все города',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести отчёт в JSON',
+        )
+
+    def handle(self, *args, **options):
+        result = find_assignment_issues(options['city_ids'])
+
+        if options['json']:
+            report = {
+                'double_bookings': [
+                    {
+                        'battery': i['battery_code'],
+                        'first_assignment': i['first']['id'],
+                        'first_rental': i['first']['rental_id'],
+                        'second_assignment': i['second']['id'],
+                        'second_rental': i['second']['rental_id'],
+                        'same_group': i['same_group'],
+                    }
+                    for i in result['double_bookings']
+                ],
+                'gaps': [
+                    {
+                        'rental': i['rental']['id'],
+                        'contract_code': i['rental']['contract_code'],
+                        'gap_days': i['gap_days'],
+                        'gaps': [[s.isoformat(), e.isoformat()] for s, e in i['gaps']],
+                        'no_assignments': i['no_assignments'],
+                    }
+                    for i in result['gaps']
+                ],
+                'outside_window': [
+                    {
+                        'assignment': i['assignment']['id'],
+                        'battery': i['battery_code'],
+                        'rental': i['rental']['id'],
+                        'starts_early': i['starts_early'],
+                        'ends_late': i['ends_late'],
+                    }
+                    for i in result['outside_window']
+                ],
+            }
+            self.stdout.write(json.dumps(report, ensure_ascii=False))
+            return
+
+        self.stdout.write(f"Проверено версий: {result['versions']}, назначений: {result['assignments']}")
+
+        for i in result['double_bookings']:
+            self.stdout.write(self.style.ERROR(
+                f"Двойное назначение батареи {i['battery_code']}: назначения {i['first']['id']} "
+                f"(договор {i['first']['rental_id']}) и {i['second']['id']} (договор {i['second']['rental_id']})"
+            ))
+        for i in result['gaps']:
+            ranges = ', '.join(f'{s:%d.%m.%Y}–{e:%d.%m.%Y}' for s, e in i['gaps'][:5])
+            self.stdout.write(self.style.WARNING(
+                f"Договор {i['rental']['id']} ({i['rental']['contract_code']}, v{i['rental']['version']}): "
+                f"дней без батарей {i['gap_days']} — {ranges}"
+            ))
+        for i in result['outside_window']:
+            where = 'начинается до версии' if i['starts_early'] else 'заканчивается после версии'
+            self.stdout.write(self.style.WARNING(
+                f"Назначение {i['assignment']['id']} (батарея {i['battery_code']}) {where} — договор {i['rental']['id']}"
+            ))
+
+        total = len(result['double_bookings']) + len(result['gaps']) + len(result['outside_window'])
+        if total:
+            self.stdout.write(self.style.ERROR(
+                f"Найдено проблем: двойных назначений {len(result['double_bookings'])}, "
+                f"версий с днями без батарей {len(result['gaps'])}, "
+                f"назначений вне окна версии {len(result['outside_window'])}"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS('Назначения батарей согласованы.'))
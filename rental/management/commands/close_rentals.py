@@ -0,0 +1,99 @@
+import json
+from datetime import date, datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from rental.closing import DEFAULT_CHUNK, active_roots, close_groups
+
+
+class Command(BaseCommand):
+    help = (
+        'Массово закрывает группы договоров (версии и открытые назначения батарей) на дату, '
+        'опционально с зачётом и возвратом депозита. '
+        'Пачками по --chunk групп, одна транзакция на пачку.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--city',
+            type=int,
+            action='append',
+            dest='city_ids',
+            help='ID города (можно несколько раз): закрыть все активные группы города',
+        )
+        parser.add_argument(
+            '--root',
+            type=int,
+            action='append',
+            dest='root_ids',
+            help='ID корня группы (можно несколько раз)',
+        )
+        parser.add_argument(
+            '--date',
+            help='Последний оплачиваемый день, YYYY-MM-DD (закрытие — следующий день 00:00). По умолчанию — сегодня',
+        )
+        parser.add_argument(
+            '--settle',
+            action='store_true',
+            help='Зачесть депозит в долг и вернуть остаток (платежи ADJUSTMENT/RETURN_DEPOSIT)',
+        )
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=DEFAULT_CHUNK,
+            help=f'Групп в одной транзакции (по умолчанию {DEFAULT_CHUNK})',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, сколько групп будет закрыто',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести отчёт в JSON',
+        )
+
+    def handle(self, *args, **options):
+        if not options['city_ids'] and not options['root_ids']:
+            raise CommandError('Укажите --city или --root')
+
+        tz = timezone.get_current_timezone()
+        if options['date']:
+            try:
+                last_day = date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError('Дата в формате YYYY-MM-DD')
+        else:
+            last_day = timezone.localdate()
+        # Как close_rental_view: введённая дата — последний оплачиваемый день
+        close_at = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time(0, 0)), tz)
+
+        root_ids = set(options['root_ids'] or [])
+        if options['city_ids']:
+            root_ids.update(active_roots(options['city_ids']))
+
+        if options['dry_run']:
+            report = {'groups': len(root_ids), 'versions': 0, 'assignments': 0, 'payments': 0, 'errors': []}
+        else:
+            report = close_groups(
+                root_ids, close_at, None, settle=options['settle'], chunk_size=max(options['chunk'], 1)
+            )
+
+        if options['json']:
+            self.stdout.write(json.dumps({'close_at': close_at.isoformat(), **report}, ensure_ascii=False))
+            return
+        if report['errors']:
+            self.stdout.write(self.style.ERROR(
+                f"Закрыто групп {report['groups']} из {len(root_ids)}, не закрыто из-за ошибок: {len(report['errors'])}"
+            ))
+            for error in report['errors']:
+                self.stdout.write(self.style.ERROR(f"  группа {error['root']}: {error['error']}"))
+        elif options['dry_run']:
+            self.stdout.write(f"Будет закрыто групп: {report['groups']} (на {close_at:%Y-%m-%d %H:%M})")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Закрыто групп {report['groups']}, версий {report['versions']}, "
+                f"назначений {report['assignments']}, платежей {report['payments']}"
+            ))
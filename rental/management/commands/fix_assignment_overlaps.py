@@ -0,0 +1,117 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+# Только сырой SQL по таблицам назначений и договоров: команда запускается и до
+# миграции 0031 (ограничение excl_assign_battery_overlap), когда модели уже
+# ссылаются на столбцы более поздних миграций
+INVERTED_SQL = """
+    SELECT id, battery_id, start_at, end_at
+    FROM rental_rentalbatteryassignment
+    WHERE end_at < start_at
+    ORDER BY battery_id, start_at, id
+"""
+
+# Пары пересекающихся назначений одной батареи: a — раньше начавшееся.
+# Перевёрнутые интервалы для сравнения схлопываются в точку (tstzrange их не принимает)
+OVERLAPS_SQL = """
+    SELECT a.id, a.battery_id, a.start_at, ra.status, b.id, b.start_at, rb.status
+    FROM rental_rentalbatteryassignment a
+    JOIN rental_rentalbatteryassignment b
+      ON a.battery_id = b.battery_id
+     AND (a.start_at, a.id) < (b.start_at, b.id)
+     AND tstzrange(a.start_at, CASE WHEN a.end_at < a.start_at THEN a.start_at ELSE a.end_at END)
+      && tstzrange(b.start_at, CASE WHEN b.end_at < b.start_at THEN b.start_at ELSE b.end_at END)
+    JOIN rental_rental ra ON ra.id = a.rental_id
+    JOIN rental_rental rb ON rb.id = b.rental_id
+    ORDER BY a.battery_id, a.start_at, a.id
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        'Подготовка данных к ограничению excl_assign_battery_overlap (миграция 0031): '
+        'перевёрнутым назначениям (end_at < start_at) ставит end_at = start_at, '
+        'а пересекающиеся назначения одной батареи обрезает — раньше начавшееся заканчивается '
+        'в момент начала следующего. По умолчанию обрезаются только пары, где оба договора '
+        'не активны (история); пары с активным договором и с одинаковым началом выводятся '
+        'для ручного исправления. Работает сырым SQL, запускать до migrate. '
+        'Изменения не попадают в историю simple_history.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, что будет исправлено',
+        )
+        parser.add_argument(
+            '--include-active',
+            action='store_true',
+            help='Обрезать и пары с активными договорами',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести отчёт в JSON',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        now = timezone.now()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(INVERTED_SQL)
+                inverted = cursor.fetchall()
+                cursor.execute(OVERLAPS_SQL)
+                pairs = cursor.fetchall()
+
+                trims = {}
+                manual = []
+                for a_id, battery_id, a_start, a_status, b_id, b_start, b_status in pairs:
+                    active = 'active' in (a_status, b_status)
+                    if b_start <= a_start or (active and not options['include_active']):
+                        manual.append((battery_id, a_id, b_id))
+                        continue
+                    if a_id not in trims or b_start < trims[a_id]:
+                        trims[a_id] = b_start
+
+                if not dry_run:
+                    if inverted:
+                        cursor.execute(
+                            'UPDATE rental_rentalbatteryassignment SET end_at = start_at, updated_at = %s '
+                            'WHERE end_at < start_at',
+                            [now],
+                        )
+                    if trims:
+                        cursor.executemany(
+                            'UPDATE rental_rentalbatteryassignment SET end_at = %s, updated_at = %s WHERE id = %s',
+                            [(end_at, now, a_id) for a_id, end_at in trims.items()],
+                        )
+
+        report = {
+            'dry_run': dry_run,
+            'inverted': [row[0] for row in inverted],
+            'trimmed': {str(a_id): end_at.isoformat() for a_id, end_at in sorted(trims.items())},
+            'manual': [{'battery': b, 'first': a_id, 'second': b_id} for b, a_id, b_id in manual],
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False))
+            return
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING('Режим dry-run: изменения не применены.'))
+        self.stdout.write(f"Перевёрнутых назначений (end_at = start_at): {len(inverted)}")
+        self.stdout.write(f"Обрезано назначений: {len(trims)}")
+        for a_id, end_at in sorted(trims.items()):
+            self.stdout.write(f"  назначение {a_id}: end_at → {timezone.localtime(end_at):%Y-%m-%d %H:%M}")
+        if manual:
+            self.stdout.write(self.style.ERROR(f"Требуют ручного исправления пар: {len(manual)}"))
+            for battery_id, a_id, b_id in manual:
+                self.stdout.write(self.style.ERROR(
+                    f"  батарея {battery_id}: назначения {a_id} и {b_id} (активный договор или одинаковое начало)"
+                ))
+        else:
+            self.stdout.write(self.style.SUCCESS('Пересечений, требующих ручного исправления, нет.'))
@@ -1,14 +1,29 @@
+import json
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 from django.db.models import Q, Exists, OuterRef
 
-from rental.models import Battery, RentalBatteryAssignment, Rental
+from rental.counters import recount_all, recount_all_deposits, schedule_recount
+from rental.models import Battery, MaintenanceRun, RentalBatteryAssignment, Rental
+
+COMMAND_NAME = 'fix_battery_status'
+# Перекрытие окна инкрементального режима: транзакции, закоммиченные позже
+# начала прошлого запуска, но с более ранним history_date, не теряются
+INCREMENTAL_OVERLAP = timedelta(minutes=5)
 
 
 class Command(BaseCommand):
     help = (
         'Исправляет статусы батарей: батареи в аренде (есть активное назначение) — RENTED, '
-        'без активного назначения и статусом RENTED — AVAILABLE. Выводит номера (short_code) исправленных батарей.'
+        'без активного назначения и статусом RENTED — AVAILABLE. Сверяет указатель текущего назначения '
+        '(current_assignment / current_rental_root / current_client) и пересчитывает счётчики по городам '
+        '(в полном режиме — и снимок депозитов по городам). '
+        'Статусы исправляются двумя UPDATE ... WHERE EXISTS, указатели — одним bulk_update, в одной транзакции. '
+        'С --incremental проверяются только батареи, чьи назначения или договоры менялись '
+        '(или начались/закончились) с прошлого запуска. Выводит номера (short_code) исправленных батарей.'
     )
 
     def add_arguments(self, parser):
@@ -17,55 +32,151 @@ class Command(BaseCommand):
             action='store_true',
             help='Только показать, какие батареи будут изменены, без записи в БД',
         )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Проверять только батареи с изменениями с прошлого запуска (для cron)',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести отчёт в JSON',
+        )
+
+    def candidate_battery_ids(self, since, now):
+        """
+        Батареи, состояние которых могло измениться в окне (since, now].
+        Диапазоны по start_at/end_at назначений идут по индексам idx_assign_start/idx_assign_end.
+        """
+        changed_rentals = Rental.history.filter(history_date__gt=since).values('id')
+        ids = set(
+            RentalBatteryAssignment.history.filter(history_date__gt=since).values_list('battery_id', flat=True)
+        )
+        ids |= set(
+            RentalBatteryAssignment.objects.filter(
+                Q(start_at__gt=since, start_at__lte=now)
+                | Q(end_at__gt=since, end_at__lte=now)
+                | Q(rental_id__in=changed_rentals)
+            ).values_list('battery_id', flat=True)
+        )
+        ids |= set(Battery.history.filter(history_date__gt=since).values_list('id', flat=True))
+        ids.discard(None)
+        return ids
 
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         now = timezone.now()
 
-        # Активное назначение: только по активному договору (ACTIVE), start_at <= now, end_at не закрыт
-        active_assignment = RentalBatteryAssignment.objects.filter(
-            battery_id=OuterRef('pk'),
-            rental__status=Rental.Status.ACTIVE,
-            start_at__lte=now,
-        ).filter(Q(end_at__isnull=True) | Q(end_at__gt=now))
-
-        # 1) В аренде (есть активное назначение), но статус не RENTED
-        rented_but_wrong = Battery.objects.filter(
-            Exists(active_assignment),
-        ).exclude(status=Battery.Status.RENTED)
-
-        fixed_to_rented = []
-        for b in rented_but_wrong:
-            fixed_to_rented.append(b.short_code)
+        with transaction.atomic():
+            # Блокировка строки запуска: параллельные запуски из cron выполняются по очереди
+            run, created = MaintenanceRun.objects.select_for_update().get_or_create(
+                command=COMMAND_NAME, defaults={'last_run_at': now}
+            )
+            incremental = options['incremental'] and not created
+            since = run.last_run_at - INCREMENTAL_OVERLAP if incremental else None
+
+            batteries = Battery.objects.all()
+            candidates = None
+            if incremental:
+                candidates = self.candidate_battery_ids(since, now)
+                batteries = batteries.filter(pk__in=candidates)
+
+            # Активное назначение: только по активному договору (ACTIVE), start_at <= now, end_at не закрыт
+            active_assignment = RentalBatteryAssignment.objects.filter(
+                battery_id=OuterRef('pk'),
+                rental__status=Rental.Status.ACTIVE,
+                start_at__lte=now,
+            ).filter(Q(end_at__isnull=True) | Q(end_at__gt=now))
+
+            # 1) В аренде (есть активное назначение), но статус не RENTED
+            rented_but_wrong = batteries.filter(Exists(active_assignment)).exclude(status=Battery.Status.RENTED)
+            # 2) Нет активного назначения, но статус RENTED (не service/sold)
+            not_rented_but_wrong = batteries.filter(status=Battery.Status.RENTED).exclude(Exists(active_assignment))
+
+            # Строки блокируются до UPDATE, чтобы отчёт совпадал с изменёнными строками
+            to_rented = dict(rented_but_wrong.select_for_update().values_list('pk', 'short_code'))
+            to_available = dict(not_rented_but_wrong.select_for_update().values_list('pk', 'short_code'))
             if not dry_run:
-                Battery.objects.filter(pk=b.pk).update(status=Battery.Status.RENTED)
+                if to_rented:
+                    rented_but_wrong.update(status=Battery.Status.RENTED)
+                if to_available:
+                    not_rented_but_wrong.update(status=Battery.Status.AVAILABLE)
 
-        # 2) Нет активного назначения, но статус RENTED (не service/sold)
-        batteries_with_active = Battery.objects.filter(Exists(active_assignment))
-        not_rented_but_wrong = Battery.objects.filter(
-            status=Battery.Status.RENTED,
-        ).exclude(pk__in=batteries_with_active)
+            # 3) Указатель текущего назначения расходится с назначениями
+            battery_ids = candidates if incremental else batteries.values_list('pk', flat=True)
+            expected_pointers = Battery.current_assignments(battery_ids, now)
+            fixed_pointers = []
+            changed = []
+            stored_pointers = batteries.values_list(
+                'pk', 'short_code', 'current_assignment_id', 'current_rental_root_id', 'current_client_id'
+            )
+            for battery_id, short_code, *pointer in stored_pointers:
+                expected = expected_pointers.get(battery_id, (None, None, None))
+                if tuple(pointer) != expected:
+                    fixed_pointers.append(short_code)
+                    changed.append(Battery(
+                        pk=battery_id,
+                        current_assignment_id=expected[0],
+                        current_rental_root_id=expected[1],
+                        current_client_id=expected[2],
+                    ))
+            if changed and not dry_run:
+                # Один UPDATE ... CASE на пачку, как в Battery.sync_current_assignment
+                Battery.objects.bulk_update(
+                    changed, ['current_assignment', 'current_rental_root', 'current_client'], batch_size=1000
+                )
+
+            report = {
+                'mode': 'incremental' if incremental else 'full',
+                'since': since.isoformat() if since else None,
+                'run_at': now.isoformat(),
+                'dry_run': dry_run,
+                'checked': len(candidates) if incremental else None,
+                'to_rented': sorted(to_rented.values()),
+                'to_available': sorted(to_available.values()),
+                'pointers': sorted(fixed_pointers),
+            }
 
-        fixed_to_available = []
-        for b in not_rented_but_wrong:
-            fixed_to_available.append(b.short_code)
             if not dry_run:
-                Battery.objects.filter(pk=b.pk).update(status=Battery.Status.AVAILABLE)
+                # 4) Счётчики батарей по (город, статус): полный режим — всё, инкрементальный — затронутые
+                if incremental:
+                    schedule_recount(battery_ids=set(to_rented) | set(to_available))
+                else:
+                    recount_all()
+                    recount_all_deposits()
+                run.last_run_at = now
+                run.report = report
+                run.save(update_fields=['last_run_at', 'report'])
+            else:
+                # dry-run ничего не записывает, включая первую запись о запуске
+                transaction.set_rollback(True)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False))
+            return
 
         if dry_run:
             self.stdout.write(self.style.WARNING('Режим dry-run: изменения не применены.'))
+        if incremental:
+            self.stdout.write(f"Инкрементальный режим с {since:%Y-%m-%d %H:%M}: проверено батарей {report['checked']}")
 
-        if fixed_to_rented:
-            msg = f"Установлен статус RENTED (были в аренде с неверным статусом): {', '.join(sorted(fixed_to_rented))}"
+        if report['to_rented']:
+            msg = f"Установлен статус RENTED (были в аренде с неверным статусом): {', '.join(report['to_rented'])}"
             self.stdout.write(self.style.SUCCESS(msg))
         else:
             self.stdout.write('Батарей с неверным статусом (должны быть RENTED): 0')
 
-        if fixed_to_available:
-            msg = f"Установлен статус AVAILABLE (не в аренде, но статус был RENTED): {', '.join(sorted(fixed_to_available))}"
+        if report['to_available']:
+            msg = f"Установлен статус AVAILABLE (не в аренде, но статус был RENTED): {', '.join(report['to_available'])}"
             self.stdout.write(self.style.SUCCESS(msg))
         else:
             self.stdout.write('Батарей с неверным статусом (должны быть AVAILABLE): 0')
 
-        if not fixed_to_rented and not fixed_to_available:
+        if report['pointers']:
+            msg = f"Исправлен указатель текущего назначения: {', '.join(report['pointers'])}"
+            self.stdout.write(self.style.SUCCESS(msg))
+        else:
+            self.stdout.write('Батарей с неверным указателем текущего назначения: 0')
+
+        if not report['to_rented'] and not report['to_available'] and not report['pointers']:
             self.stdout.write(self.style.SUCCESS('Все статусы батарей согласованы с назначениями.'))
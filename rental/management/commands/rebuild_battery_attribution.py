@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from rental.attribution import refresh_batteries
+from rental.models import Battery, RentalBatteryAssignment
+
+# Окно для --open: назначения, закончившиеся по времени (без события) с прошлого суточного запуска
+OPEN_WINDOW = timedelta(days=2)
+
+
+class Command(BaseCommand):
+    help = (
+        'Полностью пересчитывает помесячную атрибуцию выручки и ремонтов по батареям '
+        '(таблица BatteryMonthlyAttribution). Батареи обрабатываются пачками. '
+        'С --open — только батареи с незакрытыми (или только что закончившимися) назначениями: '
+        'дни и начисления идущих аренд растут без событий, запускать из cron раз в сутки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--battery',
+            type=int,
+            action='append',
+            dest='battery_ids',
+            help='ID батареи (можно указать несколько раз). По умолчанию — все батареи',
+        )
+        parser.add_argument(
+            '--open',
+            action='store_true',
+            help='Только батареи с назначениями, идущими сейчас или закончившимися за последние двое суток',
+        )
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=200,
+            help='Сколько батарей пересчитывать за одну транзакцию (по умолчанию 200)',
+        )
+
+    def handle(self, *args, **options):
+        chunk = max(options['chunk'], 1)
+        now = timezone.now()
+        if options['battery_ids']:
+            ids = options['battery_ids']
+        elif options['open']:
+            ids = sorted(set(
+                RentalBatteryAssignment.objects.filter(start_at__lte=now)
+                .filter(Q(end_at__isnull=True) | Q(end_at__gt=now - OPEN_WINDOW))
+                .values_list('battery_id', flat=True)
+            ))
+        else:
+            ids = list(Battery.objects.order_by('pk').values_list('pk', flat=True))
+
+        total_rows = 0
+        for i in range(0, len(ids), chunk):
+            total_rows += refresh_batteries(ids[i:i + chunk], now_dt=now)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Атрибуция пересчитана: батарей {len(ids)}, строк {total_rows}.'
+        ))
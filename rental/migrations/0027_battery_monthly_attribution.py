@@ -0,0 +1,34 @@
+# Minimal migration: only the BatteryMonthlyAttribution table.
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0026_add_commission_percent_and_related_transfer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatteryMonthlyAttribution',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='Первое число месяца', verbose_name='Месяц')),
+                ('battery_days', models.PositiveIntegerField(default=0, verbose_name='Дней в аренде')),
+                ('charges', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Начислено')),
+                ('payments', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Оплачено (доля)')),
+                ('repair_costs', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Ремонты')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('battery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_attribution', to='rental.battery', verbose_name='Батарея')),
+            ],
+            options={
+                'verbose_name': 'Атрибуция батареи за месяц',
+                'verbose_name_plural': 'Атрибуция батарей по месяцам',
+                'ordering': ['battery', 'month'],
+                'indexes': [models.Index(fields=['month'], name='idx_batt_attr_month')],
+                'constraints': [models.UniqueConstraint(fields=('battery', 'month'), name='uq_batt_attr_month')],
+            },
+        ),
+    ]
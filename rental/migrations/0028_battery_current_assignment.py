@@ -0,0 +1,58 @@
+# Minimal migration: denormalized current-assignment pointer on Battery + backfill.
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Q
+from django.utils import timezone
+
+
+def backfill_current_assignment(apps, schema_editor):
+    Battery = apps.get_model('rental', 'Battery')
+    RentalBatteryAssignment = apps.get_model('rental', 'RentalBatteryAssignment')
+    now = timezone.now()
+    # Как Battery.current_assignments: назначения, идущие сейчас (будущие не считаются)
+    rows = (
+        RentalBatteryAssignment.objects
+        .filter(rental__status='active', start_at__lte=now)
+        .filter(Q(end_at__isnull=True) | Q(end_at__gt=now))
+        .order_by('battery_id', '-start_at', '-id')
+        .values_list('battery_id', 'id', 'rental__root_id', 'rental_id', 'rental__client_id')
+    )
+    pointers = {}
+    for battery_id, assignment_id, root_id, rental_id, client_id in rows:
+        if battery_id not in pointers:
+            pointers[battery_id] = Battery(
+                pk=battery_id,
+                current_assignment_id=assignment_id,
+                current_rental_root_id=root_id or rental_id,
+                current_client_id=client_id,
+            )
+    Battery.objects.bulk_update(
+        list(pointers.values()), ['current_assignment', 'current_rental_root', 'current_client'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0027_battery_monthly_attribution'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battery',
+            name='current_assignment',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rental.rentalbatteryassignment'),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='current_rental_root',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rental.rental'),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='current_client',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rental.client'),
+        ),
+        migrations.RunPython(backfill_current_assignment, migrations.RunPython.noop),
+    ]
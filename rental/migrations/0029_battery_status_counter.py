@@ -0,0 +1,47 @@
+# Minimal migration: per-(city, status) battery counters + initial fill.
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_counters(apps, schema_editor):
+    Battery = apps.get_model('rental', 'Battery')
+    BatteryStatusCounter = apps.get_model('rental', 'BatteryStatusCounter')
+    rows = Battery.objects.values('city_id', 'status').annotate(count=Count('id'), total_cost=Sum('cost_price')).order_by()
+    merged = {}
+    for row in rows:
+        key = (row['city_id'], row['status'] or '')
+        count, cost = merged.get(key, (0, 0))
+        merged[key] = (count + row['count'], cost + (row['total_cost'] or 0))
+    BatteryStatusCounter.objects.bulk_create([
+        BatteryStatusCounter(city_id=city_id, status=status, count=count, total_cost=cost)
+        for (city_id, status), (count, cost) in merged.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0028_battery_current_assignment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatteryStatusCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(blank=True, max_length=16)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_cost', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('city', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='battery_counters', to='rental.city')),
+            ],
+            options={
+                'verbose_name': 'Счётчик батарей',
+                'verbose_name_plural': 'Счётчики батарей',
+                'constraints': [models.UniqueConstraint(fields=('city', 'status'), name='uq_batt_counter_city_status')],
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
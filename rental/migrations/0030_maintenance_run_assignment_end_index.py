@@ -0,0 +1,30 @@
+# Minimal migration: MaintenanceRun + index on assignment end_at.
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0029_battery_status_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaintenanceRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=64, unique=True)),
+                ('last_run_at', models.DateTimeField()),
+                ('report', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'verbose_name': 'Запуск служебной команды',
+                'verbose_name_plural': 'Запуски служебных команд',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='rentalbatteryassignment',
+            index=models.Index(fields=['end_at'], name='idx_assign_end'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Minimal migration: btree_gist + exclusion constraint against overlapping battery assignments.
+# Existing conflicts are detected first; the migration stops with a list of them.
+# The constraint covers assignments of every rental (the old admin check only looked at
+# ACTIVE ones), so historical overlaps inside closed contracts also stop it. Remediation:
+# `python manage.py fix_assignment_overlaps --dry-run`, then without --dry-run (raw SQL,
+# runs before this migration), then migrate again.
+
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+import rental.models
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations
+
+
+def check_existing_conflicts(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT id, battery_id, start_at, end_at
+            FROM rental_rentalbatteryassignment
+            WHERE end_at < start_at
+            LIMIT 50
+            """
+        )
+        inverted = cursor.fetchall()
+        cursor.execute(
+            """
+            SELECT a.battery_id, a.id, b.id
+            FROM rental_rentalbatteryassignment a
+            JOIN rental_rentalbatteryassignment b
+              ON a.battery_id = b.battery_id
+             AND a.id < b.id
+             AND tstzrange(a.start_at, CASE WHEN a.end_at < a.start_at THEN a.start_at ELSE a.end_at END)
+              && tstzrange(b.start_at, CASE WHEN b.end_at < b.start_at THEN b.start_at ELSE b.end_at END)
+            ORDER BY a.battery_id, a.id
+            LIMIT 50
+            """
+        )
+        overlaps = cursor.fetchall()
+    if not inverted and not overlaps:
+        return
+    lines = ['Найдены назначения батарей, мешающие ограничению excl_assign_battery_overlap:']
+    for assignment_id, battery_id, start_at, end_at in inverted:
+        lines.append(f'  назначение {assignment_id} (батарея {battery_id}): end_at {end_at} раньше start_at {start_at}')
+    for battery_id, first_id, second_id in overlaps:
+        lines.append(f'  батарея {battery_id}: пересекаются назначения {first_id} и {second_id}')
+    lines.append('Показано не более 50 строк каждого вида. Ограничение действует для всех договоров, включая закрытые.')
+    lines.append(
+        'Исправление: python manage.py fix_assignment_overlaps --dry-run, затем без --dry-run '
+        '(пары с активными договорами — вручную или с --include-active), и повторите migrate.'
+    )
+    raise RuntimeError('\n'.join(lines))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0030_maintenance_run_assignment_end_index'),
+    ]
+
+    operations = [
+        BtreeGistExtension(),
+        migrations.RunPython(check_existing_conflicts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='rentalbatteryassignment',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(
+                expressions=[
+                    ('battery', django.contrib.postgres.fields.ranges.RangeOperators.EQUAL),
+                    (rental.models.TsTzRange('start_at', 'end_at'), django.contrib.postgres.fields.ranges.RangeOperators.OVERLAPS),
+                ],
+                name='excl_assign_battery_overlap',
+                violation_error_message='Батарея уже занята в другом договоре на эти даты',
+            ),
+        ),
+    ]
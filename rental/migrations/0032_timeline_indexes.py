@@ -0,0 +1,61 @@
+# Minimal migration: (battery, start_at) indexes for the battery timeline and
+# unique keys of status logs created from assignments and repairs.
+# Duplicate logs (same key) are removed first, the oldest row is kept.
+
+from django.db import migrations, models
+
+
+def delete_duplicate_logs(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for column in ('rental_id', 'repair_id'):
+            cursor.execute(
+                f"""
+                DELETE FROM rental_batterystatuslog d
+                USING rental_batterystatuslog k
+                WHERE d.{column} IS NOT NULL
+                  AND d.battery_id = k.battery_id
+                  AND d.kind = k.kind
+                  AND d.{column} = k.{column}
+                  AND d.start_at = k.start_at
+                  AND d.id > k.id
+                """
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0031_assignment_no_overlap'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='repair',
+            index=models.Index(fields=['battery', 'start_at'], name='idx_repair_batt_start'),
+        ),
+        migrations.AddIndex(
+            model_name='batterystatuslog',
+            index=models.Index(fields=['battery', 'start_at'], name='idx_statuslog_batt_start'),
+        ),
+        migrations.AddIndex(
+            model_name='batterytransfer',
+            index=models.Index(fields=['battery', 'created_at'], name='idx_transfer_batt_created'),
+        ),
+        migrations.RunPython(delete_duplicate_logs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='batterystatuslog',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(rental__isnull=False),
+                fields=('battery', 'kind', 'rental', 'start_at'),
+                name='uq_statuslog_rental_key',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='batterystatuslog',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(repair__isnull=False),
+                fields=('battery', 'kind', 'repair', 'start_at'),
+                name='uq_statuslog_repair_key',
+            ),
+        ),
+    ]
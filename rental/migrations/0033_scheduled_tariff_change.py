@@ -0,0 +1,77 @@
+# Minimal migration: ScheduledTariffChange (+ history) for batch tariff changes.
+
+import django.db.models.deletion
+import simple_history.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+STATUS_CHOICES = [('pending', 'Запланирована'), ('applied', 'Применена'), ('cancelled', 'Отменена')]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rental', '0032_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTariffChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('current_weekly_rate', models.DecimalField(blank=True, decimal_places=2, help_text='Только договоры с этой текущей ставкой (пусто — любые)', max_digits=12, null=True)),
+                ('new_weekly_rate', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('effective_at', models.DateTimeField(help_text='Момент начала новой ставки')),
+                ('status', models.CharField(choices=STATUS_CHOICES, default='pending', max_length=16)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('applied_count', models.PositiveIntegerField(default=0)),
+                ('report', models.JSONField(blank=True, default=dict)),
+                ('note', models.TextField(blank=True)),
+                ('city', models.ForeignKey(blank=True, help_text='Пусто — все города', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='tariff_changes', to='rental.city')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_created', to=settings.AUTH_USER_MODEL)),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_updated', to=settings.AUTH_USER_MODEL)),
+                ('rentals', models.ManyToManyField(blank=True, help_text='Только эти договоры (пусто — все, подходящие под фильтры)', related_name='tariff_changes', to='rental.rental')),
+            ],
+            options={
+                'verbose_name': 'Смена тарифа',
+                'verbose_name_plural': 'Смены тарифов',
+                'ordering': ['-effective_at'],
+                'indexes': [models.Index(fields=['status', 'effective_at'], name='idx_tariff_change_due')],
+            },
+        ),
+        migrations.CreateModel(
+            name='HistoricalScheduledTariffChange',
+            fields=[
+                ('id', models.BigIntegerField(auto_created=True, blank=True, db_index=True, verbose_name='ID')),
+                ('created_at', models.DateTimeField(blank=True, editable=False)),
+                ('updated_at', models.DateTimeField(blank=True, editable=False)),
+                ('current_weekly_rate', models.DecimalField(blank=True, decimal_places=2, help_text='Только договоры с этой текущей ставкой (пусто — любые)', max_digits=12, null=True)),
+                ('new_weekly_rate', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('effective_at', models.DateTimeField(help_text='Момент начала новой ставки')),
+                ('status', models.CharField(choices=STATUS_CHOICES, default='pending', max_length=16)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('applied_count', models.PositiveIntegerField(default=0)),
+                ('report', models.JSONField(blank=True, default=dict)),
+                ('note', models.TextField(blank=True)),
+                ('history_id', models.AutoField(primary_key=True, serialize=False)),
+                ('history_date', models.DateTimeField(db_index=True)),
+                ('history_change_reason', models.CharField(max_length=100, null=True)),
+                ('history_type', models.CharField(choices=[('+', 'Created'), ('~', 'Changed'), ('-', 'Deleted')], max_length=1)),
+                ('city', models.ForeignKey(blank=True, db_constraint=False, help_text='Пусто — все города', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='rental.city')),
+                ('created_by', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('updated_by', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('history_user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'historical Смена тарифа',
+                'verbose_name_plural': 'historical Смены тарифов',
+                'ordering': ('-history_date', '-history_id'),
+                'get_latest_by': ('history_date', 'history_id'),
+            },
+            bases=(simple_history.models.HistoricalChanges, models.Model),
+        ),
+    ]
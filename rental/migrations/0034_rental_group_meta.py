@@ -0,0 +1,68 @@
+# Minimal migration: denormalized group metadata on the root rental
+# (group_start_at, group_end_at, latest_version, active_version, versions_count).
+# Existing groups are backfilled with one grouped UPDATE.
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_group_meta(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE rental_rental r
+            SET group_start_at = g.group_start_at,
+                group_end_at = g.group_end_at,
+                latest_version_id = g.latest_version_id,
+                active_version_id = g.active_version_id,
+                versions_count = g.versions_count
+            FROM (
+                SELECT COALESCE(root_id, id) AS group_id,
+                       MIN(start_at) AS group_start_at,
+                       CASE WHEN BOOL_OR(end_at IS NULL) THEN NULL ELSE MAX(end_at) END AS group_end_at,
+                       (ARRAY_AGG(id ORDER BY version DESC, id DESC))[1] AS latest_version_id,
+                       (ARRAY_AGG(id ORDER BY version DESC, id DESC)
+                            FILTER (WHERE status = 'active'))[1] AS active_version_id,
+                       COUNT(*) AS versions_count
+                FROM rental_rental
+                GROUP BY COALESCE(root_id, id)
+            ) g
+            WHERE r.id = g.group_id
+            """
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0033_scheduled_tariff_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rental',
+            name='group_start_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='rental',
+            name='group_end_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='rental',
+            name='latest_version',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rental.rental'),
+        ),
+        migrations.AddField(
+            model_name='rental',
+            name='active_version',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rental.rental'),
+        ),
+        migrations.AddField(
+            model_name='rental',
+            name='versions_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_group_meta, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Minimal migration: BatteryTransfer.approved_at (+ history).
+# Approved transfers are backfilled with the first history record in the
+# approved status, falling back to updated_at.
+
+from django.db import migrations, models
+
+
+def backfill_approved_at(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE rental_batterytransfer t
+            SET approved_at = COALESCE(
+                (SELECT MIN(h.history_date) FROM rental_historicalbatterytransfer h
+                 WHERE h.id = t.id AND h.status = 'approved'),
+                t.updated_at
+            )
+            WHERE t.status = 'approved'
+            """
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0034_rental_group_meta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batterytransfer',
+            name='approved_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalbatterytransfer',
+            name='approved_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_approved_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Minimal migration: per-city held deposits snapshot + initial fill.
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import DecimalField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_snapshot(apps, schema_editor):
+    Payment = apps.get_model('rental', 'Payment')
+    DepositSnapshot = apps.get_model('rental', 'DepositSnapshot')
+    zero = Value(0, output_field=DecimalField(max_digits=12, decimal_places=2))
+    rows = (
+        Payment.objects.filter(type__in=('deposit', 'return_deposit'))
+        .values('rental__root__city_id')
+        .annotate(
+            held=Coalesce(Sum('amount', filter=Q(type='deposit')), zero)
+            - Coalesce(Sum('amount', filter=Q(type='return_deposit')), zero)
+        )
+        .order_by()
+    )
+    DepositSnapshot.objects.bulk_create([
+        DepositSnapshot(city_id=row['rental__root__city_id'], held=row['held'])
+        for row in rows
+        if row['held']
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0035_batterytransfer_approved_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DepositSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('held', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('city', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='deposit_snapshots', to='rental.city')),
+            ],
+            options={
+                'verbose_name': 'Депозиты по городу',
+                'verbose_name_plural': 'Депозиты по городам',
+                'constraints': [models.UniqueConstraint(fields=('city',), name='uq_deposit_snapshot_city')],
+            },
+        ),
+        migrations.RunPython(fill_snapshot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Minimal migration: index on assignment start_at (incremental fix_battery_status window).
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rental', '0036_deposit_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rentalbatteryassignment',
+            index=models.Index(fields=['start_at'], name='idx_assign_start'),
+        ),
+    ]
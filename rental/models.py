@@ -1,7 +1,13 @@
+import re
+
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateTimeRangeField, RangeOperators
 from django.utils import timezone
 from django.db.models import Sum
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from decimal import Decimal
 from simple_history.models import HistoricalRecords
@@ -10,6 +16,11 @@ from simple_history.models import HistoricalRecords
 User = get_user_model()
 
 
+class TsTzRange(models.Func):
+    function = 'TSTZRANGE'
+    output_field = DateTimeRangeField()
+
+
 class TimeStampedModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -49,7 +60,19 @@ class Battery(TimeStampedModel):
     city = models.ForeignKey('City', on_delete=models.SET_NULL, null=True, blank=True, related_name='batteries')
     status = models.CharField(max_length=16, choices=Status.choices, blank=True, null=True)
     note = models.TextField(blank=True)
-    history = HistoricalRecords()
+    # Денормализованный указатель на текущее назначение (см. sync_current_assignment)
+    current_assignment = models.ForeignKey(
+        'RentalBatteryAssignment', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', editable=False
+    )
+    current_rental_root = models.ForeignKey(
+        'Rental', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', editable=False
+    )
+    current_client = models.ForeignKey(
+        Client, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', editable=False
+    )
+    history = HistoricalRecords(
+        excluded_fields=['current_assignment', 'current_rental_root', 'current_client']
+    )
 
     class Meta:
         verbose_name = "Батарея"
@@ -58,6 +81,60 @@ class Battery(TimeStampedModel):
     def __str__(self):
         return f"{self.short_code}"
 
+    @staticmethod
+    def current_assignments(battery_ids, now=None):
+        """
+        Текущие назначения батарей: {battery_id: (assignment_id, root_id, client_id)}.
+        Текущее — идущее в момент now (начато и не завершено) назначение активного
+        договора, как правило статуса в fix_battery_status; при нескольких берётся
+        последнее по началу. Назначения, которые начинаются или заканчиваются без
+        событий (по времени), указатель подхватывает при запуске fix_battery_status.
+        """
+        now = now or timezone.now()
+        rows = (
+            RentalBatteryAssignment.objects
+            .filter(battery_id__in=battery_ids, rental__status=Rental.Status.ACTIVE, start_at__lte=now)
+            .filter(models.Q(end_at__isnull=True) | models.Q(end_at__gt=now))
+            .order_by('battery_id', '-start_at', '-id')
+            .values_list('battery_id', 'id', 'rental__root_id', 'rental_id', 'rental__client_id')
+        )
+        result = {}
+        for battery_id, assignment_id, root_id, rental_id, client_id in rows:
+            if battery_id not in result:
+                result[battery_id] = (assignment_id, root_id or rental_id, client_id)
+        return result
+
+    @classmethod
+    def sync_current_assignment(cls, battery_ids, now=None):
+        """
+        Обновляет current_assignment / current_rental_root / current_client.
+        Вызывается из сигналов назначений и договоров (в той же транзакции);
+        изменившиеся указатели пишутся одним bulk_update (без сигналов и истории).
+        Возвращает число изменённых батарей.
+        """
+        battery_ids = {b for b in battery_ids if b}
+        if not battery_ids:
+            return 0
+        current = cls.current_assignments(battery_ids, now)
+        stored = cls.objects.filter(pk__in=battery_ids).values_list(
+            'pk', 'current_assignment_id', 'current_rental_root_id', 'current_client_id'
+        )
+        changed = []
+        for battery_id, *pointer in stored:
+            expected = current.get(battery_id, (None, None, None))
+            if tuple(pointer) != expected:
+                changed.append(cls(
+                    pk=battery_id,
+                    current_assignment_id=expected[0],
+                    current_rental_root_id=expected[1],
+                    current_client_id=expected[2],
+                ))
+        if changed:
+            cls.objects.bulk_update(
+                changed, ['current_assignment', 'current_rental_root', 'current_client'], batch_size=1000
+            )
+        return len(changed)
+
 
 class Rental(TimeStampedModel):
     class Status(models.TextChoices):
@@ -85,7 +162,16 @@ class Rental(TimeStampedModel):
     version = models.PositiveIntegerField(default=1)
     contract_code = models.CharField(max_length=64, blank=True, help_text="Общий номер договора для всей группы (root)")
 
-    history = HistoricalRecords()
+    # Сводка по группе — заполняется только у root (Rental.refresh_group_meta)
+    group_start_at = models.DateTimeField(null=True, blank=True, editable=False)
+    group_end_at = models.DateTimeField(null=True, blank=True, editable=False)
+    latest_version = models.ForeignKey("self", null=True, blank=True, on_delete=models.SET_NULL, related_name="+", editable=False)
+    active_version = models.ForeignKey("self", null=True, blank=True, on_delete=models.SET_NULL, related_name="+", editable=False)
+    versions_count = models.PositiveIntegerField(default=0, editable=False)
+
+    history = HistoricalRecords(
+        excluded_fields=['group_start_at', 'group_end_at', 'latest_version', 'active_version', 'versions_count']
+    )
 
     class Meta:
         verbose_name = "Аренда"
@@ -230,6 +316,80 @@ class Rental(TimeStampedModel):
         root = self.root or self
         return Rental.objects.filter(root=root).order_by("start_at", "id")
 
+    @classmethod
+    def refresh_group_meta(cls, root_ids):
+        """
+        Пересчитывает сводку групп на root: group_start_at, group_end_at (None — есть
+        открытая версия), latest_version, active_version (последняя ACTIVE по номеру),
+        versions_count. Один запрос по версиям групп; .update() только изменившихся
+        корней (без сигналов и истории). Возвращает число обновлённых корней.
+        """
+        root_ids = {r for r in root_ids if r}
+        if not root_ids:
+            return 0
+        rows = cls.objects.filter(models.Q(root_id__in=root_ids) | models.Q(pk__in=root_ids)).values_list(
+            'pk', 'root_id', 'version', 'status', 'start_at', 'end_at',
+            'group_start_at', 'group_end_at', 'latest_version_id', 'active_version_id', 'versions_count',
+        )
+        groups = {}
+        stored = {}
+        for pk, root_id, version, status, start_at, end_at, *meta in rows:
+            group_id = root_id or pk
+            if group_id not in root_ids:
+                continue
+            if pk == group_id:
+                stored[pk] = tuple(meta)
+            g = groups.setdefault(group_id, {
+                'start': start_at, 'end': end_at, 'open': False, 'count': 0, 'latest': None, 'active': None,
+            })
+            g['start'] = min(g['start'], start_at)
+            if end_at is None:
+                g['open'] = True
+            elif g['end'] is None or end_at > g['end']:
+                g['end'] = end_at
+            g['count'] += 1
+            key = (version, pk)
+            if g['latest'] is None or key > g['latest']:
+                g['latest'] = key
+            if status == cls.Status.ACTIVE and (g['active'] is None or key > g['active']):
+                g['active'] = key
+
+        changed = 0
+        for group_id, g in groups.items():
+            expected = (
+                g['start'],
+                None if g['open'] else g['end'],
+                g['latest'][1],
+                g['active'][1] if g['active'] else None,
+                g['count'],
+            )
+            if stored.get(group_id) != expected:
+                cls.objects.filter(pk=group_id).update(
+                    group_start_at=expected[0],
+                    group_end_at=expected[1],
+                    latest_version_id=expected[2],
+                    active_version_id=expected[3],
+                    versions_count=expected[4],
+                )
+                changed += 1
+        return changed
+
+    @classmethod
+    def next_version_number(cls, root_id):
+        """
+        Блокирует строку root (select_for_update) и возвращает номер следующей версии
+        группы по latest_version — параллельные создания версий идут по очереди.
+        """
+        latest = cls.objects.select_for_update(of=('self',)).filter(pk=root_id).values_list(
+            'latest_version__version', flat=True
+        ).first()
+        if latest is None:
+            # Сводка ещё не заполнена (root только что создан)
+            latest = cls.objects.filter(models.Q(root_id=root_id) | models.Q(pk=root_id)).aggregate(
+                last=models.Max('version')
+            )['last'] or 0
+        return latest + 1
+
     def group_charges_until(self, until: timezone.datetime | None = None) -> Decimal:
         """Sum of charges across all versions in the group (root)."""
         # #region agent log
@@ -355,9 +515,11 @@ class Rental(TimeStampedModel):
                 }, ensure_ascii=False) + '\n')
         except: pass
         # #endregion
-        paid = self.group_payments().filter(type=Payment.PaymentType.DEPOSIT).aggregate(s=Sum("amount"))['s'] or Decimal(0)
-        returned = self.group_payments().filter(type=Payment.PaymentType.RETURN_DEPOSIT).aggregate(s=Sum("amount"))['s'] or Decimal(0)
-        result = paid - returned
+        totals = self.group_payments().aggregate(
+            paid=Sum("amount", filter=models.Q(type=Payment.PaymentType.DEPOSIT)),
+            returned=Sum("amount", filter=models.Q(type=Payment.PaymentType.RETURN_DEPOSIT)),
+        )
+        result = (totals['paid'] or Decimal(0)) - (totals['returned'] or Decimal(0))
         # #region agent log
         try:
             elapsed = (time_module.time() - start_time) * 1000
@@ -384,6 +546,11 @@ class Rental(TimeStampedModel):
 
 
 
+# Текст нарушения excl_assign_battery_overlap при проверке модели (validate_constraints
+# заменяет его на overlap_message с номером батареи)
+OVERLAP_VIOLATION_MESSAGE = "Батарея уже занята в другом договоре на эти даты"
+
+
 class RentalBatteryAssignment(TimeStampedModel):
     rental = models.ForeignKey(Rental, on_delete=models.CASCADE, related_name="assignments")
     battery = models.ForeignKey(Battery, on_delete=models.PROTECT, related_name="assignments")
@@ -426,8 +593,82 @@ class RentalBatteryAssignment(TimeStampedModel):
         ordering = ["start_at", "id"]
         indexes = [
             models.Index(fields=["battery", "start_at"], name="idx_assign_batt_start"),
+            models.Index(fields=["end_at"], name="idx_assign_end"),
+            # Начавшиеся в окне назначения (fix_battery_status --incremental)
+            models.Index(fields=["start_at"], name="idx_assign_start"),
+        ]
+        constraints = [
+            # Батарея не может быть в двух назначениях одновременно: полуинтервалы [start_at, end_at)
+            ExclusionConstraint(
+                name="excl_assign_battery_overlap",
+                expressions=[
+                    ("battery", RangeOperators.EQUAL),
+                    (TsTzRange("start_at", "end_at"), RangeOperators.OVERLAPS),
+                ],
+                violation_error_message=OVERLAP_VIOLATION_MESSAGE,
+            ),
         ]
 
+    def validate_constraints(self, exclude=None):
+        # Форма (inline) получает тот же текст, что change_batteries_view и carry_over_assignments
+        try:
+            super().validate_constraints(exclude=exclude)
+        except ValidationError as exc:
+            if not hasattr(exc, 'error_dict'):
+                raise
+            battery = Battery.objects.filter(pk=self.battery_id).first() if self.battery_id else None
+            raise ValidationError({
+                field: [
+                    self.overlap_message(battery) if OVERLAP_VIOLATION_MESSAGE in error.messages else error
+                    for error in errors
+                ]
+                for field, errors in exc.error_dict.items()
+            })
+
+    @staticmethod
+    def overlap_message(battery):
+        if battery is None:
+            return "Батарея уже занята в другом договоре"
+        return f"Батарея {battery.short_code} уже занята в другом договоре"
+
+    @classmethod
+    def current_batteries(cls, rental_ref='pk', now=None):
+        """
+        Аннотации текущих батарей договора для .annotate(**...): current_battery_codes
+        (StringAgg коротких кодов через ", " или None) и current_batteries_count.
+        Коррелированные подзапросы только по активным назначениям — считаются лишь
+        для выбранных строк (страницы списка). rental_ref — поле договора во внешнем
+        запросе: 'pk' для Rental, 'rental_id' для Payment.
+        """
+        now = now or timezone.now()
+        active = cls.objects.filter(rental_id=models.OuterRef(rental_ref), start_at__lte=now).filter(
+            models.Q(end_at__isnull=True) | models.Q(end_at__gt=now)
+        ).order_by().values('rental_id')
+        return {
+            'current_battery_codes': models.Subquery(
+                active.annotate(codes=StringAgg('battery__short_code', ', ', ordering=('start_at', 'id'))).values('codes'),
+                output_field=models.TextField(),
+            ),
+            'current_batteries_count': Coalesce(
+                models.Subquery(active.annotate(n=models.Count('id')).values('n')), 0
+            ),
+        }
+
+    @staticmethod
+    def overlap_error(exc):
+        """
+        ValidationError для нарушения excl_assign_battery_overlap (IntegrityError из БД)
+        с тем же текстом, что и проверки в admin; None — если это другая ошибка.
+        """
+        diag = getattr(exc.__cause__ or exc, 'diag', None)
+        constraint = getattr(diag, 'constraint_name', None) or str(exc)
+        if 'excl_assign_battery_overlap' not in constraint:
+            return None
+        detail = getattr(diag, 'message_detail', None) or str(exc)
+        match = re.search(r'\(battery_id, tstzrange\(start_at, end_at\)\)=\((\d+),', detail)
+        battery = Battery.objects.filter(pk=match.group(1)).first() if match else None
+        return ValidationError(RentalBatteryAssignment.overlap_message(battery))
+
 
 class Payment(TimeStampedModel):
     class PaymentType(models.TextChoices):
@@ -557,6 +798,9 @@ class Repair(TimeStampedModel):
     class Meta:
         verbose_name = "Ремонт"
         verbose_name_plural = "Ремонты"
+        indexes = [
+            models.Index(fields=["battery", "start_at"], name="idx_repair_batt_start"),
+        ]
 
 
 class BatteryStatusLog(TimeStampedModel):
@@ -577,6 +821,175 @@ class BatteryStatusLog(TimeStampedModel):
     class Meta:
         verbose_name = "Лог статуса батареи"
         verbose_name_plural = "Логи статусов батарей"
+        indexes = [
+            models.Index(fields=["battery", "start_at"], name="idx_statuslog_batt_start"),
+        ]
+        # Ключи get_or_create/upsert из сигналов назначений и ремонтов
+        constraints = [
+            models.UniqueConstraint(
+                fields=["battery", "kind", "rental", "start_at"],
+                condition=models.Q(rental__isnull=False),
+                name="uq_statuslog_rental_key",
+            ),
+            models.UniqueConstraint(
+                fields=["battery", "kind", "repair", "start_at"],
+                condition=models.Q(repair__isnull=False),
+                name="uq_statuslog_repair_key",
+            ),
+        ]
+
+
+class BatteryMonthlyAttribution(models.Model):
+    """
+    Помесячная атрибуция выручки и затрат на батарею (производная таблица).
+    Пересчитывается инкрементально сигналами (rental.attribution) и полностью
+    командой rebuild_battery_attribution.
+    """
+    battery = models.ForeignKey(Battery, on_delete=models.CASCADE, related_name="monthly_attribution", verbose_name="Батарея")
+    month = models.DateField("Месяц", help_text="Первое число месяца")
+    battery_days = models.PositiveIntegerField("Дней в аренде", default=0)
+    charges = models.DecimalField("Начислено", max_digits=12, decimal_places=2, default=0)
+    payments = models.DecimalField("Оплачено (доля)", max_digits=12, decimal_places=2, default=0)
+    repair_costs = models.DecimalField("Ремонты", max_digits=12, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Атрибуция батареи за месяц"
+        verbose_name_plural = "Атрибуция батарей по месяцам"
+        ordering = ["battery", "month"]
+        constraints = [
+            models.UniqueConstraint(fields=["battery", "month"], name="uq_batt_attr_month"),
+        ]
+        indexes = [
+            models.Index(fields=["month"], name="idx_batt_attr_month"),
+        ]
+
+    def __str__(self):
+        return f"{self.battery} {self.month:%Y-%m}"
+
+
+class BatteryStatusCounter(models.Model):
+    """
+    Число и себестоимость батарей по (город, статус) — производная таблица.
+    Пересчитывается по затронутым городам после коммита (rental.counters);
+    полный пересчёт — fix_battery_status.
+    """
+    city = models.ForeignKey('City', on_delete=models.CASCADE, null=True, blank=True, related_name='battery_counters')
+    # Пустая строка — батареи без статуса
+    status = models.CharField(max_length=16, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    total_cost = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Счётчик батарей"
+        verbose_name_plural = "Счётчики батарей"
+        constraints = [
+            models.UniqueConstraint(fields=["city", "status"], name="uq_batt_counter_city_status"),
+        ]
+
+    def __str__(self):
+        return f"{self.city_id or '-'} {self.status or '-'}: {self.count}"
+
+
+class DepositSnapshot(models.Model):
+    """
+    Депозиты на руках (депозиты минус возвраты) по городу корня группы — производная
+    таблица для dashboard. Пересчитывается по затронутым городам после коммита
+    (rental.counters) из сигналов платежей и договоров; полный пересчёт — fix_battery_status.
+    """
+    city = models.ForeignKey('City', on_delete=models.CASCADE, null=True, blank=True, related_name='deposit_snapshots')
+    held = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Депозиты по городу"
+        verbose_name_plural = "Депозиты по городам"
+        constraints = [
+            models.UniqueConstraint(fields=["city"], name="uq_deposit_snapshot_city"),
+        ]
+
+    def __str__(self):
+        return f"{self.city_id or '-'}: {self.held}"
+
+
+class MaintenanceRun(models.Model):
+    """Последний успешный запуск служебной команды (для инкрементальных режимов)."""
+    command = models.CharField(max_length=64, unique=True)
+    last_run_at = models.DateTimeField()
+    report = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        verbose_name = "Запуск служебной команды"
+        verbose_name_plural = "Запуски служебных команд"
+
+    def __str__(self):
+        return f"{self.command} @ {self.last_run_at:%Y-%m-%d %H:%M}"
+
+
+class ScheduledTariffChange(TimeStampedModel):
+    """
+    Запланированная смена тарифа для группы договоров. Команда
+    apply_tariff_changes в момент effective_at закрывает текущие активные
+    версии выбранных договоров и создаёт новые с new_weekly_rate (пачками);
+    более поздним платным версиям ставка меняется на месте.
+    """
+    class Status(models.TextChoices):
+        PENDING = "pending", "Запланирована"
+        APPLIED = "applied", "Применена"
+        CANCELLED = "cancelled", "Отменена"
+
+    city = models.ForeignKey('City', on_delete=models.PROTECT, null=True, blank=True, related_name='tariff_changes',
+                             help_text="Пусто — все города")
+    current_weekly_rate = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True,
+                                              help_text="Только договоры с этой текущей ставкой (пусто — любые)")
+    rentals = models.ManyToManyField('Rental', blank=True, related_name='tariff_changes',
+                                     help_text="Только эти договоры (пусто — все, подходящие под фильтры)")
+    new_weekly_rate = models.DecimalField(max_digits=12, decimal_places=2)
+    effective_at = models.DateTimeField(help_text="Момент начала новой ставки")
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    applied_at = models.DateTimeField(null=True, blank=True)
+    applied_count = models.PositiveIntegerField(default=0)
+    report = models.JSONField(default=dict, blank=True)
+    note = models.TextField(blank=True)
+    history = HistoricalRecords()
+
+    class Meta:
+        verbose_name = "Смена тарифа"
+        verbose_name_plural = "Смены тарифов"
+        ordering = ['-effective_at']
+        indexes = [
+            models.Index(fields=['status', 'effective_at'], name='idx_tariff_change_due'),
+        ]
+
+    def clean(self):
+        if self.new_weekly_rate is not None and self.new_weekly_rate < 0:
+            raise ValidationError("Ставка не может быть отрицательной")
+
+    def target_versions(self):
+        """
+        Активные платные версии, подпадающие под фильтры и действующие после effective_at:
+        идущие на effective_at (закрываются, продолжение — с новой ставкой) и начинающиеся
+        позже (например, платная версия после бесплатных дней — ставка меняется на месте).
+        Версии с нулевой ставкой (бесплатные дни) не трогаются.
+        """
+        qs = Rental.objects.filter(status=Rental.Status.ACTIVE).filter(
+            models.Q(end_at__isnull=True) | models.Q(end_at__gt=self.effective_at)
+        ).exclude(weekly_rate=self.new_weekly_rate).exclude(weekly_rate=0)
+        if self.city_id:
+            qs = qs.filter(city_id=self.city_id)
+        if self.current_weekly_rate is not None:
+            qs = qs.filter(weekly_rate=self.current_weekly_rate)
+        if self.pk and self.rentals.exists():
+            # Выбрать можно любую версию договора — берётся вся группа
+            roots = self.rentals.annotate(
+                group_id=Coalesce('root_id', 'id')
+            ).values('group_id')
+            qs = qs.filter(models.Q(root_id__in=roots) | models.Q(pk__in=roots))
+        return qs
+
+    def __str__(self):
+        return f"{self.new_weekly_rate} PLN/нед. с {timezone.localtime(self.effective_at):%d.%m.%Y %H:%M}"
 
 
 class BatteryTransfer(TimeStampedModel):
@@ -590,6 +1003,8 @@ class BatteryTransfer(TimeStampedModel):
     to_city = models.ForeignKey('City', on_delete=models.PROTECT, related_name="transfers_to")
     requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name="transfer_requests")
     approved_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="approved_transfers")
+    # Момент подтверждения (момент переноса для истории парка); updated_at меняют и поздние правки
+    approved_at = models.DateTimeField(null=True, blank=True, editable=False)
     status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
     note = models.TextField(blank=True, verbose_name="Комментарий")
     history = HistoricalRecords()
@@ -601,6 +1016,7 @@ class BatteryTransfer(TimeStampedModel):
         indexes = [
             models.Index(fields=['status', 'created_at']),
             models.Index(fields=['battery', 'status']),
+            models.Index(fields=['battery', 'created_at'], name='idx_transfer_batt_created'),
         ]
     
     def clean(self):
@@ -610,114 +1026,104 @@ class BatteryTransfer(TimeStampedModel):
     
     def approve(self, approved_by_user):
         """Подтверждает перенос и меняет city батареи"""
+        approved, errors = BatteryTransfer.approve_many([self.pk], approved_by_user)
+        if self.pk in errors:
+            raise ValidationError(errors[self.pk])
+        transfer = approved[0]
+        self.status = transfer.status
+        self.approved_by = transfer.approved_by
+        self.approved_at = transfer.approved_at
+        self.updated_at = transfer.updated_at
+        self.battery.refresh_from_db(fields=['city'])
+
+    @classmethod
+    def approve_many(cls, transfer_ids, approved_by_user):
+        """
+        Подтверждает переносы пачкой в одной транзакции.
+
+        Переносы и их батареи блокируются select_for_update, активная аренда
+        проверяется по назначениям на текущий момент (Battery.current_assignments,
+        один запрос — указатель мог устареть по времени), города
+        батарей меняются одним bulk UPDATE, переносы сохраняются bulk_update;
+        историю обоих пишет simple_history. Возвращает (подтверждённые
+        переносы, {transfer_id: текст ошибки}) — ошибки не откатывают остальные.
+        """
         import logging
-        import traceback
-        
+        from django.db import transaction
+        from simple_history.utils import bulk_update_with_history
+        from .counters import schedule_recount
+
         logger = logging.getLogger('rental')
-        
-        try:
-            logger.debug(f"BatteryTransfer.approve() вызван для transfer_id={self.id}, battery={self.battery.short_code if self.battery else None}, from_city={self.from_city.name if self.from_city else None}, to_city={self.to_city.name if self.to_city else None}")
-            
-            if self.status != self.Status.PENDING:
-                raise ValidationError("Можно подтвердить только запросы в статусе PENDING")
-            
-            # Проверяем наличие необходимых объектов
-            if not self.battery:
-                raise ValueError(f"У переноса {self.id} отсутствует батарея")
-            if not self.from_city:
-                raise ValueError(f"У переноса {self.id} отсутствует город отправления")
-            if not self.to_city:
-                raise ValueError(f"У переноса {self.id} отсутствует город назначения")
-            
-            # Проверка: from_city должен совпадать с текущим city батареи
-            if self.battery.city and self.from_city and self.battery.city.id != self.from_city.id:
-                logger.warning(f"Несоответствие городов для переноса {self.id}: батарея в городе {self.battery.city.name}, запрос из {self.from_city.name}")
-                raise ValidationError(
-                    f"Город отправления ({self.from_city.name}) не совпадает с текущим городом батареи "
-                    f"({self.battery.city.name}). Батарея могла быть перенесена другим запросом."
+        transfer_ids = list(transfer_ids)
+        errors = {}
+        approved = []
+        now = timezone.now()
+
+        with transaction.atomic():
+            transfers = list(
+                cls.objects.select_for_update(of=('self',))
+                .select_related('from_city', 'to_city')
+                .filter(pk__in=transfer_ids)
+                .order_by('created_at', 'pk')
+            )
+            batteries = {
+                b.pk: b
+                for b in Battery.objects.select_for_update().filter(
+                    pk__in={t.battery_id for t in transfers}
                 )
-            
-            # Проверка активной аренды перед подтверждением
-            from django.db.models import Q
-            now = timezone.now()
-            active_assignments = RentalBatteryAssignment.objects.filter(
-                battery=self.battery,
-                start_at__lte=now
-            ).filter(
-                Q(end_at__isnull=True) | Q(end_at__gt=now)
-            ).filter(
-                rental__status=Rental.Status.ACTIVE
-            ).exists()
-            
-            logger.debug(f"Проверка активной аренды для батареи {self.battery.short_code}: {active_assignments}")
-            
-            if active_assignments:
-                raise ValidationError(f"Батарея {self.battery.short_code} находится в активной аренде. Перенос невозможен.")
-            
-            # Выполняем перенос в транзакции
-            from django.db import transaction
-            
-            old_city = self.battery.city
-            old_city_id = self.battery.city_id if self.battery.city else None
-            old_city_name = old_city.name if old_city else 'None'
-            
-            logger.info(f"Начало переноса: transfer_id={self.id}, battery_id={self.battery.id}, battery={self.battery.short_code}, old_city_id={old_city_id}, old_city_name={old_city_name}, new_city_id={self.to_city.id}, new_city_name={self.to_city.name}")
-            
-            with transaction.atomic():
-                # Проверяем текущее состояние батареи ДО обновления
-                battery_id = self.battery.id
-                battery_before = Battery.objects.filter(id=battery_id).values('id', 'city_id', 'short_code').first()
-                logger.info(f"Состояние батареи ДО обновления: {battery_before}")
-                
-                # Обновляем статус и approved_by
-                self.status = self.Status.APPROVED
-                self.approved_by = approved_by_user
-                
-                # Меняем город батареи напрямую через QuerySet.update() используя city_id вместо объекта
-                to_city_id = self.to_city.id
-                updated_by_id = approved_by_user.id if approved_by_user else None
-                
-                logger.info(f"Выполнение UPDATE: battery_id={battery_id}, city_id={to_city_id}, updated_by_id={updated_by_id}")
-                
-                # Выполняем обновление с использованием city_id
-                updated_count = Battery.objects.filter(id=battery_id).update(
-                    city_id=to_city_id,
-                    updated_by_id=updated_by_id
+            }
+            in_rent = Battery.current_assignments(batteries, now)
+            found = {t.pk for t in transfers}
+            for transfer_id in transfer_ids:
+                if transfer_id not in found:
+                    errors[transfer_id] = "Запрос на перенос не найден"
+
+            moved = {}
+            for transfer in transfers:
+                battery = batteries.get(transfer.battery_id)
+                if transfer.status != cls.Status.PENDING:
+                    errors[transfer.pk] = "Можно подтвердить только запросы в статусе PENDING"
+                elif battery is None:
+                    errors[transfer.pk] = f"У переноса {transfer.pk} отсутствует батарея"
+                elif transfer.from_city_id == transfer.to_city_id:
+                    errors[transfer.pk] = "Город назначения должен отличаться от текущего города"
+                elif battery.city_id and battery.city_id != transfer.from_city_id:
+                    # В т.ч. второй перенос той же батареи в одной пачке
+                    errors[transfer.pk] = (
+                        f"Город отправления ({transfer.from_city.name}) не совпадает с текущим городом батареи. "
+                        f"Батарея могла быть перенесена другим запросом."
+                    )
+                elif battery.pk in in_rent:
+                    errors[transfer.pk] = f"Батарея {battery.short_code} находится в активной аренде. Перенос невозможен."
+                if transfer.pk in errors:
+                    continue
+                battery.city_id = transfer.to_city_id
+                battery.updated_by = approved_by_user
+                battery.updated_at = now
+                moved[battery.pk] = battery
+                transfer.status = cls.Status.APPROVED
+                transfer.approved_by = approved_by_user
+                transfer.approved_at = now
+                transfer.updated_at = now
+                approved.append(transfer)
+
+            if approved:
+                bulk_update_with_history(
+                    list(moved.values()), Battery, ['city', 'updated_by', 'updated_at'],
+                    default_user=approved_by_user,
                 )
-                
-                logger.info(f"Результат update(): updated_count={updated_count}, battery_id={battery_id}")
-                
-                if updated_count != 1:
-                    logger.error(f"ОШИБКА: Обновлено {updated_count} записей вместо 1 для батареи {battery_id}")
-                    raise ValueError(f"Не удалось обновить город батареи: обновлено {updated_count} записей")
-                
-                # Проверяем состояние батареи ПОСЛЕ обновления через прямой SQL запрос
-                battery_after = Battery.objects.filter(id=battery_id).values('id', 'city_id', 'short_code').first()
-                logger.info(f"Состояние батареи ПОСЛЕ update(): {battery_after}")
-                
-                # Перезагружаем батарею из БД для обновления объекта в памяти
-                self.battery.refresh_from_db()
-                actual_city_id = self.battery.city_id
-                actual_city_name = self.battery.city.name if self.battery.city else 'None'
-                
-                logger.info(f"После refresh_from_db(): battery.city_id={actual_city_id}, battery.city={actual_city_name}")
-                
-                if actual_city_id != to_city_id:
-                    logger.error(f"ОШИБКА: Город батареи не изменился после update()! Ожидался city_id={to_city_id}, но получили {actual_city_id}")
-                    logger.error(f"Детали: battery_before={battery_before}, battery_after={battery_after}")
-                    raise ValueError(f"Не удалось изменить город батареи: ожидался {self.to_city.name} (id={to_city_id}), но остался {actual_city_name} (id={actual_city_id})")
-                
-                # Сохраняем перенос
-                self.save()
-                
-                logger.info(f"Перенос {self.id} успешно подтверждён: батарея {self.battery.short_code} перенесена из {old_city_name} в {self.to_city.name}")
-            
-        except (ValidationError, ValueError) as e:
-            logger.error(f"Ошибка валидации при подтверждении переноса {self.id}: {str(e)}\n{traceback.format_exc()}")
-            raise
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при подтверждении переноса {self.id}: {str(e)}\n{traceback.format_exc()}")
-            raise ValidationError(f"Ошибка при подтверждении переноса: {str(e)}")
+                bulk_update_with_history(
+                    approved, cls, ['status', 'approved_by', 'approved_at', 'updated_at'],
+                    default_user=approved_by_user,
+                )
+                # bulk_update не отправляет post_save — счётчики городов отмечаем сами
+                schedule_recount(city_ids={t.from_city_id for t in approved} | {t.to_city_id for t in approved})
+
+        logger.info(
+            f"Подтверждено переносов: {len(approved)}, ошибок: {len(errors)} "
+            f"(пользователь {getattr(approved_by_user, 'pk', None)})"
+        )
+        return approved, errors
     
     def reject(self, rejected_by_user, reason=""):
         """Отклоняет запрос на перенос"""
@@ -1,4 +1,4 @@
-from django.db.models.signals import post_migrate, post_save, post_delete
+from django.db.models.signals import post_migrate, post_save, post_delete, pre_save
 from django.conf import settings
 from django.utils import timezone
 
@@ -14,7 +14,14 @@ from .models import (
     Expense,
     OwnerContribution,
     FinancePartner,
+    Payment,
+    Rental,
+    BatteryTransfer,
 )
+from .assignment_effects import assignments_deleted, assignments_saved
+from .attribution import schedule_refresh
+from .billing import DEPOSIT_TYPES
+from .counters import schedule_deposit_recount, schedule_recount
 
 
 @receiver(post_migrate)
@@ -33,43 +40,92 @@ def create_groups(sender, **kwargs):
 
 
 # --- BatteryStatusLog automation ---
+# Лог RENTED, статус батареи, указатель текущего назначения, счётчики и атрибуция —
+# в rental.assignment_effects (внутри batch_assignment_effects применяются пакетом)
 @receiver(post_save, sender=RentalBatteryAssignment)
 def assignment_to_statuslog(sender, instance: RentalBatteryAssignment, created, **kwargs):
-    # Upsert RENTED status for this assignment
-    log, _ = BatteryStatusLog.objects.get_or_create(
-        battery=instance.battery,
-        kind=BatteryStatusLog.Kind.RENTED,
-        rental=instance.rental,
-        start_at=instance.start_at,
-        defaults={
-            'end_at': instance.end_at,
-            'created_by': getattr(instance, 'created_by', None),
-            'updated_by': getattr(instance, 'updated_by', None),
-        }
-    )
-    changed = False
-    if log.end_at != instance.end_at:
-        log.end_at = instance.end_at
-        changed = True
-    if changed:
-        log.save(update_fields=['end_at'])
-
-    # Синхронизация Battery.status при добавлении/сохранении назначения
-    if instance.battery_id:
-        Battery.objects.filter(pk=instance.battery_id).update(status=Battery.Status.RENTED)
+    assignments_saved([instance])
 
 
 @receiver(post_delete, sender=RentalBatteryAssignment)
 def assignment_delete_statuslog(sender, instance: RentalBatteryAssignment, **kwargs):
-    BatteryStatusLog.objects.filter(
-        battery=instance.battery,
-        kind=BatteryStatusLog.Kind.RENTED,
-        rental=instance.rental,
-        start_at=instance.start_at,
-    ).delete()
-    # Освобождаем батарею при удалении назначения
-    if instance.battery_id:
-        Battery.objects.filter(pk=instance.battery_id).update(status=Battery.Status.AVAILABLE)
+    assignments_deleted([instance])
+
+
+# --- Указатель текущего назначения на Battery ---
+@receiver(post_save, sender=Rental)
+def rental_sync_current_pointer(sender, instance: Rental, created, **kwargs):
+    # Смена статуса договора (закрытие/модификация) освобождает или занимает батареи
+    if created:
+        return
+    Battery.sync_current_assignment(
+        RentalBatteryAssignment.objects.filter(rental=instance).values_list('battery_id', flat=True)
+    )
+
+
+# --- Сводка группы на root (group_start_at, latest/active_version, versions_count) ---
+@receiver(post_save, sender=Rental)
+@receiver(post_delete, sender=Rental)
+def rental_refresh_group_meta(sender, instance: Rental, **kwargs):
+    # В той же транзакции, что и создание/закрытие версии
+    Rental.refresh_group_meta([instance.root_id or instance.pk])
+
+
+# --- Счётчики батарей по (город, статус) ---
+@receiver(pre_save, sender=Battery)
+def battery_remember_city(sender, instance: Battery, **kwargs):
+    instance._counter_old_city_id = (
+        Battery.objects.filter(pk=instance.pk).values_list('city_id', flat=True).first()
+        if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Battery)
+@receiver(post_delete, sender=Battery)
+def battery_recount_counters(sender, instance: Battery, **kwargs):
+    schedule_recount(city_ids={instance.city_id, getattr(instance, '_counter_old_city_id', instance.city_id)})
+
+
+@receiver(post_save, sender=BatteryTransfer)
+def transfer_recount_counters(sender, instance: BatteryTransfer, **kwargs):
+    # Подтверждённый перенос, сохранённый через save() (approve_many отмечает города сам)
+    if instance.status == BatteryTransfer.Status.APPROVED:
+        schedule_recount(city_ids={instance.from_city_id, instance.to_city_id})
+
+
+# --- Депозиты на руках по городам (DepositSnapshot) ---
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_recount_deposits(sender, instance: Payment, **kwargs):
+    # Прежние тип и договор — из payment_remember_type (pre_save)
+    states = [(instance.type, instance.rental_id), getattr(instance, '_attribution_old', None) or (None, None)]
+    rental_ids = {rental_id for type_, rental_id in states if type_ in DEPOSIT_TYPES}
+    if rental_ids:
+        schedule_deposit_recount(rental_ids=rental_ids)
+
+
+@receiver(pre_save, sender=Rental)
+def rental_remember_city(sender, instance: Rental, **kwargs):
+    # Депозиты группируются по городу корня: смена города корня переносит их
+    instance._deposit_old_city_id = (
+        Rental.objects.filter(pk=instance.pk).values_list('city_id', flat=True).first()
+        if instance.pk and instance.root_id == instance.pk else instance.city_id
+    )
+
+
+@receiver(post_save, sender=Rental)
+def rental_recount_deposits(sender, instance: Rental, created, **kwargs):
+    old_city_id = getattr(instance, '_deposit_old_city_id', instance.city_id)
+    if not created and old_city_id != instance.city_id:
+        schedule_deposit_recount(city_ids={old_city_id, instance.city_id})
+
+
+@receiver(post_delete, sender=Rental)
+def rental_delete_recount_deposits(sender, instance: Rental, **kwargs):
+    # Платежи удалённой группы уходят каскадом — город корня известен только здесь
+    if instance.root_id in (None, instance.pk):
+        schedule_deposit_recount(city_ids={instance.city_id})
+
 
 # --- Auto create OwnerContribution for "внесение денег" ---
 @receiver(post_save, sender=Expense)
@@ -127,3 +183,40 @@ def repair_delete_statuslog(sender, instance: Repair, **kwargs):
         repair=instance,
         start_at=instance.start_at,
     ).delete()
+
+
+# --- Инкрементальный пересчёт атрибуции батарей ---
+def _rental_root_id(rental_id):
+    if not rental_id:
+        return None
+    return Rental.objects.filter(pk=rental_id).values_list('root_id', flat=True).first()
+
+
+@receiver(post_save, sender=Rental)
+@receiver(post_delete, sender=Rental)
+def rental_attribution_refresh(sender, instance: Rental, **kwargs):
+    schedule_refresh(root_ids=[instance.root_id or instance.pk])
+
+
+@receiver(pre_save, sender=Payment)
+def payment_remember_type(sender, instance: Payment, **kwargs):
+    # Прежние тип и договор: платёж, переставший быть оплатой аренды, тоже меняет атрибуцию
+    instance._attribution_old = (
+        Payment.objects.filter(pk=instance.pk).values_list('type', 'rental_id').first()
+        if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_attribution_refresh(sender, instance: Payment, **kwargs):
+    states = [(instance.type, instance.rental_id), getattr(instance, '_attribution_old', None) or (None, None)]
+    rental_ids = {rental_id for type_, rental_id in states if type_ == Payment.PaymentType.RENT}
+    if rental_ids:
+        schedule_refresh(root_ids=[_rental_root_id(rental_id) for rental_id in rental_ids])
+
+
+@receiver(post_save, sender=Repair)
+@receiver(post_delete, sender=Repair)
+def repair_attribution_refresh(sender, instance: Repair, **kwargs):
+    schedule_refresh(battery_ids=[instance.battery_id])
@@ -0,0 +1,134 @@
+"""
+Снимок договора для форм модератора (карточка договора, форма платежа) за один
+запрос к серверу: клиент, договор, статус, начало группы, текущие батареи,
+последние платежи и разбивка баланса группы.
+
+Фиксированное число запросов независимо от размера группы:
+1) версия + клиент + город + корень + текущие батареи (подзапросы StringAgg/Count),
+   load_rental — отдельно, чтобы вызывающий проверил права до расчёта;
+2–3) версии и назначения группы (billing.load_groups);
+4) суммы платежей группы по типам;
+5) последние платежи группы.
+
+ETag (snapshot_etag) считается без построения снимка — одним запросом со
+счётчиками и max(updated_at) версий, назначений и платежей группы: при совпадении
+If-None-Match шаги 2–5 не выполняются и тело не собирается.
+"""
+import hashlib
+from decimal import Decimal
+
+from django.db.models import CharField, Count, Max, Subquery, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+
+from . import billing
+from .models import Payment, Rental, RentalBatteryAssignment
+
+RECENT_PAYMENTS = 5
+
+
+def _money(value):
+    return f"{(value or Decimal(0)):.2f}"
+
+
+def load_rental(rental_id, now):
+    """Версия договора со связанными объектами и текущими батарями или None."""
+    return (
+        Rental.objects.select_related('client', 'city', 'root')
+        .annotate(**RentalBatteryAssignment.current_batteries(now=now))
+        .filter(pk=rental_id)
+        .first()
+    )
+
+
+def snapshot_etag(rental, now):
+    """
+    Ключ ETag снимка (hex md5) без его построения: счётчики и max(updated_at) версий,
+    назначений и платежей группы, клиент, текущие батареи из load_rental и местная дата
+    (начисления посуточные, батареи меняются по времени без записей).
+    """
+    root_id = rental.root_id or rental.pk
+
+    def stamp(model, **filters):
+        return Subquery(
+            model.objects.filter(**filters).order_by().values(*filters)
+            .annotate(key=Concat(Cast(Count('id'), CharField()), Value('@'), Cast(Max('updated_at'), CharField())))
+            .values('key'),
+            output_field=CharField(),
+        )
+
+    stamps = Rental.objects.filter(pk=root_id).values_list(
+        stamp(Rental, root_id=root_id),
+        stamp(RentalBatteryAssignment, rental__root_id=root_id),
+        stamp(Payment, rental__root_id=root_id),
+    ).first() or ()
+    parts = [
+        *stamps,
+        rental.pk,
+        rental.client.updated_at if rental.client else None,
+        rental.current_battery_codes,
+        timezone.localdate(now),
+    ]
+    return hashlib.md5('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def rental_snapshot(rental, now, payments_limit=RECENT_PAYMENTS):
+    """Снимок договора (dict для JSON); rental — результат load_rental."""
+    tz = timezone.get_current_timezone()
+    root = rental.root or rental
+
+    summaries, _groups = billing.group_summaries([root.pk], tz, now)
+    summary = summaries.get(root.pk, {})
+    charges = summary.get('charges', Decimal(0))
+    paid = summary.get('paid', Decimal(0))
+    deposit = summary.get('deposit', Decimal(0))
+
+    payments = (
+        Payment.objects.filter(rental__root_id=root.pk)
+        .only('id', 'date', 'amount', 'type', 'method', 'rental_id')
+        .order_by('-date', '-id')[:payments_limit]
+    )
+    group_start_at = root.group_start_at or root.start_at
+    codes = rental.current_battery_codes
+    return {
+        'rental': {
+            'id': rental.pk,
+            'root_id': root.pk,
+            'version': rental.version,
+            'contract_code': rental.contract_code or f'#{rental.pk}',
+            'status': rental.status,
+            'status_display': rental.get_status_display(),
+            'is_active': rental.status == Rental.Status.ACTIVE,
+            'city_id': rental.city_id,
+            'weekly_rate': _money(rental.weekly_rate),
+            'start_at': rental.start_at.isoformat(),
+            'group_start_at': group_start_at.isoformat() if group_start_at else None,
+            'start_date': timezone.localtime(group_start_at, tz).strftime('%d.%m.%Y %H:%M') if group_start_at else '-',
+        },
+        'client': {
+            'id': rental.client_id,
+            'name': rental.client.name if rental.client else '-',
+            'phone': rental.client.phone if rental.client else '',
+        },
+        # По номеру батареи, как в get_rental_info (StringAgg упорядочен по началу назначения)
+        'batteries': sorted(codes.split(', ')) if codes else [],
+        'recent_payments': [
+            {
+                'id': p.pk,
+                'date': p.date.strftime('%d.%m.%Y'),
+                'amount': str(p.amount),
+                'type': p.type,
+                'type_display': p.get_type_display(),
+                'method_display': p.get_method_display(),
+            }
+            for p in payments
+        ],
+        # balance — переплата (paid − charges), debt — долг (charges − paid)
+        'balance': {
+            'charges': _money(charges),
+            'paid': _money(paid),
+            'deposit': _money(deposit),
+            'balance': _money(paid - charges),
+            'debt': _money(charges - paid),
+        },
+    }
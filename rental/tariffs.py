@@ -0,0 +1,203 @@
+"""
+Пакетная смена тарифов (ScheduledTariffChange) и перенос батарей между версиями.
+
+Смена применяется пачками по chunk версий, одна транзакция на пачку:
+- корни групп и версии блокируются select_for_update (как в _create_next_version);
+- номера новых версий — от latest_version корня (денормализовано на корне);
+- старые версии закрываются bulk_update, новые создаются bulk_create
+  (история — simple_history);
+- активные назначения закрываются одним bulk UPDATE и продолжаются в новых
+  версиях одним bulk INSERT; побочные эффекты назначений — один раз на пачку
+  через batch_assignment_effects.
+
+Версии, начинающиеся после effective_at (платная версия после бесплатных дней,
+заранее созданная следующая версия), не делятся — ставка меняется на месте.
+Версии с нулевой ставкой (бесплатные дни) не трогаются.
+
+Повторный запуск безопасен: новые и переоценённые версии уже имеют new_weekly_rate
+и под фильтр target_versions не попадают.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+from .assignment_effects import assignments_saved, batch_assignment_effects
+from .attribution import schedule_refresh
+from .models import Rental, RentalBatteryAssignment, ScheduledTariffChange
+
+DEFAULT_CHUNK = 100
+
+
+def _user_name(user):
+    if user is None:
+        return ''
+    return user.get_full_name() or user.username or user.email
+
+
+def carry_over_assignments(version_pairs, user, cut_at):
+    """
+    Закрывает на cut_at активные назначения старых версий и создаёт их продолжения
+    в новых. Назначения, которые начинаются не раньше cut_at, целиком переносятся
+    в новую версию: закрытие на cut_at дало бы start_at > end_at (DataError в tstzrange).
+    version_pairs — [(id старой версии, новая версия)].
+    Один SELECT, один bulk UPDATE, один bulk INSERT на все пары.
+    Возвращает (изменённые назначения, созданные продолжения).
+    """
+    new_by_old = {old_id: new for old_id, new in version_pairs}
+    if not new_by_old:
+        return [], []
+    now = timezone.now()
+    changed = list(
+        RentalBatteryAssignment.objects.filter(rental_id__in=new_by_old).filter(
+            Q(end_at__isnull=True) | Q(end_at__gt=cut_at)
+        )
+    )
+    if not changed:
+        return [], []
+    continuations = []
+    for a in changed:
+        new_version = new_by_old[a.rental_id]
+        a.updated_by = user
+        a.updated_at = now
+        if a.start_at >= cut_at:
+            a.rental = new_version
+            continue
+        a.end_at = cut_at
+        continuations.append(RentalBatteryAssignment(
+            rental=new_version,
+            battery_id=a.battery_id,
+            start_at=cut_at,
+            end_at=None,
+            created_by=user,
+            updated_by=user,
+        ))
+    with batch_assignment_effects(user):
+        bulk_update_with_history(
+            changed, RentalBatteryAssignment, ["rental", "end_at", "updated_by", "updated_at"], default_user=user
+        )
+        if continuations:
+            try:
+                with transaction.atomic():
+                    bulk_create_with_history(continuations, RentalBatteryAssignment, default_user=user)
+            except IntegrityError as e:
+                raise RentalBatteryAssignment.overlap_error(e) or e
+        assignments_saved(changed + continuations)
+    return changed, continuations
+
+
+def _apply_chunk(change, version_ids, user):
+    """
+    Одна пачка версий в одной транзакции.
+    Возвращает (число созданных версий, число версий с изменённой на месте ставкой).
+    """
+    effective_at = change.effective_at
+    now = timezone.now()
+    user_name = _user_name(user)
+    with transaction.atomic(), batch_assignment_effects(user):
+        root_ids = {
+            root_id or pk
+            for pk, root_id in Rental.objects.filter(pk__in=version_ids).values_list('pk', 'root_id')
+        }
+        # Сначала корни (как next_version_number), затем сами версии — с повторной проверкой статуса.
+        # Номер последней версии группы хранится на корне (latest_version)
+        next_version = dict(
+            Rental.objects.select_for_update(of=('self',)).filter(pk__in=root_ids).order_by('pk')
+            .values_list('pk', 'latest_version__version')
+        )
+        locked = list(
+            Rental.objects.select_for_update().filter(pk__in=version_ids, status=Rental.Status.ACTIVE)
+            .filter(Q(end_at__isnull=True) | Q(end_at__gt=effective_at))
+            .exclude(weekly_rate=change.new_weekly_rate).exclude(weekly_rate=0)
+            .order_by('pk')
+        )
+        if not locked:
+            return 0, 0
+        versions = [v for v in locked if v.start_at < effective_at]
+        later = [v for v in locked if v.start_at >= effective_at]
+        for v in later:
+            # Версия целиком после effective_at — новая ставка без деления
+            v.weekly_rate = change.new_weekly_rate
+            v.updated_by = user
+            v.updated_by_name = user_name
+            v.updated_at = now
+
+        new_versions = []
+        for v in versions:
+            root_id = v.root_id or v.pk
+            next_version[root_id] = (next_version.get(root_id) or v.version) + 1
+            # Запланированное окончание старой версии переходит в новую
+            planned_end = v.end_at if v.end_at and v.end_at > effective_at else None
+            v.end_at = effective_at
+            v.status = Rental.Status.MODIFIED
+            v.updated_by = user
+            v.updated_by_name = user_name
+            v.updated_at = now
+            new_versions.append(Rental(
+                client_id=v.client_id,
+                city_id=v.city_id,
+                start_at=effective_at,
+                end_at=planned_end,
+                weekly_rate=change.new_weekly_rate,
+                deposit_amount=v.deposit_amount,
+                status=Rental.Status.ACTIVE,
+                battery_type=v.battery_type,
+                parent_id=v.pk,
+                root_id=root_id,
+                version=next_version[root_id],
+                contract_code=v.contract_code,
+                created_by=user,
+                updated_by=user,
+                created_by_name=user_name,
+                updated_by_name=user_name,
+            ))
+
+        bulk_update_with_history(
+            versions + later, Rental,
+            ['end_at', 'status', 'weekly_rate', 'updated_by', 'updated_by_name', 'updated_at'],
+            default_user=user,
+        )
+        if new_versions:
+            bulk_create_with_history(new_versions, Rental, default_user=user)
+            carry_over_assignments([(v.pk, new) for v, new in zip(versions, new_versions)], user, effective_at)
+        # bulk-операции не отправляют post_save договоров
+        Rental.refresh_group_meta(root_ids)
+        schedule_refresh(root_ids=root_ids)
+    return len(new_versions), len(later)
+
+
+def apply_tariff_change(change, chunk_size=DEFAULT_CHUNK):
+    """
+    Применяет смену тарифа пачками. Ошибка пачки откатывает только её;
+    при ошибках смена остаётся PENDING и повторяется следующим запуском.
+    Возвращает отчёт {'versions', 'created', 'rerated', 'errors'}.
+    """
+    user = change.created_by
+    version_ids = list(change.target_versions().order_by('pk').values_list('pk', flat=True))
+    created = rerated = 0
+    errors = []
+    for i in range(0, len(version_ids), chunk_size):
+        chunk = version_ids[i:i + chunk_size]
+        try:
+            chunk_created, chunk_rerated = _apply_chunk(change, chunk, user)
+            created += chunk_created
+            rerated += chunk_rerated
+        except Exception as e:
+            errors.append({'versions': chunk, 'error': str(e)})
+
+    report = {'versions': len(version_ids), 'created': created, 'rerated': rerated, 'errors': errors}
+    change.applied_count += created + rerated
+    change.report = report
+    fields = ['applied_count', 'report', 'updated_at']
+    if not errors:
+        change.status = ScheduledTariffChange.Status.APPLIED
+        change.applied_at = timezone.now()
+        fields += ['status', 'applied_at']
+    change.save(update_fields=fields)
+    return report
+
+
+def due_changes(now=None):
+    return ScheduledTariffChange.objects.filter(
+        status=ScheduledTariffChange.Status.PENDING, effective_at__lte=now or timezone.now()
+    ).order_by('effective_at', 'pk')
@@ -24,6 +24,15 @@ def get_item(dictionary, key):
         return None
 
 
+@register.filter
+def get_index(sequence, index):
+    """Get element of list (or evaluated queryset) by position"""
+    try:
+        return sequence[index]
+    except (IndexError, TypeError, KeyError):
+        return None
+
+
 @register.filter
 def get_item_by_partner(list_of_dicts, partner_id):
     """Get dict from list by partner.id"""
@@ -0,0 +1,139 @@
+"""
+Хронология батареи: договоры (назначения с клиентом и номером договора),
+ремонты, переносы между городами, ручные записи лога статусов и простои.
+
+Все источники читаются одним запросом UNION ALL с одинаковым набором колонок
+(каждый подзапрос идёт по индексу (battery, start_at) / (battery, created_at)).
+Дублирующие записи лога не берутся: RENTED повторяет назначения, SERVICE с
+repair — ремонты. Простои — промежутки без аренды, сервиса и продажи между
+появлением батареи и текущим моментом, считаются одним проходом по
+отсортированным интервалам.
+"""
+from datetime import timedelta
+
+from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import BatteryStatusLog, BatteryTransfer, Repair, RentalBatteryAssignment
+
+# Простои короче этого порога в хронологии не показываются
+IDLE_MIN_GAP = timedelta(days=1)
+
+# Виды записей хронологии (kind лога статусов — отдельные значения)
+RENTAL = 'rental'
+REPAIR = 'repair'
+TRANSFER = 'transfer'
+IDLE = 'idle'
+
+# Виды, занимающие батарею (между ними — простой)
+_BUSY = {RENTAL, REPAIR, BatteryStatusLog.Kind.SERVICE, BatteryStatusLog.Kind.SOLD}
+
+
+def _columns(kind, start, end, rental=None, root=None, title=None, subtitle=None, amount=None):
+    """Колонки подзапроса в фиксированном порядке (порядок аннотаций = порядок колонок UNION)."""
+    text = models.CharField()
+    number = models.IntegerField()
+    return {
+        't_kind': kind,
+        't_start': start,
+        't_end': end if end is not None else Value(None, output_field=models.DateTimeField()),
+        't_obj': F('id'),
+        't_rental': rental if rental is not None else Value(None, output_field=number),
+        't_root': root if root is not None else Value(None, output_field=number),
+        't_title': title if title is not None else Value('', output_field=text),
+        't_subtitle': subtitle if subtitle is not None else Value('', output_field=text),
+        't_amount': amount if amount is not None else Value(
+            None, output_field=models.DecimalField(max_digits=12, decimal_places=2)
+        ),
+    }
+
+
+def timeline_queryset(battery_id):
+    """Один запрос UNION ALL по назначениям, ремонтам, переносам и логу статусов."""
+    text = models.CharField()
+    assignments = RentalBatteryAssignment.objects.filter(battery_id=battery_id).values(**_columns(
+        Value(RENTAL, output_field=text), F('start_at'), F('end_at'),
+        rental=F('rental_id'),
+        root=Coalesce(F('rental__root_id'), F('rental_id')),
+        title=F('rental__contract_code'),
+        subtitle=F('rental__client__name'),
+        amount=F('rental__weekly_rate'),
+    )).order_by()
+    repairs = Repair.objects.filter(battery_id=battery_id).values(**_columns(
+        Value(REPAIR, output_field=text), F('start_at'), F('end_at'),
+        title=F('description'),
+        amount=F('cost'),
+    ))
+    # Момент переноса — подтверждение (approved_at)
+    transfers = BatteryTransfer.objects.filter(
+        battery_id=battery_id, status=BatteryTransfer.Status.APPROVED
+    ).values(**_columns(
+        Value(TRANSFER, output_field=text), F('approved_at'), None,
+        title=F('from_city__name'),
+        subtitle=F('to_city__name'),
+    )).order_by()
+    logs = BatteryStatusLog.objects.filter(battery_id=battery_id).exclude(
+        kind=BatteryStatusLog.Kind.RENTED
+    ).exclude(repair__isnull=False).values(**_columns(F('kind'), F('start_at'), F('end_at')))
+    return assignments.union(repairs, transfers, logs, all=True).order_by('t_start')
+
+
+def idle_gaps(entries, since, now):
+    """Промежутки [start, end) без аренды/сервиса/продажи не короче IDLE_MIN_GAP."""
+    gaps = []
+    cursor = since  # конец занятости среди уже просмотренных интервалов
+    for e in entries:
+        if e['kind'] not in _BUSY:
+            continue
+        start = e['start_at']
+        if cursor is None or start > cursor:
+            if cursor is not None and start - cursor >= IDLE_MIN_GAP:
+                gaps.append((cursor, start))
+            cursor = start
+        end = e['end_at'] or now
+        if end > cursor:
+            cursor = end
+        if cursor >= now:
+            return gaps
+    if cursor is not None and now - cursor >= IDLE_MIN_GAP:
+        gaps.append((cursor, None))
+    return gaps
+
+
+def battery_timeline(battery_id, since=None, now=None):
+    """
+    Записи хронологии батареи по убыванию начала (свежие сверху):
+    {'kind', 'start_at', 'end_at', 'id', 'rental_id', 'root_id', 'title', 'subtitle', 'amount', 'days'}.
+    since — появление батареи в системе (начало отсчёта простоев).
+    """
+    now = now or timezone.now()
+    entries = [
+        {
+            'kind': row['t_kind'],
+            'start_at': row['t_start'],
+            'end_at': row['t_end'],
+            'id': row['t_obj'],
+            'rental_id': row['t_rental'],
+            'root_id': row['t_root'],
+            'title': row['t_title'],
+            'subtitle': row['t_subtitle'],
+            'amount': row['t_amount'],
+        }
+        for row in timeline_queryset(battery_id)
+    ]
+    if entries and (since is None or entries[0]['start_at'] < since):
+        since = entries[0]['start_at']
+    for start, end in idle_gaps(entries, since, now):
+        entries.append({
+            'kind': IDLE, 'start_at': start, 'end_at': end, 'id': None, 'rental_id': None, 'root_id': None,
+            'title': '', 'subtitle': '', 'amount': None,
+        })
+    for e in entries:
+        if e['kind'] == TRANSFER:
+            e['days'] = None
+            continue
+        e['days'] = ((e['end_at'] or now) - e['start_at']).days
+    entries.sort(key=lambda e: e['start_at'], reverse=True)
+    return entries
@@ -0,0 +1,232 @@
+"""
+Утилизация батарей по времени (доля батарее-дней в аренде / на сервисе / свободно).
+
+Интервалы аренды (назначения + BatteryStatusLog RENTED), сервиса и продажи
+(BatteryStatusLog SERVICE/SOLD) загружаются четырьмя запросами и сортируются один раз
+по (battery_id, время). Затем для каждой батареи выполняется проход sweep-line
+со счётчиками открытых интервалов каждого вида:
+- есть открытая продажа — батарея вне парка, время не учитывается;
+- есть открытая аренда — в аренде;
+- есть открытый сервис — на сервисе;
+- иначе — свободна (простой).
+
+Время относится к городу, где батарея была в этот момент (подтверждённые
+переносы, как FleetHistory.city_at), а не к её текущему городу. Проданные
+батареи учитываются до продажи.
+"""
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .fleet_state import fleet_battery_ids, transfer_timelines
+from .models import Battery, BatteryStatusLog, RentalBatteryAssignment
+
+# Виды интервалов (индексы счётчиков) и состояния (индексы накопителей)
+RENTED, SERVICE, SOLD = 0, 1, 2
+STATE_RENTED, STATE_SERVICE, STATE_AVAILABLE = 0, 1, 2
+DAY_SECONDS = 86400
+
+
+def week_starts(period_start, period_end, tz):
+    """Границы недель (понедельник 00:00 по местному времени), покрывающие период."""
+    first = timezone.localtime(period_start, tz).date()
+    first -= timedelta(days=first.weekday())
+    bounds = []
+    d = first
+    while True:
+        dt = timezone.make_aware(datetime.combine(d, time(0, 0)), tz)
+        bounds.append(dt)
+        if dt >= period_end:
+            break
+        d += timedelta(days=7)
+    return bounds
+
+
+def _overlapping(qs, period_start, period_end):
+    return qs.filter(start_at__lt=period_end).filter(Q(end_at__isnull=True) | Q(end_at__gt=period_start))
+
+
+def load_events(battery_ids, period_start, period_end):
+    """
+    События начала/конца интервалов, обрезанных по периоду, отсортированные
+    по (battery_id, время). Порядок событий в один и тот же момент не важен:
+    между ними нулевая длительность. Элемент: (battery_id, момент, вид, +1/−1).
+    """
+    sources = [
+        (RENTED, RentalBatteryAssignment.objects.filter(battery_id__in=battery_ids)),
+        (RENTED, BatteryStatusLog.objects.filter(battery_id__in=battery_ids, kind=BatteryStatusLog.Kind.RENTED)),
+        (SERVICE, BatteryStatusLog.objects.filter(battery_id__in=battery_ids, kind=BatteryStatusLog.Kind.SERVICE)),
+        (SOLD, BatteryStatusLog.objects.filter(battery_id__in=battery_ids, kind=BatteryStatusLog.Kind.SOLD)),
+    ]
+    events = []
+    for kind, qs in sources:
+        for battery_id, start_at, end_at in _overlapping(qs, period_start, period_end).values_list(
+            'battery_id', 'start_at', 'end_at'
+        ):
+            s = max(start_at, period_start)
+            e = min(end_at, period_end) if end_at else period_end
+            if e <= s:
+                continue
+            events.append((battery_id, s, kind, 1))
+            events.append((battery_id, e, kind, -1))
+    events.sort(key=lambda ev: (ev[0], ev[1]))
+    return events
+
+
+def compute_utilization(battery_qs, period_start, period_end, tz):
+    """
+    Утилизация по батареям, городам и неделям за [period_start, period_end).
+    Возвращает словарь:
+      batteries — список по батареям (дни по состояниям, доля аренды, простои;
+        end_city_id — город батареи на конец периода, где идёт текущий простой);
+      cities — {city_id: {'rented', 'service', 'available', 'utilization'}} (в днях);
+      weeks — список начал недель; heatmap — {city_id: [доля аренды по неделям или None]}.
+    """
+    batteries = list(battery_qs.values('id', 'short_code', 'city_id', 'created_at'))
+    battery_ids = [b['id'] for b in batteries]
+    events = load_events(battery_ids, period_start, period_end)
+    timelines = transfer_timelines(battery_ids)
+
+    bounds = week_starts(period_start, period_end, tz)
+    n_weeks = len(bounds) - 1
+    # [rented, service, available] секунд по городу и неделе; батареи, бывшие в городе
+    week_totals = {}
+    city_batteries = {}
+    # Город последнего учтённого промежутка батареи (к нему относится текущий простой)
+    end_city = {}
+
+    def add_city_span(battery_id, city_id, state_idx, t0, t1):
+        city_batteries.setdefault(city_id, set()).add(battery_id)
+        end_city[battery_id] = city_id
+        bins = week_totals.setdefault(city_id, [[0.0, 0.0, 0.0] for _ in range(n_weeks)])
+        i = max(bisect_right(bounds, t0) - 1, 0)
+        while t0 < t1 and i < n_weeks:
+            seg_end = min(t1, bounds[i + 1])
+            bins[i][state_idx] += (seg_end - t0).total_seconds()
+            t0 = seg_end
+            i += 1
+
+    def add_span(battery_id, current_city_id, state_idx, t0, t1):
+        # Промежуток делится моментами переносов: каждая часть — городу на её начало
+        entry = timelines.get(battery_id)
+        if not entry:
+            add_city_span(battery_id, current_city_id, state_idx, t0, t1)
+            return
+        times, cities = entry
+        i = bisect_right(times, t0)
+        while t0 < t1:
+            seg_end = min(t1, times[i]) if i < len(times) else t1
+            add_city_span(battery_id, cities[i], state_idx, t0, seg_end)
+            t0 = seg_end
+            i += 1
+
+    # Индексы событий каждой батареи в общем отсортированном массиве
+    ranges = {}
+    for idx, ev in enumerate(events):
+        r = ranges.get(ev[0])
+        if r is None:
+            ranges[ev[0]] = [idx, idx + 1]
+        else:
+            r[1] = idx + 1
+
+    per_battery = []
+    for b in batteries:
+        # Начало учёта: начало периода, но не раньше появления батареи в системе
+        # (если интервалы начинаются раньше created_at — с первого интервала)
+        start = max(period_start, b['created_at']) if b['created_at'] else period_start
+        lo, hi = ranges.get(b['id'], (0, 0))
+        if hi > lo:
+            start = min(start, events[lo][1])
+        counts = [0, 0, 0]
+        seconds = [0.0, 0.0, 0.0]
+        longest_idle = 0.0
+        idle_since = None
+        t = start
+
+        def advance(t0, t1):
+            nonlocal idle_since, longest_idle
+            if t1 <= t0:
+                return
+            if counts[SOLD]:
+                state = None
+            elif counts[RENTED]:
+                state = STATE_RENTED
+            elif counts[SERVICE]:
+                state = STATE_SERVICE
+            else:
+                state = STATE_AVAILABLE
+            if state is not None:
+                seconds[state] += (t1 - t0).total_seconds()
+                add_span(b['id'], b['city_id'], state, t0, t1)
+            if state == STATE_AVAILABLE:
+                if idle_since is None:
+                    idle_since = t0
+            elif idle_since is not None:
+                longest_idle = max(longest_idle, (t0 - idle_since).total_seconds())
+                idle_since = None
+
+        for idx in range(lo, hi):
+            _battery_id, at, kind, delta = events[idx]
+            at = max(at, start)
+            advance(t, at)
+            t = max(t, at)
+            counts[kind] += delta
+        advance(t, period_end)
+        current_idle = 0.0
+        if idle_since is not None:
+            current_idle = (period_end - idle_since).total_seconds()
+            longest_idle = max(longest_idle, current_idle)
+
+        total = sum(seconds)
+        per_battery.append({
+            'id': b['id'],
+            'short_code': b['short_code'],
+            'city_id': b['city_id'],
+            'end_city_id': end_city.get(b['id'], b['city_id']),
+            'rented_days': seconds[STATE_RENTED] / DAY_SECONDS,
+            'service_days': seconds[STATE_SERVICE] / DAY_SECONDS,
+            'available_days': seconds[STATE_AVAILABLE] / DAY_SECONDS,
+            'utilization': (seconds[STATE_RENTED] / total * 100) if total else None,
+            'longest_idle_days': longest_idle / DAY_SECONDS,
+            'current_idle_days': current_idle / DAY_SECONDS,
+        })
+
+    # Итоги по городам — из тех же промежутков, что и тепловая карта
+    cities = {}
+    for city_id, bins in week_totals.items():
+        rented, service, available = (sum(b[i] for b in bins) / DAY_SECONDS for i in range(3))
+        total = rented + service + available
+        cities[city_id] = {
+            'rented': rented,
+            'service': service,
+            'available': available,
+            'batteries': len(city_batteries[city_id]),
+            'utilization': (rented / total * 100) if total else None,
+        }
+
+    heatmap = {}
+    for city_id, bins in week_totals.items():
+        heatmap[city_id] = [
+            (rented / (rented + service + available) * 100) if (rented + service + available) else None
+            for rented, service, available in bins
+        ]
+
+    return {
+        'batteries': per_battery,
+        'cities': cities,
+        'weeks': bounds[:-1],
+        'heatmap': heatmap,
+    }
+
+
+def fleet_battery_queryset(city_ids):
+    """
+    Батареи, бывшие в парке городов: текущий город или переносы в них/из них.
+    Проданные включены — время после продажи отсекает интервал SOLD.
+    city_ids=None — весь парк, включая батареи без города.
+    """
+    if city_ids is None:
+        return Battery.objects.all()
+    return Battery.objects.filter(pk__in=fleet_battery_ids(city_ids))
@@ -4,16 +4,18 @@ from django.utils import timezone
 from django.db.models import Count, Sum, Avg
 from datetime import timedelta, datetime, time
 from django.db import models
-from django.db.models import Prefetch, Q
+from django.db.models import Q
 from django.template.response import TemplateResponse
-from django.http import FileResponse, HttpResponse, HttpResponseForbidden
+from django.http import FileResponse, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.conf import settings
+from django.urls import reverse
 import os
 
 from decimal import Decimal
 
-from .models import Client, Rental, Battery, Payment, Repair, RentalBatteryAssignment, FinancePartner, MoneyTransfer, City, ExpenseCategory, Expense
+from .models import Client, Rental, Battery, BatteryStatusLog, Payment, Repair, RentalBatteryAssignment, FinancePartner, MoneyTransfer, City, ExpenseCategory, Expense
 from .admin_utils import get_user_city, get_debug_log_path
+from .counters import MAIN_STATUSES, status_counts, status_counts_by_city
 
 
 def calculate_balances_for_rentals(rentals, tz, now_dt):
@@ -122,15 +124,10 @@ def dashboard(request):
     
     # Активные клиенты: есть хотя бы один активный рентал
     # Активные клиенты с предзагрузкой назначений батарей
-    now = timezone.now()
-    active_assignments_qs = RentalBatteryAssignment.objects.filter(
-        start_at__lte=now
-    ).filter(Q(end_at__isnull=True) | Q(end_at__gt=now)).select_related('battery')
     active_rentals = (
         Rental.objects
         .filter(status=Rental.Status.ACTIVE)
         .select_related('client')
-        .prefetch_related(Prefetch('assignments', queryset=active_assignments_qs, to_attr='active_assignments'))
     )
     if filter_city:
         active_rentals = active_rentals.filter(city=filter_city)
@@ -139,8 +136,10 @@ def dashboard(request):
     active_clients_ids = active_rentals.values_list('client_id', flat=True).distinct()
     active_clients_count = active_rentals.values_list('client_id', flat=True).distinct().count()
 
-    # Батареи у активных клиентов: соберём по предзагруженным назначениям
-    batteries_by_client = {r.client_id: [a.battery for a in r.active_assignments] for r in active_rentals}
+    # Батареи у активных клиентов: по указателю текущего клиента на батарее
+    batteries_by_client = {}
+    for battery in Battery.objects.filter(current_client_id__in=active_clients_ids).order_by('short_code'):
+        batteries_by_client.setdefault(battery.current_client_id, []).append(battery)
 
     # Отдельный запрос для статистики по батареям
     now = timezone.now()
@@ -184,17 +183,18 @@ def dashboard(request):
             'weekly_rate': weekly_rate,
         })
 
-    # Статистика по батареям — только по статусу (available, rented, service)
-    batteries_qs = Battery.objects.all()
+    # Статистика по батареям — только по статусу (available, rented, service), из таблицы счётчиков
     if filter_city:
-        batteries_qs = batteries_qs.filter(city=filter_city)
+        counter_city_ids = [filter_city.id]
     elif filter_cities:
-        batteries_qs = batteries_qs.filter(city__in=filter_cities)
-    main_statuses = [Battery.Status.AVAILABLE, Battery.Status.RENTED, Battery.Status.SERVICE]
-    rented_now = batteries_qs.filter(status=Battery.Status.RENTED).count()
-    in_service = batteries_qs.filter(status=Battery.Status.SERVICE).count()
-    available = batteries_qs.filter(status=Battery.Status.AVAILABLE).count()
-    total_batteries = batteries_qs.filter(status__in=main_statuses).count()
+        counter_city_ids = [c.id for c in filter_cities]
+    else:
+        counter_city_ids = None
+    counts = status_counts(counter_city_ids)
+    rented_now = counts.get(Battery.Status.RENTED, {}).get('count', 0)
+    in_service = counts.get(Battery.Status.SERVICE, {}).get('count', 0)
+    available = counts.get(Battery.Status.AVAILABLE, {}).get('count', 0)
+    total_batteries = sum(counts.get(status, {}).get('count', 0) for status in MAIN_STATUSES)
     battery_stats = {
         'total': total_batteries,
         'rented': rented_now,
@@ -366,6 +366,22 @@ def dashboard(request):
         'values': [val for _, val in debtors]
     }
 
+    # Депозиты на руках: строки DepositSnapshot по городам (поддерживаются сигналами платежей),
+    # без прохода по платежам
+    from .counters import deposits_held_by_city
+    if filter_city:
+        deposit_snapshot = deposits_held_by_city([filter_city.id])
+    elif filter_cities:
+        deposit_snapshot = deposits_held_by_city([c.id for c in filter_cities])
+    else:
+        deposit_snapshot = deposits_held_by_city()
+    if filter_city:
+        deposits_held = deposit_snapshot.get(filter_city.id, Decimal(0))
+    elif filter_cities:
+        deposits_held = sum((deposit_snapshot.get(c.id, Decimal(0)) for c in filter_cities), Decimal(0))
+    else:
+        deposits_held = sum(deposit_snapshot.values(), Decimal(0))
+
     total_paid_30 = float(sum(paid_values))
     total_charged_30 = float(sum(charges_values))
 
@@ -524,14 +540,14 @@ def dashboard(request):
         cities = City.objects.filter(active=True)
         today = timezone.localdate()
         last_30_days = today - timedelta(days=30)
+        counts_by_city = status_counts_by_city([city.id for city in cities])
         
         for city in cities:
             # Батареи по городу — только по статусу (available, rented, service)
-            city_batteries = Battery.objects.filter(city=city)
-            main_statuses = [Battery.Status.AVAILABLE, Battery.Status.RENTED, Battery.Status.SERVICE]
-            city_batteries_total = city_batteries.filter(status__in=main_statuses).count()
-            city_batteries_rented = city_batteries.filter(status=Battery.Status.RENTED).count()
-            city_batteries_available = city_batteries.filter(status=Battery.Status.AVAILABLE).count()
+            city_counts = counts_by_city.get(city.id, {})
+            city_batteries_total = sum(city_counts.get(status, 0) for status in MAIN_STATUSES)
+            city_batteries_rented = city_counts.get(Battery.Status.RENTED, 0)
+            city_batteries_available = city_counts.get(Battery.Status.AVAILABLE, 0)
             
             # Активные клиенты по городу
             city_active_clients = Client.objects.filter(
@@ -571,6 +587,7 @@ def dashboard(request):
             'charges_series': charges_series,
             'top_debtors': top_debtors,
             'overall_debt': overall_debt,
+            'deposits_held': deposits_held,
             'total_paid_30': total_paid_30,
             'total_charged_30': total_charged_30,
             'window_days': window_days,
@@ -706,6 +723,15 @@ def city_analytics(request):
     cities = City.objects.filter(active=True)
     if city_filter:
         cities = cities.filter(id=city_filter.id)
+
+    # Утилизация по времени за 30 дней: доля батарее-дней в аренде
+    from .utilization import compute_utilization, fleet_battery_queryset
+    now_dt = timezone.now()
+    utilization = compute_utilization(
+        fleet_battery_queryset([c.id for c in cities]),
+        now_dt - timedelta(days=30), now_dt, timezone.get_current_timezone(),
+    )['cities']
+    counts_by_city = status_counts_by_city([c.id for c in cities])
     
     analytics_data = []
     for city in cities:
@@ -732,19 +758,10 @@ def city_analytics(request):
         ).aggregate(total=Sum('amount'))['total'] or Decimal(0)
         
         # Статистика по батареям — только по статусу (available, rented, service)
-        main_statuses = [Battery.Status.AVAILABLE, Battery.Status.RENTED, Battery.Status.SERVICE]
-        batteries_total = Battery.objects.filter(
-            city=city,
-            status__in=main_statuses
-        ).count()
-        batteries_rented = Battery.objects.filter(
-            city=city,
-            status=Battery.Status.RENTED
-        ).count()
-        batteries_available = Battery.objects.filter(
-            city=city,
-            status=Battery.Status.AVAILABLE
-        ).count()
+        city_counts = counts_by_city.get(city.id, {})
+        batteries_total = sum(city_counts.get(status, 0) for status in MAIN_STATUSES)
+        batteries_rented = city_counts.get(Battery.Status.RENTED, 0)
+        batteries_available = city_counts.get(Battery.Status.AVAILABLE, 0)
         
         # Активные клиенты
         active_clients = Client.objects.filter(
@@ -768,7 +785,7 @@ def city_analytics(request):
             'batteries_total': batteries_total,
             'batteries_rented': batteries_rented,
             'batteries_available': batteries_available,
-            'batteries_utilization': (batteries_rented / batteries_total * 100) if batteries_total > 0 else 0,
+            'batteries_utilization': utilization.get(city.id, {}).get('utilization') or 0,
             'active_clients': active_clients,
             'avg_payment': avg_payment,
         })
@@ -812,3 +829,542 @@ def download_debug_log(request):
         return response
     except Exception as e:
         return HttpResponse(f"Error reading log: {str(e)}", status=500)
+
+
+def _report_cities(request):
+    """
+    Города, доступные пользователю в отчётах: модераторы/владельцы — свои города,
+    суперпользователь — все или выбранный параметром ?city=.
+    Пользователь без города и без роли владельца не видит ни одного города.
+    Возвращает (queryset городов, выбранный город или None).
+    """
+    from .admin_utils import get_user_cities
+    cities = City.objects.filter(active=True).order_by('name')
+    selected_city = None
+    if not request.user.is_superuser:
+        user_cities = get_user_cities(request.user)
+        if user_cities is None:
+            return City.objects.none(), None
+        cities = cities.filter(id__in=[c.id for c in user_cities])
+    city_id = request.GET.get('city')
+    if city_id:
+        selected_city = cities.filter(id=city_id).first()
+        if selected_city:
+            cities = cities.filter(id=selected_city.id)
+    return cities, selected_city
+
+
+def _report_city_ids(request, cities, selected_city):
+    """
+    id городов для фильтров отчёта. None — суперпользователь без выбранного города:
+    все данные, включая неактивные города и договоры/батареи без города.
+    """
+    if request.user.is_superuser and not selected_city:
+        return None
+    return {c.id for c in cities}
+
+
+def _report_city_rows(cities, city_ids, seen_ids):
+    """
+    Города для строк отчёта: cities, а при city_ids=None — ещё и города из seen_ids,
+    которых нет в cities (неактивные), и строка «Без города» для None.
+    """
+    city_list = list(cities)
+    if city_ids is not None:
+        return city_list
+    missing = set(seen_ids) - {c.id for c in city_list}
+    city_list += City.objects.filter(id__in=missing - {None}).order_by('name')
+    if None in missing:
+        city_list.append(City(name='Без города'))
+    return city_list
+
+
+@staff_member_required
+def receivables_aging(request):
+    """Просрочка дебиторской задолженности по корзинам: по городам, модераторам и клиентам"""
+    from django.contrib.auth.models import User
+    from . import billing
+
+    cities, selected_city = _report_cities(request)
+    city_ids = _report_city_ids(request, cities, selected_city)
+    include_closed = request.GET.get('closed') == '1'
+
+    # Группы (root) с активной версией; по запросу — и закрытые
+    groups_qs = Rental.objects.all() if city_ids is None else Rental.objects.filter(city_id__in=city_ids)
+    if not include_closed:
+        groups_qs = groups_qs.filter(status=Rental.Status.ACTIVE)
+    root_ids = list(groups_qs.values_list('root_id', flat=True).distinct())
+
+    tz = timezone.get_current_timezone()
+    now_dt = timezone.now()
+    versions_by_root, assignments_by_version = billing.load_groups(root_ids)
+    paid_by_root = {
+        root_id: totals.get(Payment.PaymentType.RENT, Decimal(0))
+        for root_id, totals in billing.group_payment_totals(root_ids).items()
+    }
+    aging = billing.aging_by_root(versions_by_root, assignments_by_version, paid_by_root, tz, now_dt)
+
+    # Справочники одним запросом каждый
+    city_names = dict(City.objects.values_list('id', 'name'))
+    client_ids = {versions[-1]['client_id'] for versions in versions_by_root.values()}
+    client_names = dict(Client.objects.filter(id__in=client_ids).values_list('id', 'name'))
+    # Модератор группы — тот, кто создал первую версию (root)
+    creators = {
+        root_id: versions[0]['created_by_id']
+        for root_id, versions in versions_by_root.items()
+    }
+    users = {
+        u['id']: (f"{u['first_name']} {u['last_name']}".strip() or u['username'])
+        for u in User.objects.filter(id__in=set(creators.values())).values('id', 'username', 'first_name', 'last_name')
+    }
+
+    n = len(billing.AGING_BUCKETS)
+
+    def add(table, key, name, data):
+        row = table.setdefault(key, {'name': name, 'buckets': [Decimal(0)] * n, 'total': Decimal(0), 'groups': 0})
+        row['buckets'] = [a + b for a, b in zip(row['buckets'], data['buckets'])]
+        row['total'] += data['total']
+        row['groups'] += 1
+
+    by_city, by_moderator, by_client = {}, {}, {}
+    totals = {'buckets': [Decimal(0)] * n, 'total': Decimal(0)}
+    for root_id, data in aging.items():
+        if data['total'] <= 0:
+            continue
+        latest = versions_by_root[root_id][-1]
+        add(by_city, latest['city_id'], city_names.get(latest['city_id'], '—'), data)
+        creator_id = creators.get(root_id)
+        add(by_moderator, creator_id, users.get(creator_id, 'Не указан'), data)
+        add(by_client, latest['client_id'], client_names.get(latest['client_id'], '—'), data)
+        totals['buckets'] = [a + b for a, b in zip(totals['buckets'], data['buckets'])]
+        totals['total'] += data['total']
+
+    def ordered(table):
+        return sorted(table.values(), key=lambda r: r['total'], reverse=True)
+
+    context = {
+        'buckets': [label for _key, label, _lo, _hi in billing.AGING_BUCKETS],
+        'sections': [
+            ('По городам', 'Город', ordered(by_city)),
+            ('По модераторам', 'Модератор', ordered(by_moderator)),
+            ('По клиентам', 'Клиент', ordered(by_client)),
+        ],
+        'totals': totals,
+        'totals_by_bucket': list(zip([label for _key, label, _lo, _hi in billing.AGING_BUCKETS], totals['buckets'])),
+        'include_closed': include_closed,
+        'selected_city': selected_city,
+        'cities': City.objects.filter(active=True) if request.user.is_superuser else [],
+    }
+    return TemplateResponse(request, 'admin/receivables_aging.html', context)
+
+
+@staff_member_required
+def revenue_forecast(request):
+    """Прогноз начислений по городам и неделям с учётом исторической собираемости"""
+    from . import billing
+
+    cities, selected_city = _report_cities(request)
+    try:
+        weeks = min(max(int(request.GET.get('weeks', 8)), 1), 52)
+    except ValueError:
+        weeks = 8
+
+    tz = timezone.get_current_timezone()
+    now_dt = timezone.now()
+    city_ids = _report_city_ids(request, cities, selected_city)
+    first, daily_by_city = billing.forecast_by_city(city_ids, tz, now_dt, weeks * 7)
+
+    # Историческая собираемость: оплаты аренды / начисления за такой же прошлый период
+    hist_last = first - timedelta(days=1)
+    hist_first = first - timedelta(days=weeks * 7)
+    hist_start_dt = timezone.make_aware(datetime.combine(hist_first, time(0, 0)), tz)
+    groups_qs = Rental.objects.all() if city_ids is None else Rental.objects.filter(city_id__in=city_ids)
+    root_ids = groups_qs.filter(Q(end_at__isnull=True) | Q(end_at__gt=hist_start_dt)).values('root_id')
+    versions_by_root, assignments_by_version = billing.load_groups(root_ids)
+    hist_charges = billing.charges_by_city_in_period(
+        versions_by_root, assignments_by_version, tz, now_dt, hist_first, hist_last
+    )
+    paid_qs = Payment.objects.filter(type=Payment.PaymentType.RENT, date__gte=hist_first, date__lte=hist_last)
+    if city_ids is not None:
+        paid_qs = paid_qs.filter(city_id__in=city_ids)
+    hist_paid = dict(
+        paid_qs
+        .values('city_id')
+        .annotate(total=Sum('amount'))
+        .values_list('city_id', 'total')
+    )
+
+    city_list = _report_city_rows(cities, city_ids, set(daily_by_city) | set(hist_charges) | set(hist_paid))
+    week_labels = [first + timedelta(days=7 * i) for i in range(weeks)]
+    rows = []
+    totals_by_week = [Decimal(0)] * weeks
+    for city in city_list:
+        daily = daily_by_city.get(city.id, [Decimal(0)] * (weeks * 7))
+        by_week = [sum(daily[7 * i:7 * i + 7], Decimal(0)) for i in range(weeks)]
+        totals_by_week = [a + b for a, b in zip(totals_by_week, by_week)]
+        charged = hist_charges.get(city.id, Decimal(0))
+        paid = hist_paid.get(city.id) or Decimal(0)
+        ratio = (paid / charged) if charged > 0 else None
+        total = sum(by_week, Decimal(0))
+        rows.append({
+            'city': city,
+            'weeks': by_week,
+            'total': total,
+            'hist_charged': charged,
+            'hist_paid': paid,
+            'collection_ratio': ratio * 100 if ratio is not None else None,
+            'expected_collected': total * ratio if ratio is not None else None,
+        })
+    rows.sort(key=lambda r: r['total'], reverse=True)
+    week_rows = [
+        {'start': label, 'values': [r['weeks'][i] for r in rows], 'total': totals_by_week[i]}
+        for i, label in enumerate(week_labels)
+    ]
+
+    context = {
+        'rows': rows,
+        'week_rows': week_rows,
+        'grand_total': sum(totals_by_week, Decimal(0)),
+        'weeks': weeks,
+        'hist_first': hist_first,
+        'hist_last': hist_last,
+        'selected_city': selected_city,
+        'cities': City.objects.filter(active=True) if request.user.is_superuser else [],
+    }
+    return TemplateResponse(request, 'admin/revenue_forecast.html', context)
+
+
+# Старение депозитов закрытых договоров: дни с окончания последней версии
+DEPOSIT_AGING_BUCKETS = (
+    ('0–7 дней', 0, 7),
+    ('8–30 дней', 8, 30),
+    ('31–90 дней', 31, 90),
+    ('90+ дней', 91, None),
+)
+
+
+@staff_member_required
+def deposit_liability(request):
+    """Удерживаемые депозиты: по городам, по клиентам и старение невозвращённых по закрытым договорам"""
+    from . import billing
+
+    cities, selected_city = _report_cities(request)
+    city_ids = _report_city_ids(request, cities, selected_city)
+    held_rows = list(billing.held_deposits_by_group(city_ids))
+    city_list = _report_city_rows(cities, city_ids, {row['rental__root__city_id'] for row in held_rows})
+    today = timezone.localdate()
+
+    by_city = {c.id: {'city': c, 'active': Decimal(0), 'closed': Decimal(0), 'total': Decimal(0)} for c in city_list}
+    by_client = {}
+    aging = [Decimal(0)] * len(DEPOSIT_AGING_BUCKETS)
+    closed_groups = []
+    for row in held_rows:
+        held = row['held']
+        city_row = by_city[row['rental__root__city_id']]
+        city_row['total'] += held
+        client_row = by_client.setdefault(row['rental__root__client_id'], {
+            'name': row['rental__root__client__name'],
+            'url': reverse('admin:rental_client_change', args=[row['rental__root__client_id']]),
+            'total': Decimal(0),
+            'groups': 0,
+        })
+        client_row['total'] += held
+        client_row['groups'] += 1
+        if row['has_active']:
+            city_row['active'] += held
+            continue
+        city_row['closed'] += held
+        days = (today - timezone.localtime(row['group_end']).date()).days if row['group_end'] else 0
+        for i, (_label, lo, hi) in enumerate(DEPOSIT_AGING_BUCKETS):
+            if days >= lo and (hi is None or days <= hi):
+                aging[i] += held
+                break
+        closed_groups.append({
+            'contract_code': row['rental__root__contract_code'],
+            'client': row['rental__root__client__name'],
+            'url': reverse('admin:rental_rental_change', args=[row['rental__root_id']]),
+            'held': held,
+            'closed_at': row['group_end'],
+            'days': days,
+        })
+
+    closed_groups.sort(key=lambda r: r['days'], reverse=True)
+    context = {
+        'by_city': sorted(by_city.values(), key=lambda r: r['total'], reverse=True),
+        'by_client': sorted(by_client.values(), key=lambda r: r['total'], reverse=True),
+        'aging': list(zip([label for label, _lo, _hi in DEPOSIT_AGING_BUCKETS], aging)),
+        'closed_groups': closed_groups,
+        'grand_total': sum((r['total'] for r in by_city.values()), Decimal(0)),
+        'selected_city': selected_city,
+        'cities': City.objects.filter(active=True) if request.user.is_superuser else [],
+    }
+    return TemplateResponse(request, 'admin/deposit_liability.html', context)
+
+
+@staff_member_required
+def battery_utilization(request):
+    """Утилизация батарей по времени: по городам, тепловая карта по неделям, простои батарей"""
+    from .utilization import compute_utilization, fleet_battery_queryset
+
+    cities, selected_city = _report_cities(request)
+    try:
+        days = min(max(int(request.GET.get('days', 90)), 7), 730)
+    except ValueError:
+        days = 90
+
+    tz = timezone.get_current_timezone()
+    now_dt = timezone.now()
+    city_ids = _report_city_ids(request, cities, selected_city)
+    result = compute_utilization(
+        fleet_battery_queryset(city_ids),
+        now_dt - timedelta(days=days), now_dt, tz,
+    )
+    city_list = _report_city_rows(cities, city_ids, result['cities'])
+
+    city_rows = []
+    for city in city_list:
+        stats = result['cities'].get(city.id)
+        if not stats:
+            continue
+        # Прозрачность ячейки тепловой карты готовим строкой, чтобы не зависеть от локализации чисел
+        heatmap = [
+            {'value': v, 'alpha': f"{(v or 0) / 100:.2f}"}
+            for v in result['heatmap'].get(city.id, [])
+        ]
+        city_rows.append({'city': city, **stats, 'heatmap': heatmap})
+    city_rows.sort(key=lambda r: r['utilization'] or 0, reverse=True)
+
+    # Батареи с самым долгим текущим простоем — в выбранных городах на конец периода
+    # (батарея, перенесённая в другой город, простаивает уже там)
+    idle = sorted(
+        (b for b in result['batteries'] if city_ids is None or b['end_city_id'] in city_ids),
+        key=lambda b: b['current_idle_days'],
+        reverse=True,
+    )
+    city_names = {c.id: c.name for c in city_list}
+    idle_rows = [
+        {
+            **b,
+            'city_name': city_names.get(b['end_city_id'], '—'),
+            'url': reverse('admin:rental_battery_change', args=[b['id']]),
+        }
+        for b in idle[:50]
+    ]
+
+    context = {
+        'city_rows': city_rows,
+        'weeks': result['weeks'],
+        'idle_rows': idle_rows,
+        'days': days,
+        'selected_city': selected_city,
+        'cities': City.objects.filter(active=True) if request.user.is_superuser else [],
+    }
+    return TemplateResponse(request, 'admin/battery_utilization.html', context)
+
+
+# Строк на страницу в каждом разделе проверки назначений
+ASSIGNMENT_ISSUES_PER_PAGE = 100
+
+
+@staff_member_required
+def assignment_integrity(request):
+    """Согласованность назначений: двойные назначения батарей, дни без батарей, назначения вне окна версии"""
+    from django.core.paginator import Paginator
+    from .integrity import find_assignment_issues
+
+    cities, selected_city = _report_cities(request)
+    result = find_assignment_issues(_report_city_ids(request, cities, selected_city))
+
+    def rental_link(v):
+        return {
+            'id': v['id'],
+            'contract_code': v['contract_code'],
+            'version': v['version'],
+            'client': v['client__name'],
+            'url': reverse('admin:rental_rental_change', args=[v['id']]),
+        } if v else None
+
+    def section(issues, param, row):
+        # Каждый раздел листается отдельно (?<param>=N); строки — только для текущей страницы
+        page = Paginator(issues, ASSIGNMENT_ISSUES_PER_PAGE).get_page(request.GET.get(param))
+
+        def page_url(number):
+            query = request.GET.copy()
+            query[param] = number
+            return '?' + query.urlencode()
+
+        return {
+            'rows': [row(i) for i in page.object_list],
+            'total': page.paginator.count,
+            'page': page,
+            'prev_url': page_url(page.previous_page_number()) if page.has_previous() else None,
+            'next_url': page_url(page.next_page_number()) if page.has_next() else None,
+        }
+
+    double_bookings = section(result['double_bookings'], 'double_page', lambda i: {
+        'battery_code': i['battery_code'],
+        'battery_url': reverse('admin:rental_battery_change', args=[i['battery_id']]),
+        'first': i['first'],
+        'second': i['second'],
+        'first_rental': rental_link(i['first_rental']),
+        'second_rental': rental_link(i['second_rental']),
+        'same_group': i['same_group'],
+        'overlap_start': i['overlap_start'],
+        'overlap_end': i['overlap_end'],
+    })
+    gaps = section(sorted(result['gaps'], key=lambda i: i['gap_days'], reverse=True), 'gaps_page', lambda i: {
+        'rental': rental_link(i['rental']),
+        'window': i['window'],
+        'gaps': i['gaps'],
+        'gap_days': i['gap_days'],
+        'no_assignments': i['no_assignments'],
+    })
+    outside_window = section(result['outside_window'], 'outside_page', lambda i: {
+        'assignment': i['assignment'],
+        'battery_code': i['battery_code'],
+        'rental': rental_link(i['rental']),
+        'rental_start': i['rental']['start_at'],
+        'rental_end': i['rental']['end_at'],
+        'starts_early': i['starts_early'],
+        'ends_late': i['ends_late'],
+    })
+
+    context = {
+        'double_bookings': double_bookings,
+        'gaps': gaps,
+        'outside_window': outside_window,
+        'checked_versions': result['versions'],
+        'checked_assignments': result['assignments'],
+        'selected_city': selected_city,
+        'cities': City.objects.filter(active=True) if request.user.is_superuser else [],
+    }
+    return TemplateResponse(request, 'admin/assignment_integrity.html', context)
+
+
+# Ограничение числа моментов в одном запросе ряда (API состояния парка)
+FLEET_SERIES_MAX_POINTS = 2000
+
+
+def _parse_moment(value, default=None):
+    """Момент из параметра запроса (ISO или datetime-local); наивный — в местном времени."""
+    from django.utils.dateparse import parse_datetime
+    try:
+        moment = parse_datetime(value) if value else None
+    except ValueError:
+        moment = None
+    if moment is None:
+        return default
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.get_current_timezone())
+    return moment
+
+
+@staff_member_required
+def fleet_as_of(request):
+    """Состояние парка на момент T: батареи по городам, клиентам и договорам"""
+    from .fleet_state import FleetHistory, fleet_battery_ids
+
+    cities, selected_city = _report_cities(request)
+    city_ids = _report_city_ids(request, cities, selected_city)
+    at = _parse_moment(request.GET.get('at'), timezone.now())
+
+    history = FleetHistory(None if city_ids is None else fleet_battery_ids(city_ids))
+    states = history.state_at(at, city_ids)
+    city_names = dict(City.objects.values_list('id', 'name'))
+    # Русские подписи статусов — из BatteryStatusLog.Kind (значения совпадают с Battery.Status)
+    status_labels = dict(BatteryStatusLog.Kind.choices)
+
+    by_city = {}
+    rows = []
+    for state in states:
+        city_row = by_city.setdefault(state['city_id'], {
+            'name': city_names.get(state['city_id'], '—'),
+            'total': 0,
+            **{status: 0 for status in Battery.Status.values},
+        })
+        city_row[state['status']] += 1
+        city_row['total'] += 1
+        rental = state['rental']
+        rows.append({
+            'short_code': state['short_code'],
+            'url': reverse('admin:rental_battery_change', args=[state['id']]),
+            'city': city_row['name'],
+            'status': state['status'],
+            'status_label': status_labels.get(state['status'], state['status']),
+            'client': rental['client_name'] if rental else None,
+            'client_url': reverse('admin:rental_client_change', args=[rental['client_id']]) if rental else None,
+            'contract_code': rental['contract_code'] if rental else None,
+            'rental_url': reverse('admin:rental_rental_change', args=[rental['root_id']]) if rental else None,
+        })
+    rows.sort(key=lambda r: (r['city'], r['short_code'] or ''))
+
+    context = {
+        'at': at,
+        'at_value': timezone.localtime(at).strftime('%Y-%m-%dT%H:%M'),
+        'city_rows': sorted(by_city.values(), key=lambda r: r['name']),
+        'rows': rows,
+        'api_url': reverse('fleet-as-of-api'),
+        'selected_city': selected_city,
+        'cities': City.objects.filter(active=True) if request.user.is_superuser else [],
+    }
+    return TemplateResponse(request, 'admin/fleet_as_of.html', context)
+
+
+@staff_member_required
+def fleet_as_of_api(request):
+    """
+    JSON состояния парка. ?at=... — батареи и счётчики по городам на момент;
+    ?from=...&to=...&step_hours=24 — ряд счётчиков по городам (для графиков утилизации).
+    """
+    from .fleet_state import FleetHistory, fleet_battery_ids
+
+    cities, selected_city = _report_cities(request)
+    city_ids = _report_city_ids(request, cities, selected_city)
+    history = FleetHistory(None if city_ids is None else fleet_battery_ids(city_ids))
+
+    def counts_json(counts):
+        return {
+            str(city_id) if city_id is not None else 'none': {str(k): v for k, v in by_status.items()}
+            for city_id, by_status in counts.items()
+        }
+
+    start = _parse_moment(request.GET.get('from'))
+    if start is not None:
+        end = _parse_moment(request.GET.get('to'), timezone.now())
+        try:
+            step = timedelta(hours=max(int(request.GET.get('step_hours', 24)), 1))
+        except ValueError:
+            return JsonResponse({'error': 'step_hours должен быть целым числом'}, status=400)
+        if end < start or (end - start) / step > FLEET_SERIES_MAX_POINTS:
+            return JsonResponse({'error': f'Не более {FLEET_SERIES_MAX_POINTS} моментов в ряду'}, status=400)
+        moments = []
+        moment = start
+        while moment <= end:
+            moments.append(moment)
+            moment += step
+        return JsonResponse({
+            'series': [
+                {'at': moment.isoformat(), 'counts': counts_json(counts)}
+                for moment, counts in history.series(moments, city_ids)
+            ],
+        })
+
+    at = _parse_moment(request.GET.get('at'), timezone.now())
+    states = history.state_at(at, city_ids)
+    return JsonResponse({
+        'at': at.isoformat(),
+        'counts': counts_json(history.count(states)),
+        'batteries': [
+            {
+                'id': s['id'],
+                'short_code': s['short_code'],
+                'city_id': s['city_id'],
+                'status': str(s['status']),
+                'rental_id': s['rental']['rental_id'] if s['rental'] else None,
+                'root_id': s['rental']['root_id'] if s['rental'] else None,
+                'contract_code': s['rental']['contract_code'] if s['rental'] else None,
+                'client_id': s['rental']['client_id'] if s['rental'] else None,
+            }
+            for s in states
+        ],
+    })